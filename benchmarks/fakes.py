@@ -0,0 +1,470 @@
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+import hashlib
+import io
+import json
+import numpy as np
+import os
+import random
+import re
+import threading
+import time
+
+
+class LatencyProfile:
+
+    def __init__(self, mean_ms=0, jitter_ms=0, per_item_ms=0, error_rate=0, time_scale=1, seed=None):
+        '''Latency and failure behaviour of one fake service
+            Params: mean_ms (float) - Mean latency of a call in milliseconds
+                    jitter_ms (float) - Standard deviation of the latency
+                    per_item_ms (float) - Extra latency per item in a call, e.g. per vector upserted or token generated
+                    error_rate (float) - Probability that a call fails
+                    time_scale (float) - Multiplier applied to every latency, below 1 to shorten runs
+                    seed (int) - Seed for repeatable latencies and failures'''
+
+        self.mean_ms = mean_ms
+        self.jitter_ms = jitter_ms
+        self.per_item_ms = per_item_ms
+        self.error_rate = error_rate
+        self.time_scale = time_scale
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+
+    def wait(self, items=0):
+        '''Sleeps for one call's latency and returns True if the call should fail
+            Params: items (int) - Items in the call'''
+
+        with self.lock:
+            latency = max(0, self.random.gauss(self.mean_ms, self.jitter_ms)) + self.per_item_ms * items
+            failed = self.random.random() < self.error_rate
+            self.calls += 1
+            self.errors += int(failed)
+
+        time.sleep(latency * self.time_scale / 1000)
+
+        return failed
+
+
+    def summary(self):
+        return {'calls': self.calls, 'injected_errors': self.errors}
+
+
+def hashed_embedding(text, dimension=384):
+    '''Deterministic bag of words embedding, texts sharing words have similar vectors so filtered and unfiltered
+        retrieval return meaningful matches
+        Params: text (str) - Text to embed
+                dimension (int) - Vector dimension'''
+
+    vector = np.zeros(dimension, dtype='float32')
+
+    for word in re.findall(r'\w+', text.lower()):
+        digest = hashlib.md5(word.encode('utf-8')).digest()
+        vector[int.from_bytes(digest[:4], 'little') % dimension] += 1 if digest[4] % 2 else -1
+
+    norm = np.linalg.norm(vector)
+
+    return vector / norm if norm else vector
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': 'Injected by benchmark'}}, operation)
+
+
+class FakeBedrockClient:
+
+    def __init__(self, latency, answer_words=200):
+        '''Stands in for the bedrock-runtime client, recognising each prompt used by the pipelines and answering in the
+            format its caller parses. Injected errors are throttling errors so retry paths are exercised
+            Params: latency (LatencyProfile) - Latency per call, per_item_ms applies per output word
+                    answer_words (int) - Length of generated final answers'''
+
+        self.latency = latency
+        self.answer_words = answer_words
+
+
+    @staticmethod
+    def prompt_text(messages):
+        return messages[0]['content'][0]['text']
+
+
+    @staticmethod
+    def capitalised_entities(text, limit=12):
+        '''Picks capitalised phrases from text as stand-in entities'''
+
+        entities = re.findall(r'\b[A-Z][a-z]+(?: [A-Z][a-z]+)*', text)
+
+        return list(dict.fromkeys(entities))[:limit] or ['None']
+
+
+    def respond(self, prompt):
+        '''Returns the text a model would give for one of the pipeline prompts
+            Params: prompt (str) - Prompt sent to the model'''
+
+        if 'for each of the numbered user questions' in prompt:
+            questions = re.split(r'\nQuestion (\d+):\n', '\n' + prompt.split('do not try to rephrase them.')[1].split('Output only JSON')[0].strip())
+            return json.dumps({questions[n]: {"1": "{} results".format(questions[n + 1].strip()), "2": "{} players".format(questions[n + 1].strip())}
+                               for n in range(1, len(questions) - 1, 2)})
+
+        if 'Perform query decomposition' in prompt:
+            question = prompt.split('do not try to rephrase them.')[1].split('Output only the requested results')[0].strip()
+            return json.dumps({"1": "{} results".format(question), "2": "{} players".format(question)})
+
+        if prompt.startswith('Extract the year') or prompt.startswith('Extract the club'):
+            return 'None'
+
+        if prompt.startswith('Match any entities'):
+            question = prompt.split('Question - ')[1].split('List - ')[0]
+            entities = self.capitalised_entities(question, limit=3)
+            return ', '.join(entities)
+
+        if 'found in each of the numbered texts' in prompt:
+            texts = re.split(r'\nText (\d+):\n', '\n' + prompt.split('numbered texts below:')[1].split('Output only JSON')[0].strip())
+            return json.dumps({texts[n]: self.capitalised_entities(texts[n + 1]) for n in range(1, len(texts) - 1, 2)})
+
+        if prompt.startswith('Provide a comma separated list of unique entities'):
+            return ', '.join(self.capitalised_entities(prompt.split('found in this text:')[1]))
+
+        words = re.findall(r'\w+', prompt.split('Context -')[-1]) or ['answer']
+
+        return ' '.join(words[n % len(words)] for n in range(self.answer_words))
+
+
+    def converse(self, modelId, messages, **kwargs):
+        text = self.respond(self.prompt_text(messages))
+
+        if self.latency.wait(items=len(text.split())):
+            raise client_error('ThrottlingException', 'Converse')
+
+        return {'output': {'message': {'content': [{'text': text}]}},
+                'usage': {'inputTokens': len(self.prompt_text(messages)) // 4, 'outputTokens': len(text) // 4}}
+
+
+    def converse_stream(self, modelId, messages, **kwargs):
+        text = self.respond(self.prompt_text(messages))
+        words = text.split(' ')
+
+        if self.latency.wait():
+            raise client_error('ThrottlingException', 'ConverseStream')
+
+        def stream():
+            for n, word in enumerate(words):
+                time.sleep(self.latency.per_item_ms * self.latency.time_scale / 1000)
+                yield {'contentBlockDelta': {'delta': {'text': word if n == 0 else ' ' + word}, 'contentBlockIndex': 0}}
+
+            yield {'messageStop': {'stopReason': 'end_turn'}}
+            yield {'metadata': {'usage': {'inputTokens': len(self.prompt_text(messages)) // 4, 'outputTokens': len(text) // 4}}}
+
+        return {'stream': stream()}
+
+
+class FakeS3Client:
+
+    objects = {}
+    lock = threading.Lock()
+
+    def __init__(self, latency, directory):
+        '''Stands in for the S3 client. Every bucket lists and serves the PDFs under directory, keyed by their relative path,
+            and objects written by the pipelines are held in memory and shared between client instances
+            Params: latency (LatencyProfile) - Latency per call, per_item_ms applies per MB transferred
+                    directory (str) - Directory of source documents, e.g. demo_data'''
+
+        self.latency = latency
+        self.directory = directory
+
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.objects = {}
+
+
+    def document_keys(self):
+        keys = []
+
+        for root, _, files in os.walk(self.directory):
+            keys.extend(os.path.relpath(os.path.join(root, file_name), self.directory) for file_name in files)
+
+        return sorted(keys)
+
+
+    def read(self, bucket, key):
+        with self.lock:
+            if (bucket, key) in self.objects:
+                return self.objects[(bucket, key)]
+
+        path = os.path.join(self.directory, key)
+
+        if not os.path.isfile(path):
+            raise client_error('NoSuchKey', 'GetObject')
+
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+    @staticmethod
+    def etag(body):
+        return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+    def get_paginator(self, operation_name):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix=''):
+                client.latency.wait()
+                contents = []
+
+                for key in client.document_keys():
+                    if key.startswith(Prefix):
+                        with open(os.path.join(client.directory, key), 'rb') as f:
+                            contents.append({'Key': key, 'ETag': client.etag(f.read()), 'Size': os.path.getsize(os.path.join(client.directory, key))})
+
+                yield {'Contents': contents}
+
+        return Paginator()
+
+
+    def get_object(self, Bucket, Key):
+        body = self.read(Bucket, Key)
+
+        if self.latency.wait(items=len(body) / 1e6):
+            raise client_error('SlowDown', 'GetObject')
+
+        return {'Body': io.BytesIO(body), 'ETag': self.etag(body)}
+
+
+    def head_object(self, Bucket, Key):
+        self.latency.wait()
+
+        return {'ETag': self.etag(self.read(Bucket, Key))}
+
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        body = Body.encode('utf-8') if isinstance(Body, str) else Body
+
+        if self.latency.wait(items=len(body) / 1e6):
+            raise client_error('SlowDown', 'PutObject')
+
+        with self.lock:
+            current = self.objects.get((Bucket, Key))
+
+            if IfNoneMatch == '*' and current is not None:
+                raise client_error('PreconditionFailed', 'PutObject')
+
+            if IfMatch is not None and (current is None or self.etag(current) != IfMatch):
+                raise client_error('PreconditionFailed', 'PutObject')
+
+            self.objects[(Bucket, Key)] = body
+
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+
+    def delete_object(self, Bucket, Key):
+        self.latency.wait()
+
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+
+
+    def delete_objects(self, Bucket, Delete):
+        self.latency.wait()
+
+        with self.lock:
+            for i in Delete['Objects']:
+                self.objects.pop((Bucket, i['Key']), None)
+
+        return {}
+
+
+    def download_file(self, Bucket, Key, Filename):
+        with open(Filename, 'wb') as f:
+            f.write(self.get_object(Bucket, Key)['Body'].read())
+
+
+class FakeSecretsClient:
+
+    def get_secret_value(self, SecretId):
+        return {'SecretString': json.dumps({'key': 'benchmark-{}'.format(SecretId)})}
+
+
+class FakeBotoSession:
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def client(self, service_name, **kwargs):
+        return self.factory(service_name, **kwargs)
+
+
+class FakePineconeIndex:
+
+    def __init__(self, latency, query_latency):
+        '''Stands in for a Pinecone gRPC index, holding vectors per namespace in memory and answering queries by exact
+            cosine similarity with $in and $eq metadata filters
+            Params: latency (LatencyProfile) - Latency of upserts and deletes, per_item_ms applies per vector
+                    query_latency (LatencyProfile) - Latency of queries'''
+
+        self.latency = latency
+        self.query_latency = query_latency
+        self.namespaces = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=8)
+
+
+    def apply_upsert(self, vectors, namespace):
+        if self.latency.wait(items=len(vectors)):
+            raise RuntimeError('Injected upsert failure')
+
+        with self.lock:
+            records = self.namespaces.setdefault(namespace, {})
+
+            for vector_id, values, metadata in vectors:
+                records[vector_id] = (np.asarray(values, dtype='float32'), metadata)
+
+        class UpsertResponse:
+            upserted_count = len(vectors)
+
+        return UpsertResponse()
+
+
+    def upsert(self, vectors, namespace='', async_req=False, **kwargs):
+        if async_req:
+            return self.executor.submit(self.apply_upsert, vectors, namespace)
+
+        return self.apply_upsert(vectors, namespace)
+
+
+    def delete(self, ids, namespace='', **kwargs):
+        self.latency.wait(items=len(ids))
+
+        with self.lock:
+            records = self.namespaces.get(namespace, {})
+
+            for vector_id in ids:
+                records.pop(vector_id, None)
+
+
+    def update(self, id, set_metadata=None, namespace='', **kwargs):
+        self.latency.wait()
+
+        with self.lock:
+            record = self.namespaces.get(namespace, {}).get(id)
+
+            if record is not None:
+                record[1].update(set_metadata or {})
+
+
+    def describe_index_stats(self, **kwargs):
+        with self.lock:
+            return {'namespaces': {namespace: {'vector_count': len(records)} for namespace, records in self.namespaces.items()},
+                    'total_vector_count': sum(len(records) for records in self.namespaces.values())}
+
+
+    @staticmethod
+    def filter_match(metadata, query_filter):
+        for field, condition in (query_filter or {}).items():
+            values = condition.get('$in', []) + ([condition['$eq']] if '$eq' in condition else []) if isinstance(condition, dict) else [condition]
+            field_value = metadata.get(field)
+            field_values = field_value if isinstance(field_value, list) else [field_value]
+
+            if not set(map(str, field_values)) & set(map(str, values)):
+                return False
+
+        return True
+
+
+    def query(self, vector, filter=None, namespace=None, top_k=10, include_metadata=True, timeout=None, **kwargs):
+        if self.query_latency.wait():
+            raise RuntimeError('Injected query failure')
+
+        with self.lock:
+            records = [(vector_id, record) for vector_id, record in self.namespaces.get(namespace or '', {}).items() if self.filter_match(record[1], filter)]
+
+        if not records:
+            return {'matches': []}
+
+        matrix = np.stack([record[0] for _, record in records])
+        scores = matrix @ np.asarray(vector, dtype='float32')
+        best = np.argsort(-scores)[:top_k]
+
+        if not include_metadata:
+            return {'matches': [{'id': records[n][0], 'score': float(scores[n])} for n in best]}
+
+        return {'matches': [{'id': records[n][0], 'score': float(scores[n]), 'metadata': records[n][1][1]} for n in best]}
+
+
+class FakePinecone:
+
+    def __init__(self, latency, query_latency):
+        '''Stands in for PineconeGRPC. Every index name resolves to the same in memory index so the ingest and query
+            pipelines see the same vectors
+            Params: latency (LatencyProfile) - Latency of upserts and deletes
+                    query_latency (LatencyProfile) - Latency of queries'''
+
+        self.index = FakePineconeIndex(latency, query_latency)
+
+
+    def __call__(self, api_key=None, **kwargs):
+        return self
+
+
+    def Index(self, name):
+        return self.index
+
+
+class FakeHuggingFaceSession:
+
+    def __init__(self, latency, dimension=384):
+        '''Stands in for requests sessions posting to the Hugging Face inference API, answering with hashed embeddings.
+            Injected errors return the error body the API gives while a model is loading
+            Params: latency (LatencyProfile) - Latency per request, per_item_ms applies per input text
+                    dimension (int) - Vector dimension'''
+
+        self.latency = latency
+        self.dimension = dimension
+
+
+    def __call__(self):
+        return self
+
+
+    def post(self, url, headers=None, json=None, **kwargs):
+        inputs = json['inputs'] if isinstance(json['inputs'], list) else [json['inputs']]
+        failed = self.latency.wait(items=len(inputs))
+        dimension = self.dimension
+
+        class Response:
+            def json(self):
+                if failed:
+                    return {'error': 'Model is currently loading', 'estimated_time': 20}
+
+                vectors = [hashed_embedding(text, dimension).tolist() for text in inputs]
+
+                return vectors if isinstance(json['inputs'], list) else vectors[0]
+
+        return Response()
+
+
+class FakeSentenceTransformer:
+
+    dimension = 384
+    per_text_ms = 0 # Simulated encoding cost, set by the benchmark runner
+
+    def __init__(self, model_name_or_path=None, **kwargs):
+        '''Stands in for SentenceTransformer with the same hashed embeddings as the Hugging Face fake, so queries match
+            ingested chunks'''
+
+        self.model_name = model_name_or_path
+
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, **kwargs):
+        time.sleep(self.per_text_ms * len(sentences) / 1000)
+
+        return np.stack([hashed_embedding(text, self.dimension) for text in sentences]) if sentences else np.empty((0, self.dimension), dtype='float32')
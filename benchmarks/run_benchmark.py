@@ -0,0 +1,508 @@
+'''Offline benchmark of the ingest and query pipelines. Bedrock, S3, Secrets Manager, Pinecone, the Hugging Face inference
+API and the sentence-transformers model are replaced with the stand-ins in fakes.py, everything else runs the real code
+in vector_generation_pipeline and query_generation_function against the demo_data PDFs.
+
+    python benchmarks/run_benchmark.py --output results.json
+    python benchmarks/run_benchmark.py --time-scale 0.1 --baseline results.json
+    python benchmarks/run_benchmark.py --fast
+
+--fast runs one PDF and one query once at a hundredth of the simulated latency, a check that both pipelines still run
+end to end in seconds rather than a measurement. --max-documents and --max-queries pick other subsets.
+
+Results are written as JSON with per stage latency percentiles, throughput and peak memory for each phase.'''
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import argparse
+import datetime
+import importlib.util
+import json
+import logging
+import numpy as np
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(REPO_ROOT, 'query_generation_function'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'vector_generation_pipeline'))
+
+import fakes
+import query_generation.query_generation as qg
+
+
+# Service - latency profile defaults, overridden with --profiles
+DEFAULT_PROFILES = {'bedrock': {'mean_ms': 600, 'jitter_ms': 150, 'per_item_ms': 10, 'error_rate': 0},
+                    's3': {'mean_ms': 30, 'jitter_ms': 10, 'per_item_ms': 20, 'error_rate': 0},
+                    'pinecone_upsert': {'mean_ms': 80, 'jitter_ms': 20, 'per_item_ms': 0.1, 'error_rate': 0},
+                    'pinecone_query': {'mean_ms': 40, 'jitter_ms': 10, 'per_item_ms': 0, 'error_rate': 0},
+                    'huggingface': {'mean_ms': 120, 'jitter_ms': 30, 'per_item_ms': 2, 'error_rate': 0},
+                    'sentence_transformers': {'per_item_ms': 3}}
+
+SAMPLE_QUERIES = ['How did Arsenal perform in the 2016-17 season?',
+                  'Who was Chelsea manager when they won the league?',
+                  'Compare Liverpool and Manchester United results in 2019',
+                  'Which players left Man Utd in the summer of 2018?',
+                  'What happened to the Gunners in the Champions League last season?',
+                  'Who scored the most goals for the Reds in 2020-21?',
+                  'How many points did Chelsea finish with in 2015?',
+                  'What trophies did Liverpool win between 2018 and 2020?']
+
+# Option - default with and without --fast
+RUN_DEFAULTS = {'time_scale': (1.0, 0.01),
+                'iterations': (3, 1),
+                'max_documents': (None, 1),
+                'max_queries': (None, 1)}
+
+
+class StageRecorder:
+
+    def __init__(self):
+        self.durations = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+
+
+    def record(self, stage, seconds, failed=False):
+        with self.lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+            if failed:
+                self.failures[stage] = self.failures.get(stage, 0) + 1
+
+
+    def instrument(self, owner, method_name, stage):
+        '''Returns a patch timing every call to a method as one sample of the stage
+            Params: owner (class) - Class or module holding the method
+                    method_name (str) - Method to time
+                    stage (str) - Stage name in the results'''
+
+        method = getattr(owner, method_name)
+        recorder = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            failed = True
+
+            try:
+                result = method(*args, **kwargs)
+                failed = False
+                return result
+
+            finally:
+                recorder.record(stage, time.perf_counter() - start, failed)
+
+        return mock.patch.object(owner, method_name, timed)
+
+
+    def instrument_generator(self, owner, method_name, stage):
+        '''Returns a patch timing a generator method, one sample per call covering only the time spent inside the generator
+            Params: owner (class) - Class holding the method
+                    method_name (str) - Generator method to time
+                    stage (str) - Stage name in the results'''
+
+        method = getattr(owner, method_name)
+        recorder = self
+
+        def timed(*args, **kwargs):
+            generator = method(*args, **kwargs)
+            elapsed = 0
+
+            while True:
+                start = time.perf_counter()
+
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    recorder.record(stage, elapsed + time.perf_counter() - start)
+                    return
+
+                elapsed += time.perf_counter() - start
+                yield item
+
+        return mock.patch.object(owner, method_name, timed)
+
+
+    @staticmethod
+    def summarise(durations):
+        '''Returns latency statistics in milliseconds
+            Params: durations (list) - Durations in seconds'''
+
+        milliseconds = np.asarray(durations) * 1000
+
+        return {'count': len(durations),
+                'mean_ms': round(float(milliseconds.mean()), 3),
+                'p50_ms': round(float(np.percentile(milliseconds, 50)), 3),
+                'p95_ms': round(float(np.percentile(milliseconds, 95)), 3),
+                'p99_ms': round(float(np.percentile(milliseconds, 99)), 3),
+                'max_ms': round(float(milliseconds.max()), 3)}
+
+
+    def results(self):
+        with self.lock:
+            return {stage: dict(self.summarise(durations), failures=self.failures.get(stage, 0)) for stage, durations in sorted(self.durations.items())}
+
+
+class Benchmark:
+
+    def __init__(self, profiles, data_directory, time_scale=1, seed=0, vector_backend='pinecone', answer_words=200):
+        '''Wires the fake services into both pipelines and runs them
+            Params: profiles (dict) - Service name to LatencyProfile arguments
+                    data_directory (str) - Directory of PDFs served by the fake S3, laid out as <year>/<file>.pdf
+                    time_scale (float) - Multiplier for every simulated latency
+                    seed (int) - Seed for simulated latencies and failures
+                    vector_backend (str) - pinecone (fake) or local (the real local index)
+                    answer_words (int) - Length of generated final answers'''
+
+        self.profiles = {name: fakes.LatencyProfile(time_scale=time_scale, seed=seed + n, **profile)
+                         for n, (name, profile) in enumerate(sorted(profiles.items()))}
+        self.data_directory = data_directory
+        self.vector_backend = vector_backend
+        self.local_index_path = tempfile.mkdtemp(prefix='benchmark_index_')
+
+        self.bedrock = fakes.FakeBedrockClient(self.profiles['bedrock'], answer_words=answer_words)
+        self.pinecone = fakes.FakePinecone(self.profiles['pinecone_upsert'], self.profiles['pinecone_query'])
+        self.huggingface = fakes.FakeHuggingFaceSession(self.profiles['huggingface'])
+
+        fakes.FakeSentenceTransformer.per_text_ms = profiles['sentence_transformers'].get('per_item_ms', 0) * time_scale
+        fakes.FakeS3Client.reset()
+        qg.ResourceCache.entries.clear()
+
+
+    def boto3_client(self, service_name, *args, **kwargs):
+        if service_name == 'bedrock-runtime':
+            return self.bedrock
+
+        if service_name == 's3':
+            return fakes.FakeS3Client(self.profiles['s3'], self.data_directory)
+
+        if service_name == 'secretsmanager':
+            return fakes.FakeSecretsClient()
+
+        raise ValueError("No benchmark stand-in for {}".format(service_name))
+
+
+    def service_patches(self):
+        return [mock.patch('boto3.client', self.boto3_client),
+                mock.patch('boto3.session.Session', lambda *args, **kwargs: fakes.FakeBotoSession(self.boto3_client)),
+                mock.patch.object(qg, 'Pinecone', self.pinecone),
+                mock.patch.object(qg.requests, 'Session', self.huggingface),
+                mock.patch.object(qg.requests, 'post', self.huggingface.post)]
+
+
+    @staticmethod
+    def load_main(name, directory):
+        '''Imports a pipeline's main.py under its own module name, both pipelines have a main module'''
+
+        spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_ROOT, directory, 'main.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        return module
+
+
+    @staticmethod
+    def memory_usage():
+        '''Returns peak traced Python allocations and peak resident memory of this process and its worker processes in MB'''
+
+        _, traced_peak = tracemalloc.get_traced_memory()
+
+        return {'peak_traced_mb': round(traced_peak / 2 ** 20, 2),
+                'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+                'max_rss_children_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 2)}
+
+
+    def run_ingest(self, workers=1):
+        '''Runs the ingest pipeline's main over every PDF in data_directory. With more than one worker the sharded ingest
+            is run instead, its workers as threads so they share the in memory fakes
+            Params: workers (int) - Shard workers'''
+
+        import data_load.data_load as dl
+        import data_vectorisation.vectorise as vec
+
+        ingest_main = self.load_main('ingest_main', 'vector_generation_pipeline')
+        recorder = StageRecorder()
+
+        patches = self.service_patches() + [mock.patch.object(vec, 'PineconeGRPC', self.pinecone),
+                                            mock.patch.object(vec, 'SentenceTransformer', fakes.FakeSentenceTransformer),
+                                            mock.patch.object(ingest_main, 'INCREMENTAL', False),
+                                            mock.patch.object(ingest_main, 'VECTOR_BACKEND', self.vector_backend),
+                                            mock.patch.object(ingest_main, 'LOCAL_INDEX_PATH', self.local_index_path),
+                                            mock.patch.object(ingest_main, 'CHUNK_STORE_PATH', os.path.join(self.local_index_path, 'chunk_store')),
+                                            mock.patch.object(ingest_main, 'LOCAL_SHARD_PATH', os.path.join(self.local_index_path, 'shard_store')),
+                                            recorder.instrument_generator(dl.S3DataLoad, 'completed_downloads', 'download_wait'),
+                                            recorder.instrument_generator(vec.PDFLoader, 'completed_pdfs', 'pdf_parse_wait'),
+                                            recorder.instrument(vec.EntityExtraction, 'rate_limited_interaction', 'bedrock_entity_request'),
+                                            recorder.instrument(vec.ChunkDeduplication, 'deduplicate', 'deduplication'),
+                                            recorder.instrument(vec.EntityExtraction, 'entity_extraction', 'entity_extraction'),
+                                            recorder.instrument(vec.MetadataExtraction, 'metadata_extraction', 'metadata_extraction'),
+                                            recorder.instrument(vec.MetadataExtraction, 'chunks_dataframe_creation', 'chunks_dataframe'),
+                                            recorder.instrument(vec.VectorGeneration, 'vector_generation', 'vector_generation'),
+                                            recorder.instrument(vec.PineconeUpsert, 'pinecone_upsert', 'upsert'),
+                                            recorder.instrument(vec.LocalVectorUpsert, 'local_upsert', 'upsert'),
+                                            recorder.instrument(vec.StreamingIngest, 'process_batch', 'streaming_batch'),
+                                            recorder.instrument(vec.IngestManifest, 'save', 'manifest_save')]
+
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        with ExitPatches(patches):
+            if workers > 1:
+                threads = [threading.Thread(target=ingest_main.shard_worker, kwargs={'worker_id': 'benchmark-{}'.format(n), 'local': True}) for n in range(workers)]
+
+                for thread in threads:
+                    thread.start()
+
+                for thread in threads:
+                    thread.join()
+
+            else:
+                ingest_main.main()
+
+        wall_seconds = time.perf_counter() - start
+        memory = self.memory_usage()
+        tracemalloc.stop()
+
+        manifest = json.loads(fakes.FakeS3Client(fakes.LatencyProfile(), self.data_directory).read('rag-training-lookup', 'ingest-manifest.json'))
+        chunks = sum(len(document['chunk_hashes']) for document in manifest['documents'].values())
+
+        self.publish_entity_list(manifest)
+
+        return {'wall_seconds': round(wall_seconds, 3),
+                'workers': workers,
+                'documents': len(manifest['documents']),
+                'chunks': chunks,
+                'chunks_per_second': round(chunks / wall_seconds, 3),
+                'memory': memory,
+                'stages': recorder.results()}
+
+
+    def publish_entity_list(self, manifest=None):
+        '''Writes the entity list read by the query function from the entities found at ingest'''
+
+        entities = sorted(set(entity for chunk_entities in (manifest or {}).get('entities', {}).values() for entity in chunk_entities if entity != 'None'))
+
+        fakes.FakeS3Client(fakes.LatencyProfile(), self.data_directory).put_object(Bucket='rag-training-lookup', Key='entity-list.json', Body=json.dumps(entities))
+
+
+    def run_queries(self, queries, iterations=1, concurrency=1, streaming=False, semantic_cache=False, batch=False):
+        '''Runs every query through the query function's main, or its streaming generator, iterations times
+            Params: queries (list) - User queries
+                    iterations (int) - Times each query is run
+                    concurrency (int) - Queries run at once, as concurrent Lambda invocations in one container
+                    streaming (bool) - Use stream_answer and record time to first token
+                    semantic_cache (bool) - Leave the semantic answer cache on, repeated queries then measure cache hits
+                    batch (bool) - Send the whole workload as one batch_main request'''
+
+        query_main = self.load_main('query_main', 'query_generation_function')
+        recorder = StageRecorder()
+        errors = []
+
+        patches = self.service_patches() + [mock.patch.object(query_main, 'VECTOR_BACKEND', self.vector_backend),
+                                            mock.patch.object(query_main, 'ENCODER_BACKEND', 'huggingface'),
+                                            mock.patch.object(query_main, 'LOCAL_INDEX_PATH', self.local_index_path),
+                                            recorder.instrument(qg.SubqueryGeneration, 'generate_subqueries', 'subqueries'),
+                                            recorder.instrument(qg.MetadataFiltering, 'years_extraction', 'years'),
+                                            recorder.instrument(qg.MetadataFiltering, 'club_extraction', 'clubs'),
+                                            recorder.instrument(qg.EntityExtraction, 'entity_matching', 'entities'),
+                                            recorder.instrument(qg.SemanticCache, 'lookup', 'cache_lookup'),
+                                            recorder.instrument(qg.QueryEncoding, 'batch_encoding', 'encoding'),
+                                            recorder.instrument(qg.VectorRetrieval, 'build_context_list', 'retrieval'),
+                                            recorder.instrument(qg.ContextAssembly, 'assemble_context', 'context_assembly'),
+                                            recorder.instrument(qg.GenerateFinalAnswer, 'generate_answer', 'final_answer'),
+                                            recorder.instrument(qg.BatchQuery, 'generate_subqueries', 'batch_subqueries'),
+                                            recorder.instrument(qg.BatchQuery, 'extract_metadata', 'batch_extraction'),
+                                            recorder.instrument(qg.BatchQuery, 'batch_encoding', 'batch_encoding'),
+                                            recorder.instrument(qg.BatchQuery, 'retrieve_context', 'batch_retrieval'),
+                                            recorder.instrument(qg.BatchQuery, 'generate_answers', 'batch_generation')]
+
+        def run_query(user_query):
+            event = {'user_query': user_query, 'semantic_cache': semantic_cache, 'tracing': False}
+            start = time.perf_counter()
+
+            try:
+                if streaming:
+                    first_token = None
+
+                    for text in query_main.stream_answer(event):
+                        if first_token is None:
+                            first_token = time.perf_counter() - start
+                            recorder.record('time_to_first_token', first_token)
+
+                else:
+                    query_main.main(event, None)
+
+                recorder.record('query_total', time.perf_counter() - start)
+
+            except Exception as e:
+                recorder.record('query_total', time.perf_counter() - start, failed=True)
+                errors.append('{}: {}'.format(type(e).__name__, e))
+
+        workload = [query for _ in range(iterations) for query in queries]
+
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        def run_batch():
+            start = time.perf_counter()
+            results = json.loads(query_main.batch_main({'user_queries': workload, 'tracing': False}, None)['body'])
+            recorder.record('batch_total', time.perf_counter() - start)
+            errors.extend(result['error'] for result in results if 'error' in result)
+
+        with ExitPatches(patches):
+            if batch:
+                run_batch()
+
+            else:
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    list(executor.map(run_query, workload))
+
+        wall_seconds = time.perf_counter() - start
+        memory = self.memory_usage()
+        tracemalloc.stop()
+
+        return {'wall_seconds': round(wall_seconds, 3),
+                'queries': len(workload),
+                'failed_queries': len(errors),
+                'errors': sorted(set(errors))[:10],
+                'queries_per_second': round(len(workload) / wall_seconds, 3),
+                'memory': memory,
+                'stages': recorder.results()}
+
+
+    def service_calls(self):
+        return {name: profile.summary() for name, profile in self.profiles.items() if name != 'sentence_transformers'}
+
+
+class ExitPatches:
+
+    def __init__(self, patches):
+        self.patches = patches
+
+    def __enter__(self):
+        for patch in self.patches:
+            patch.start()
+
+    def __exit__(self, *exc_info):
+        for patch in reversed(self.patches):
+            patch.stop()
+
+
+def compare(results, baseline):
+    '''Returns the ratio of each stage's p50 and p95 latency to a previous run, above 1 is slower
+        Params: results (dict) - Results of this run
+                baseline (dict) - Results of a previous run'''
+
+    comparison = {}
+
+    for phase in ('ingest', 'query'):
+        for stage, stats in results.get(phase, {}).get('stages', {}).items():
+            previous = baseline.get(phase, {}).get('stages', {}).get(stage)
+
+            if previous and previous['p50_ms'] and previous['p95_ms']:
+                comparison['{}.{}'.format(phase, stage)] = {'p50_ratio': round(stats['p50_ms'] / previous['p50_ms'], 3),
+                                                            'p95_ratio': round(stats['p95_ms'] / previous['p95_ms'], 3)}
+
+    return comparison
+
+
+def document_subset(data_directory, max_documents=None):
+    '''Returns a directory linking the first max_documents PDFs of data_directory in the same <year>/<file>.pdf layout,
+        or data_directory itself when there is no limit
+        Params: data_directory (str) - Directory of PDFs
+                max_documents (int) - PDFs to keep'''
+
+    if not max_documents:
+        return data_directory
+
+    subset = tempfile.mkdtemp(prefix='benchmark_data_')
+    keys = [key for key in fakes.FakeS3Client(fakes.LatencyProfile(), data_directory).document_keys() if key.lower().endswith('.pdf')]
+
+    for key in keys[:max_documents]:
+        os.makedirs(os.path.dirname(os.path.join(subset, key)), exist_ok=True)
+        os.symlink(os.path.join(os.path.abspath(data_directory), key), os.path.join(subset, key))
+
+    return subset
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--phases', default='ingest,query', help='Comma separated phases to run, ingest and/or query')
+    parser.add_argument('--data', default=os.path.join(REPO_ROOT, 'demo_data'), help='Directory of PDFs to ingest')
+    parser.add_argument('--profiles', help='JSON file of latency profiles merged over the defaults, e.g. {"bedrock": {"mean_ms": 900, "error_rate": 0.05}}')
+    parser.add_argument('--fast', action='store_true', help='Run one PDF and one query once at a time scale of 0.01, options given explicitly still apply')
+    parser.add_argument('--max-documents', type=int, help='Ingest only the first N PDFs under --data')
+    parser.add_argument('--max-queries', type=int, help='Run only the first N sample queries')
+    parser.add_argument('--time-scale', type=float, help='Multiplier for every simulated latency, default 1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--vector-backend', default='pinecone', choices=['pinecone', 'local'])
+    parser.add_argument('--ingest-workers', type=int, default=1, help='Shard workers for the ingest phase, more than one runs the sharded ingest')
+    parser.add_argument('--iterations', type=int, help='Times each sample query is run, default 3')
+    parser.add_argument('--concurrency', type=int, default=1, help='Queries run at once')
+    parser.add_argument('--streaming', action='store_true', help='Stream final answers and record time to first token')
+    parser.add_argument('--semantic-cache', action='store_true', help='Leave the semantic answer cache enabled')
+    parser.add_argument('--batch', action='store_true', help='Answer the query workload with one batch_main request')
+    parser.add_argument('--answer-words', type=int, default=200)
+    parser.add_argument('--output', help='File to write results to, stdout if not given')
+    parser.add_argument('--baseline', help='Results from a previous run to compare stage latencies against')
+
+    args = parser.parse_args(argv)
+
+    for name, (default, fast_default) in RUN_DEFAULTS.items():
+        if getattr(args, name) is None:
+            setattr(args, name, fast_default if args.fast else default)
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    profiles = {name: dict(profile) for name, profile in DEFAULT_PROFILES.items()}
+
+    if args.profiles:
+        with open(args.profiles) as f:
+            for name, profile in json.load(f).items():
+                profiles.setdefault(name, {}).update(profile)
+
+    phases = args.phases.split(',')
+    benchmark = Benchmark(profiles=profiles, data_directory=document_subset(args.data, args.max_documents), time_scale=args.time_scale, seed=args.seed,
+                          vector_backend=args.vector_backend, answer_words=args.answer_words)
+
+    results = {'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+               'config': dict(vars(args), profiles=profiles)}
+
+    if 'ingest' in phases:
+        results['ingest'] = benchmark.run_ingest(workers=args.ingest_workers)
+    else:
+        benchmark.publish_entity_list()
+
+    if 'query' in phases:
+        results['query'] = benchmark.run_queries(SAMPLE_QUERIES[:args.max_queries], iterations=args.iterations, concurrency=args.concurrency,
+                                                 streaming=args.streaming, semantic_cache=args.semantic_cache, batch=args.batch)
+
+    results['service_calls'] = benchmark.service_calls()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['comparison'] = compare(results, json.load(f))
+
+    output = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The benchmark modules are imported from the benchmarks directory, the same way run_benchmark.py imports fakes
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
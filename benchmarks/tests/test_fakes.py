@@ -0,0 +1,49 @@
+import fakes
+
+
+def index():
+    index = fakes.FakePinecone(fakes.LatencyProfile(), fakes.LatencyProfile())().Index('rag-training')
+    index.upsert(vectors=[('2019-Arsenal-a', [1.0, 0.0], {'years': ['2019'], 'club': 'Arsenal'}),
+                          ('2019-Chelsea-b', [0.8, 0.2], {'years': ['2019'], 'club': 'Chelsea'})], namespace='2019')
+    index.upsert(vectors=[('2020-Arsenal-c', [0.9, 0.1], {'years': ['2020', '2021'], 'club': 'Arsenal'})], namespace='2020')
+
+    return index
+
+
+def ids(response):
+    return [match['id'] for match in response['matches']]
+
+
+def test_queries_only_search_their_namespace():
+    pinecone = index()
+
+    assert ids(pinecone.query(vector=[1.0, 0.0], namespace='2019')) == ['2019-Arsenal-a', '2019-Chelsea-b']
+    assert ids(pinecone.query(vector=[1.0, 0.0], namespace='2020')) == ['2020-Arsenal-c']
+    assert ids(pinecone.query(vector=[1.0, 0.0])) == []
+    assert pinecone.describe_index_stats() == {'namespaces': {'2019': {'vector_count': 2}, '2020': {'vector_count': 1}}, 'total_vector_count': 3}
+
+
+def test_in_and_eq_filters_match_list_and_scalar_metadata():
+    pinecone = index()
+
+    assert ids(pinecone.query(vector=[1.0, 0.0], namespace='2020', filter={'years': {'$in': ['2021']}})) == ['2020-Arsenal-c']
+    assert ids(pinecone.query(vector=[1.0, 0.0], namespace='2020', filter={'years': {'$in': ['2019']}})) == []
+    assert ids(pinecone.query(vector=[1.0, 0.0], namespace='2019', filter={'club': {'$eq': 'Chelsea'}})) == ['2019-Chelsea-b']
+    assert ids(pinecone.query(vector=[1.0, 0.0], namespace='2019', filter={'club': 'Arsenal', 'years': {'$in': ['2019', '2020']}})) == ['2019-Arsenal-a']
+
+
+def test_matches_are_ranked_by_similarity_and_limited_to_top_k():
+    response = index().query(vector=[0.0, 1.0], namespace='2019', top_k=1, include_metadata=False)
+
+    assert response['matches'] == [{'id': '2019-Chelsea-b', 'score': response['matches'][0]['score']}]
+
+
+def test_deletes_and_updates_apply_to_one_namespace():
+    pinecone = index()
+    pinecone.upsert(vectors=[('2019-Arsenal-a', [1.0, 0.0], {'years': ['2019'], 'club': 'Arsenal'})], async_req=True).result()
+
+    pinecone.update(id='2019-Arsenal-a', set_metadata={'club': 'Arsenal F.C.'}, namespace='2019')
+    pinecone.delete(ids=['2019-Arsenal-a'])
+
+    assert pinecone.query(vector=[1.0, 0.0], namespace='2019', filter={'club': 'Arsenal F.C.'})['matches'][0]['id'] == '2019-Arsenal-a'
+    assert ids(pinecone.query(vector=[1.0, 0.0])) == []
@@ -0,0 +1,31 @@
+import json
+import os
+import subprocess
+import sys
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run_benchmark.py')
+
+
+def test_fast_run_writes_percentiles_throughput_memory_and_baseline_ratios(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'ingest': {'stages': {'upsert': {'p50_ms': 1.0, 'p95_ms': 1.0}}},
+                                    'query': {'stages': {'query_total': {'p50_ms': 1.0, 'p95_ms': 1.0}}}}))
+    output = tmp_path / 'results.json'
+
+    subprocess.run([sys.executable, SCRIPT, '--fast', '--output', str(output), '--baseline', str(baseline)], check=True, timeout=300)
+    results = json.loads(output.read_text())
+
+    assert results['config']['max_documents'] == results['config']['max_queries'] == results['config']['iterations'] == 1
+    assert results['ingest']['documents'] == 1 and results['ingest']['chunks'] > 0 and results['ingest']['chunks_per_second'] > 0
+    assert results['query']['queries'] == 1 and results['query']['failed_queries'] == 0 and results['query']['queries_per_second'] > 0
+
+    for phase in ('ingest', 'query'):
+        assert results[phase]['memory']['peak_traced_mb'] > 0 and results[phase]['memory']['max_rss_mb'] > 0
+
+        for stats in results[phase]['stages'].values():
+            assert stats['count'] > 0 and 0 <= stats['p50_ms'] <= stats['p95_ms'] <= stats['p99_ms'] <= stats['max_ms']
+
+    assert set(results['comparison']) == {'ingest.upsert', 'query.query_total'}
+    assert all(ratios['p50_ratio'] > 0 and ratios['p95_ratio'] > 0 for ratios in results['comparison'].values())
+    assert results['service_calls']['bedrock']['calls'] > 0
@@ -61,6 +61,7 @@ resource "aws_iam_policy" "ecs_task_policy" {
         Action = [
           "s3:GetObject",
           "s3:PutObject",
+          "s3:DeleteObject",
           "s3:ListBucket"
         ]
         Resource = [
@@ -117,6 +118,10 @@ resource "aws_ecs_task_definition" "fargate_task" {
         {
           name  = "AWS_SECRET_API_KEY"
           value = aws_secretsmanager_secret.api_key.secret_string
+        },
+        {
+          name  = "INGEST_SHARDING"
+          value = var.worker_count > 1 ? "ecs" : "off"
         }
       ]
 
@@ -137,7 +142,7 @@ resource "aws_ecs_service" "fargate_service" {
   name            = var.ecs_service_name
   cluster         = aws_ecs_cluster.fargate_cluster.id
   task_definition = aws_ecs_task_definition.fargate_task.arn
-  desired_count   = 1
+  desired_count   = var.worker_count
   launch_type     = "FARGATE"
 
   network_configuration {
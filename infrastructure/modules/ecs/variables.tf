@@ -59,6 +59,13 @@ variable "cpu" {
   default     = 256
 }
 
+# Number of ingest workers, more than one shards the ingest across tasks
+variable "worker_count" {
+  description = "Number of ingest tasks, each claims shards of the document list when greater than 1"
+  type        = number
+  default     = 1
+}
+
 # Log Group
 variable "log_group" {
   description = "Log group for ECS logs"
@@ -63,6 +63,7 @@ resource "aws_iam_role_policy" "bedrock_policy" {
       {
         Action = [
           "bedrock:InvokeModel",
+          "bedrock:InvokeModelWithResponseStream",
         ]
         Effect   = "Allow"
         Resource = ["arn:aws:bedrock:eu-west-2::foundation-model/anthropic.claude-3-haiku-20240307-v1:0", "arn:aws:bedrock:eu-west-2::foundation-model/anthropic.claude-3-sonnet-20240229-v1:0"]
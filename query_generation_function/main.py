@@ -2,51 +2,299 @@ import json
 import query_generation.query_generation as qg
 
 
-def main(event, context):
-  '''Main function for generating RAG answer'''
+CONCURRENT_STAGES = True # Run subquery generation, metadata and entity extraction together
+STAGE_TIMEOUT = 20 # Seconds allowed for each query stage before falling back
+RETRIEVAL_WORKERS = 8 # Maximum Pinecone queries in flight at once
+RETRIEVAL_TIMEOUT = 10 # Seconds allowed for each Pinecone query
+SECRET_TTL = 3600 # Seconds secrets are cached between warm invocations
+LOOKUP_TTL = 300 # Seconds between ETag checks of the cached entity list
+HF_API_URL = 'https://api-inference.huggingface.co/models/BAAI/bge-small-en-v1.5'
+ENCODER_BACKEND = 'huggingface' # huggingface (batched remote call) or local (in process bge-small-en-v1.5, build the image with --build-arg ENCODER_BACKEND=local)
+VECTOR_BACKEND = 'pinecone' # pinecone, or local for the in process index at LOCAL_INDEX_PATH
+LOCAL_INDEX_PATH = 'local_index' # Directory holding vectors.npy and metadata.json written by the ingest pipeline
+VECTOR_METADATA = False # Return match metadata from Pinecone, only needed for an index ingested before the document store
+DOCUMENT_CACHE = 20000 # Chunk texts from the document store kept in memory between warm invocations
+PARTITIONED_BY_SEASON = True # Index has a namespace per season, so year filtered queries only search those seasons
+DEFAULT_NAMESPACE_COPY = False # Must match the ingest setting, without the copy unfiltered queries search every season namespace (one query per season instead of one)
+METADATA_CONFIDENCE = 0.75 # Rule based year and club extraction below this confidence falls back to the LLM
+ENTITY_LLM_FALLBACK = True # Ask the LLM for entities only when the local matcher finds none
+CONTEXT_TOKEN_BUDGET = 6000 # Estimated tokens of retrieved context passed to the final answer model
+SEMANTIC_CACHE = True # Return cached answers for repeated or near identical queries
+CACHE_BACKEND = 'memory' # memory (per container), or disk for a directory at CACHE_PATH shared between containers (e.g. EFS)
+CACHE_PATH = '/mnt/answer_cache'
+CACHE_MAX_ENTRIES = 1000
+CACHE_SIMILARITY = 0.95 # Minimum cosine similarity between query embeddings for a cache hit on a query naming the same years and clubs
+CACHE_TTL = 86400 # Seconds a cached answer stays valid
+ANSWER_MODEL = 'anthropic.claude-3-sonnet-20240229-v1:0'
+TRACING = True # Emit per stage latency, token and chunk metrics as a CloudWatch EMF log line for each request
+TRACE_SPANS = False # Also include every timing span in the log line as a per request trace
+METRICS_NAMESPACE = 'RagQuery'
+ROUTING = True # Route simple queries to direct or filtered retrieval, skipping decomposition and unused retrievals
+BATCH_QUERIES_PER_PROMPT = 10 # Queries decomposed by each Bedrock prompt in batch_main
+BATCH_WORKERS = 8 # Concurrent Bedrock requests for batch decomposition and extraction
+BATCH_GENERATION_WORKERS = 8 # Concurrent final answer generations in batch_main
+
+
+def create_vector_store(pinecone_api):
+  '''Returns the configured vector store, the local index is loaded once per container'''
+
+  if VECTOR_BACKEND == 'local':
+    vector_store = qg.ResourceCache.get(('local_vector_store', LOCAL_INDEX_PATH))
+
+    if vector_store is None:
+      vector_store = qg.LocalVectorStore(index_path=LOCAL_INDEX_PATH)
+      qg.ResourceCache.put(('local_vector_store', LOCAL_INDEX_PATH), vector_store)
+
+    return vector_store
+
+  return qg.PineconeVectorStore(pinecone_api=pinecone_api, pinecone_index='rag-training-index', max_workers=RETRIEVAL_WORKERS, query_timeout=RETRIEVAL_TIMEOUT,
+                                include_metadata=VECTOR_METADATA, season_namespaces_only=PARTITIONED_BY_SEASON and not DEFAULT_NAMESPACE_COPY)
+
+
+def create_document_store():
+  '''Returns the store chunk text is fetched from after fusion, kept for the container so fetched text is reused'''
+
+  key = ('document_store', VECTOR_BACKEND)
+  document_store = qg.ResourceCache.get(key)
+
+  if document_store is None:
+    if VECTOR_BACKEND == 'local':
+      document_store = qg.LocalDocumentStore(index_path=LOCAL_INDEX_PATH)
+    else:
+      document_store = qg.S3DocumentStore(bucket='rag-training-lookup', max_documents=DOCUMENT_CACHE, index_ttl=LOOKUP_TTL)
+
+    qg.ResourceCache.put(key, document_store)
+
+  return document_store
+
+
+def prepare_generation(event):
+  '''Runs the retrieval pipeline up to final answer generation, returning (generation, cache, cached_answer).
+      generation is None when the semantic cache already holds an answer'''
 
   user_query = event['user_query']
 
-  hf_token = qg.ExternalInteractions.get_secret(secret_name="hugging_face_api")
-  pinecone_api = qg.ExternalInteractions.get_secret(secret_name="pinecone_api_rag_training")
+  hf_token = qg.ExternalInteractions.get_secret(secret_name="hugging_face_api", ttl=SECRET_TTL) if ENCODER_BACKEND == 'huggingface' else None
+  pinecone_api = qg.ExternalInteractions.get_secret(secret_name="pinecone_api_rag_training", ttl=SECRET_TTL) if VECTOR_BACKEND == 'pinecone' else None
 
-  
-  # Generate Subqueries
-  subqueries = qg.SubqueryGeneration(model='anthropic.claude-3-haiku-20240307-v1:0', user_query=user_query)
-  subqueries.generate_subqueries()
-  subqueries.decomposition_json
+  encoder = qg.QueryEncoding.create_encoder(backend=ENCODER_BACKEND, hf_api_url=HF_API_URL, hf_token=hf_token)
+
+
+  #Check Semantic Answer Cache
+  cache = None
+
+  if event.get('semantic_cache', SEMANTIC_CACHE):
+    cache_store = qg.ResourceCache.get(('answer_cache', CACHE_BACKEND))
+
+    if cache_store is None:
+      cache_store = qg.DiskCacheStore(directory=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES) if CACHE_BACKEND == 'disk' else qg.InMemoryCacheStore(max_entries=CACHE_MAX_ENTRIES)
+      qg.ResourceCache.put(('answer_cache', CACHE_BACKEND), cache_store)
 
+    index_version = qg.SemanticCache.current_index_version(bucket='rag-training-lookup', key='index-version.json', ttl=LOOKUP_TTL)
+    cache = qg.SemanticCache(store=cache_store, encoder=encoder, index_version=index_version, similarity_threshold=CACHE_SIMILARITY, ttl=CACHE_TTL,
+                             scope_confidence=METADATA_CONFIDENCE)
+    cached_answer = cache.lookup(user_query)
+    qg.Tracer.metric('CacheHit', int(cached_answer is not None))
+
+    if cached_answer is not None:
+      return None, cache, cached_answer
+
+
+  #Choose Pipeline Plan - direct, filtered or decomposition
+  router = qg.QueryRouter(user_query=user_query, encoder=encoder, query_vector=cache.query_vector if cache is not None else None)
+
+  if event.get('routing', ROUTING):
+    router.route(confidence_threshold=METADATA_CONFIDENCE)
+  else:
+    router.plan = 'decomposition'
 
-  #Extract Metadata
-  metadata = qg.MetadataFiltering(user_query=user_query)
-  metadata.years_extraction(model='anthropic.claude-3-haiku-20240307-v1:0')
-  metadata.club_extraction(model='anthropic.claude-3-haiku-20240307-v1:0')
   
+  # Generate Subqueries, Extract Metadata and Extract Entities - independent stages run together
+
+  def subquery_stage():
+    subqueries = qg.SubqueryGeneration(model='anthropic.claude-3-haiku-20240307-v1:0', user_query=user_query)
+    subqueries.generate_subqueries()
+    return subqueries.decomposition_json
+
+  def years_stage():
+    years = qg.MetadataFiltering(user_query=user_query)
+    years.years_extraction(model='anthropic.claude-3-haiku-20240307-v1:0', confidence_threshold=METADATA_CONFIDENCE)
+    return years.years
+
+  def clubs_stage():
+    clubs = qg.MetadataFiltering(user_query=user_query)
+    clubs.club_extraction(model='anthropic.claude-3-haiku-20240307-v1:0', confidence_threshold=METADATA_CONFIDENCE)
+    return clubs.clubs
+
+  def entities_stage():
+    entities = qg.EntityExtraction(entity_list_bucket='rag-training-lookup', entity_list_key='entity-list.json', user_query=user_query)
+    entities.retrieve_lookup_list(ttl=LOOKUP_TTL)
+    entities.entity_matching(model='anthropic.claude-3-haiku-20240307-v1:0' if ENTITY_LLM_FALLBACK and router.plan != 'direct' else None)
+    return entities.query_entities
+
+  # Entity matching is local so it runs on every plan, the direct plan only skips its LLM fallback
+  plan_stages = []
+
+  if router.plan == 'decomposition':
+    plan_stages.append(('subqueries', subquery_stage, STAGE_TIMEOUT, True))
+
+  if router.plan != 'direct':
+    plan_stages.extend([('years', years_stage, STAGE_TIMEOUT, False),
+                        ('clubs', clubs_stage, STAGE_TIMEOUT, False)])
 
-  #Extract Entities
-  entities = qg.EntityExtraction(entity_list_bucket='rag-training-lookup', entity_list_key='entity-list.json', user_query=user_query)
-  entities.retrieve_lookup_list()
-  entities.entity_extraction(model='anthropic.claude-3-haiku-20240307-v1:0')
+  plan_stages.append(('entities', entities_stage, STAGE_TIMEOUT, False))
+
+  stages = qg.StageRunner(max_workers=4)
+  stages.run_stages(plan_stages, concurrent=event.get('concurrent_stages', CONCURRENT_STAGES))
+  results = dict({'subqueries': {}, 'years': None, 'clubs': None, 'entities': None}, **stages.results)
   
 
   #Encode Query and Subqueries
-  encoding = qg.QueryEncoding(decomposition_json=subqueries.decomposition_json, hf_api_url= 'https://api-inference.huggingface.co/models/BAAI/bge-small-en-v1.5', hf_token=hf_token, user_query=user_query)
-  encoding.original_query_encoding()
-  encoding.subquery_encoding()
+  encoding = qg.QueryEncoding(decomposition_json=results['subqueries'], hf_api_url=HF_API_URL, hf_token=hf_token, user_query=user_query, encoder=encoder)
+  encoding.user_query_vector = router.query_vector
+  encoding.batch_encoding()
   
 
   #Retrieve Matched Vectors from Vector Database
-  retrieval = qg.VectorRetrieval(user_query_vector=encoding.user_query_vector, decomposition_vector_list=encoding.decomposition_vector_list, years=metadata.years, clubs=metadata.clubs, entity_list=entities.query_entities, pinecone_api=pinecone_api, pinecone_index='rag-training-index')
+  vector_store = create_vector_store(pinecone_api)
+
+  retrieval = qg.VectorRetrieval(user_query_vector=encoding.user_query_vector, decomposition_vector_list=encoding.decomposition_vector_list, years=results['years'], clubs=results['clubs'], entity_list=results['entities'], vector_store=vector_store, partitioned_by_season=PARTITIONED_BY_SEASON)
   retrieval.build_context_list()
   
 
+  #Deduplicate, Fuse and Budget Retrieved Context
+  context = qg.ContextAssembly(query_responses=retrieval.query_responses, token_budget=CONTEXT_TOKEN_BUDGET, document_store=create_document_store())
+  context.assemble_context()
+
+
+  generation = qg.GenerateFinalAnswer(user_query=user_query, context_list=context.context_list)
+
+  return generation, cache, None
+
+
+def start_tracing(event, context):
+  '''Starts request tracing unless it is switched off, either here or per request with a tracing field in the event'''
+
+  if event.get('tracing', TRACING):
+    qg.Tracer.start(namespace=METRICS_NAMESPACE, request_id=getattr(context, 'aws_request_id', None), trace=event.get('trace_spans', TRACE_SPANS))
+
+
+def main(event, context):
+  '''Main function for generating RAG answer'''
+
+  start_tracing(event, context)
+
+  try:
+    return answer_request(event)
+
+  finally:
+    qg.Tracer.finish()
+
+
+def answer_request(event):
+  '''Generates the RAG answer for a single request'''
+
+  generation, cache, cached_answer = prepare_generation(event)
+
+  if cached_answer is not None:
+    return{
+      'statusCode': 200,
+      'body': json.dumps(cached_answer)
+    }
+
+
   #Generate Final Answer
-  generation = qg.GenerateFinalAnswer(user_query=user_query, context_list=retrieval.context_list)
-  generation.generate_answer(model='anthropic.claude-3-sonnet-20240229-v1:0')
+  generation.generate_answer(model=ANSWER_MODEL)
+
+  if cache is not None:
+    cache.save(event['user_query'], generation.answer)
 
 
   return{
     'statusCode': 200,
     'body': json.dumps(generation.answer)
   }
-  
+
+
+def stream_answer(event, context=None):
+  '''Generator yielding the RAG answer as it is generated, a cached answer is yielded in one piece'''
+
+  start_tracing(event, context)
+
+  try:
+    generation, cache, cached_answer = prepare_generation(event)
+
+    if cached_answer is not None:
+      yield cached_answer
+      return
+
+    for text in generation.stream_answer(model=ANSWER_MODEL):
+      yield text
+
+    if cache is not None:
+      cache.save(event['user_query'], generation.answer)
+
+  finally:
+    qg.Tracer.finish()
+
+
+def stream_main(event, context, response_stream=None):
+  '''Streaming handler for generating RAG answer. With a response_stream (any object with write and close, e.g. from a
+      function URL in RESPONSE_STREAM mode behind a streaming capable runtime) answer text is written as it arrives,
+      otherwise the streamed answer is collected and returned in the same shape as main'''
+
+  if response_stream is None:
+    return{
+      'statusCode': 200,
+      'body': json.dumps(''.join(stream_answer(event, context)))
+    }
+
+  try:
+    for text in stream_answer(event, context):
+      response_stream.write(text.encode('utf-8'))
+
+  finally:
+    response_stream.close()
+
+
+def batch_main(event, context):
+  '''Batch function for generating RAG answers to a list of queries in event['user_queries']. Prompts, encoder calls and
+      retrieval requests are shared across the batch, results are returned in input order with an error for any query that failed'''
+
+  start_tracing(event, context)
+
+  try:
+    user_queries = event['user_queries']
+
+    hf_token = qg.ExternalInteractions.get_secret(secret_name="hugging_face_api", ttl=SECRET_TTL) if ENCODER_BACKEND == 'huggingface' else None
+    pinecone_api = qg.ExternalInteractions.get_secret(secret_name="pinecone_api_rag_training", ttl=SECRET_TTL) if VECTOR_BACKEND == 'pinecone' else None
+
+    encoder = qg.QueryEncoding.create_encoder(backend=ENCODER_BACKEND, hf_api_url=HF_API_URL, hf_token=hf_token)
+
+    batch = qg.BatchQuery(user_queries=user_queries, encoder=encoder, vector_store=create_vector_store(pinecone_api), entity_list_bucket='rag-training-lookup',
+                          entity_list_key='entity-list.json', partitioned_by_season=PARTITIONED_BY_SEASON, max_workers=BATCH_WORKERS,
+                          document_store=create_document_store())
+
+
+    # Generate Subqueries, Extract Metadata and Extract Entities for every query
+    batch.retrieve_lookup_list(ttl=LOOKUP_TTL)
+    batch.generate_subqueries(model='anthropic.claude-3-haiku-20240307-v1:0', queries_per_prompt=BATCH_QUERIES_PER_PROMPT)
+    batch.extract_metadata(model='anthropic.claude-3-haiku-20240307-v1:0', confidence_threshold=METADATA_CONFIDENCE,
+                           entity_model='anthropic.claude-3-haiku-20240307-v1:0' if ENTITY_LLM_FALLBACK else None)
+
+
+    #Encode Queries and Subqueries, Retrieve and Assemble Context
+    batch.batch_encoding()
+    batch.retrieve_context(token_budget=CONTEXT_TOKEN_BUDGET)
+
+
+    #Generate Final Answers
+    batch.generate_answers(model=ANSWER_MODEL, max_workers=BATCH_GENERATION_WORKERS)
+
+    return{
+      'statusCode': 200,
+      'body': json.dumps(batch.results())
+    }
+
+  finally:
+    qg.Tracer.finish()
@@ -1,21 +1,272 @@
+from abc import ABC, abstractmethod
 from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
 from pinecone.grpc import PineconeGRPC as Pinecone
 
+import asyncio
 import boto3
+import datetime
+import functools
+import hashlib
 import json
 import logging
+import numpy as np
+import os
+import re
 import requests
+import threading
+import time
+import unicodedata
+
+
+class ResourceCache:
+    '''Process level cache for clients, secrets and lookup artifacts. Lambda keeps module state between warm invocations,
+    so anything held here is only created once per container'''
+
+    entries = {}
+    lock = threading.Lock()
+
+
+    @staticmethod
+    def get(key, ttl=None):
+        '''Returns a cached value, or None if it is missing or older than ttl
+            Params: key (tuple) - Cache key
+                    ttl (float) - Maximum age in seconds, None never expires'''
+
+        with ResourceCache.lock:
+            entry = ResourceCache.entries.get(key)
+
+        if entry is None:
+            return None
+
+        if ttl is not None and time.monotonic() - entry['stored'] > ttl:
+            return None
+
+        return entry['value']
+
+
+    @staticmethod
+    def put(key, value, **extra):
+        '''Stores a value in the cache along with any extra fields (e.g. an ETag)
+            Params: key (tuple) - Cache key
+                    value - Value to cache'''
+
+        with ResourceCache.lock:
+            ResourceCache.entries[key] = dict(extra, value=value, stored=time.monotonic())
+
+
+    @staticmethod
+    def client(service_name, region_name=None):
+        '''Returns a shared boto3 client, boto3 clients are thread safe once created
+            Params: service_name (str) - AWS service name e.g. bedrock-runtime
+                    region_name (str) - AWS region, defaults to the environment region'''
+
+        key = ('client', service_name, region_name)
+
+        with ResourceCache.lock:
+            if key not in ResourceCache.entries:
+                ResourceCache.entries[key] = {'value': boto3.client(service_name, region_name=region_name), 'stored': time.monotonic()}
+
+            return ResourceCache.entries[key]['value']
+
+
+    @staticmethod
+    def s3_json(bucket, key, ttl=300):
+        '''Loads a JSON object from S3 and keeps it in memory. Within ttl seconds the cached copy is returned without any S3 call,
+            after that the object's ETag is checked and the body only downloaded and parsed again if it has changed
+            Params: bucket (str) - S3 bucket name
+                    key (str) - S3 object key
+                    ttl (float) - Seconds between ETag checks'''
+
+        cache_key = ('s3_json', bucket, key)
+
+        cached = ResourceCache.get(cache_key, ttl)
+        if cached is not None:
+            return cached
+
+        s3 = ResourceCache.client('s3')
+
+        with ResourceCache.lock:
+            entry = ResourceCache.entries.get(cache_key)
+
+        if entry is not None:
+            head = s3.head_object(Bucket=bucket, Key=key)
+
+            if head['ETag'] == entry['etag']:
+                ResourceCache.put(cache_key, entry['value'], etag=entry['etag'])
+                return entry['value']
+
+        s3_object = s3.get_object(Bucket=bucket, Key=key)
+        value = json.loads(s3_object['Body'].read())
+
+        ResourceCache.put(cache_key, value, etag=s3_object['ETag'])
+        logging.info("Loaded {}/{} into resource cache".format(bucket, key))
+
+        return value
+
+
+
+
+class Tracer:
+    '''Per request timing spans and metrics, emitted as a CloudWatch embedded metric format (EMF) JSON line when the
+    request finishes. Lambda runs one request per container at a time, so the active tracer is held at class level.
+    With no active tracer every traced call and metric is a single attribute check'''
+
+    active = None
+
+    def __init__(self, namespace='RagQuery', service='query-generation', request_id=None, trace=False):
+        '''Params: namespace (str) - CloudWatch metric namespace
+                    service (str) - Value of the Service dimension
+                    request_id (str) - Request id added to the log line
+                    trace (bool) - Include every span in the log line as a per request trace'''
+
+        self.namespace = namespace
+        self.service = service
+        self.request_id = request_id
+        self.trace = trace
+        self.metrics = {}
+        self.spans = []
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+
+    @staticmethod
+    def start(**kwargs):
+        '''Starts tracing a request, taking the same arguments as Tracer'''
+
+        Tracer.active = Tracer(**kwargs)
+
+        return Tracer.active
+
+
+    @staticmethod
+    def finish():
+        '''Emits the active tracer's metrics and stops tracing'''
+
+        tracer, Tracer.active = Tracer.active, None
+
+        if tracer is not None:
+            tracer.record('RequestLatency', round((time.perf_counter() - tracer.started) * 1000, 3), 'Milliseconds')
+            print(tracer.emf_line())
+
+
+    @staticmethod
+    def metric(name, value, unit='Count'):
+        '''Records a metric value on the active tracer, repeated values are kept and emitted as a list
+            Params: name (str) - Metric name
+                    value (float) - Metric value
+                    unit (str) - CloudWatch unit'''
+
+        tracer = Tracer.active
+
+        if tracer is not None:
+            tracer.record(name, value, unit)
+
+
+    @staticmethod
+    def usage(usage):
+        '''Records Bedrock token counts from the usage field of a converse response
+            Params: usage (dict) - Usage with inputTokens and outputTokens'''
+
+        if Tracer.active is not None and usage:
+            Tracer.active.record('InputTokens', usage.get('inputTokens', 0), 'Count')
+            Tracer.active.record('OutputTokens', usage.get('outputTokens', 0), 'Count')
+
+
+    def record(self, name, value, unit):
+        with self.lock:
+            self.metrics.setdefault(name, (unit, []))[1].append(value)
+
+
+    def add_span(self, name, start, end, error):
+        '''Records a finished span as a latency metric and, when tracing, in the request trace
+            Params: name (str) - Span name
+                    start (float) - perf_counter at the start of the span
+                    end (float) - perf_counter at the end of the span
+                    error (bool) - The span raised an exception'''
+
+        self.record('{}Latency'.format(name), round((end - start) * 1000, 3), 'Milliseconds')
+
+        if error:
+            self.record('{}Errors'.format(name), 1, 'Count')
+
+        if self.trace:
+            with self.lock:
+                self.spans.append({'name': name,
+                                   'start_ms': round((start - self.started) * 1000, 3),
+                                   'duration_ms': round((end - start) * 1000, 3),
+                                   'thread': threading.current_thread().name,
+                                   'error': error})
+
+
+    def emf_line(self):
+        '''Returns the request's metrics as a CloudWatch EMF JSON line'''
+
+        with self.lock:
+            metrics = {name: (unit, list(values)) for name, (unit, values) in self.metrics.items()}
+            spans = sorted(self.spans, key=lambda x: x['start_ms'])
+
+        line = {'_aws': {'Timestamp': int(time.time() * 1000),
+                         'CloudWatchMetrics': [{'Namespace': self.namespace,
+                                                'Dimensions': [['Service']],
+                                                'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in metrics.items()]}]},
+                'Service': self.service}
+
+        for name, (unit, values) in metrics.items():
+            line[name] = values[0] if len(values) == 1 else values
+
+        if self.request_id is not None:
+            line['RequestId'] = self.request_id
+
+        if self.trace:
+            line['Trace'] = spans
+
+        return json.dumps(line)
+
+
+def traced(name):
+    '''Decorator recording each call as a span on the active tracer, calls are passed straight through when tracing is off
+        Params: name (str) - Span name'''
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = Tracer.active
+
+            if tracer is None:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            error = True
+
+            try:
+                result = function(*args, **kwargs)
+                error = False
+                return result
+
+            finally:
+                tracer.add_span(name, start, time.perf_counter(), error)
+
+        return wrapper
+
+    return decorator
+
+
 
 
 class ExternalInteractions:
 
     @staticmethod
+    @traced('Bedrock')
     def bedrock_interaction(model, prompt):
             '''Interacts with AWS bedrock using the converse method in boto3
                 Params: model (str) - Model ID for model in AWS Bedrock
                         prompt (str) - Prompt to send the model'''
             
-            bedrock = boto3.client('bedrock-runtime')
+            bedrock = ResourceCache.client('bedrock-runtime')
             
             try:
                 response = bedrock.converse(modelId= model,
@@ -30,6 +281,9 @@ class ExternalInteractions:
                 
                 bedrock_response = response['output']['message']['content'][0]['text']
 
+                Tracer.metric('PromptCharacters', len(prompt))
+                Tracer.usage(response.get('usage'))
+
                 return bedrock_response
 
             except:
@@ -38,44 +292,130 @@ class ExternalInteractions:
 
 
     @staticmethod
-    def huggingface_query(payload, hf_api_url, hf_token):
-        '''Passes a string to the given hugging face API and returns response as JSON
+    def bedrock_stream(model, prompt):
+        '''Interacts with AWS bedrock using the converse_stream method in boto3, yielding text as the model generates it
+            Params: model (str) - Model ID for model in AWS Bedrock
+                    prompt (str) - Prompt to send the model'''
+
+        bedrock = ResourceCache.client('bedrock-runtime')
+        tracer = Tracer.active
+        start = time.perf_counter()
+        first_text = True
+        error = True
+
+        try:
+            response = bedrock.converse_stream(modelId= model,
+                                               messages= [{
+                                                   'role': 'user',
+                                                   'content': [
+                                                       {
+                                                           'text': prompt
+                                                           }
+                                                           ]
+                                                       }])
+
+            for event in response['stream']:
+                if 'contentBlockDelta' in event:
+                    text = event['contentBlockDelta']['delta'].get('text')
+
+                    if text:
+                        if first_text and tracer is not None:
+                            tracer.record('TimeToFirstToken', round((time.perf_counter() - start) * 1000, 3), 'Milliseconds')
+                            first_text = False
+
+                        yield text
+
+                elif 'metadata' in event:
+                    Tracer.usage(event['metadata'].get('usage'))
+
+            Tracer.metric('PromptCharacters', len(prompt))
+            error = False
+
+        except:
+            logging.error('Unable to stream response from bedrock')
+            raise
+
+        finally:
+            if tracer is not None:
+                tracer.add_span('BedrockStream', start, time.perf_counter(), error)
+
+
+    @staticmethod
+    @traced('HuggingFace')
+    def huggingface_query(payload, hf_api_url, hf_token, session=None):
+        '''Passes a string, or list of strings, to the given hugging face API and returns response as JSON
         Params: payload (str)- Query to pass to hugging face model
                 hf_api_url (str)- API endpoint for hugging face model
-                hf_token (str)- API key for hugging face access'''
+                hf_token (str)- API key for hugging face access
+                session (requests.Session)- Session to reuse the connection, a one off request is made if not given'''
         
         headers = {"Authorization": "Bearer {}".format(hf_token)}
-        response = requests.post(hf_api_url, headers=headers, json=payload)
+        response = (session or requests).post(hf_api_url, headers=headers, json=payload)
         return response.json()
 
 
     @staticmethod
-    def pinecone_query(query_vector, query_filter, pinecone_api, pinecone_index):
-                    
-        pc = Pinecone(api_key=pinecone_api)
-        index = pc.Index(pinecone_index)
+    def pinecone_index(pinecone_api, pinecone_index):
+        '''Returns a Pinecone index handle, the handle is cached so queries share the same gRPC channel across invocations
+        Params: pinecone_api (str)- API key for Pinecone
+                pinecone_index (str)- Name of the Pinecone index'''
+
+        key = ('pinecone_index', pinecone_api, pinecone_index)
+
+        index = ResourceCache.get(key)
+
+        if index is None:
+            pc = Pinecone(api_key=pinecone_api)
+            index = pc.Index(pinecone_index)
+            ResourceCache.put(key, index)
+
+        return index
+
+
+    @staticmethod
+    @traced('PineconeQuery')
+    def pinecone_query(query_vector, query_filter, pinecone_api, pinecone_index, index=None, timeout=None, namespace=None, top_k=30, include_metadata=True):
+        '''Queries the given Pinecone index for the top_k closest matches to a vector
+        Params: query_vector (list)- Vector to match
+                query_filter (dict)- Pinecone metadata filter
+                pinecone_api (str)- API key for Pinecone
+                pinecone_index (str)- Name of the Pinecone index
+                index (GRPCIndex)- Existing index handle to reuse, a new one is created if not given
+                timeout (float)- Deadline in seconds for the query
+                namespace (str)- Namespace to search, the default namespace if not given
+                top_k (int)- Number of matches to return
+                include_metadata (bool)- Return each match's metadata, ids and scores only when False'''
+
+        if index is None:
+            index = ExternalInteractions.pinecone_index(pinecone_api=pinecone_api, pinecone_index=pinecone_index)
 
         query_response = index.query(
             vector=query_vector,
             filter=query_filter,
-            top_k=30,
-            include_metadata=True # Include metadata in the response.
+            namespace=namespace,
+            top_k=top_k,
+            include_metadata=include_metadata,
+            timeout=timeout
         )
 
         return query_response
 
 
     @staticmethod
-    def get_secret(secret_name):
+    @traced('GetSecret')
+    def get_secret(secret_name, ttl=3600):
+        '''Returns the key held in a Secrets Manager secret, cached for ttl seconds
+        Params: secret_name (str)- Name of the secret
+                ttl (float)- Seconds to keep the secret before fetching it again'''
+
+        cached = ResourceCache.get(('secret', secret_name), ttl)
+        if cached is not None:
+            return cached
 
         region_name = "eu-west-2"
 
-        # Create a Secrets Manager client
-        session = boto3.session.Session()
-        client = session.client(
-            service_name='secretsmanager',
-            region_name=region_name
-        )
+        # Shared Secrets Manager client
+        client = ResourceCache.client('secretsmanager', region_name=region_name)
 
         try:
             get_secret_value_response = client.get_secret_value(
@@ -86,7 +426,10 @@ class ExternalInteractions:
             # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
             raise e
 
-        return json.loads(get_secret_value_response['SecretString'])['key']
+        secret = json.loads(get_secret_value_response['SecretString'])['key']
+        ResourceCache.put(('secret', secret_name), secret)
+
+        return secret
 
 
 
@@ -101,6 +444,7 @@ class SubqueryGeneration:
         self.decomposition_json = None
 
 
+    @traced('Subqueries')
     def generate_subqueries(self):
         '''Uses a LLM to break down the user query into subqueries more suitable for vector retrieval'''
 
@@ -130,14 +474,155 @@ class SubqueryGeneration:
 # Metadata Filtering
 class MetadataFiltering:
 
-    def __init__(self, user_query):
+    # Normalised alias - (club value stored at ingest, confidence)
+    club_aliases = {'arsenal': ('Arsenal', 1.0),
+                    'arsenal fc': ('Arsenal', 1.0),
+                    'gunners': ('Arsenal', 0.95),
+                    'the gunners': ('Arsenal', 1.0),
+                    'chelsea': ('Chelsea', 1.0),
+                    'chelsea fc': ('Chelsea', 1.0),
+                    'cfc': ('Chelsea', 0.9),
+                    'the blues': ('Chelsea', 0.8),
+                    'liverpool': ('Liverpool', 1.0),
+                    'liverpool fc': ('Liverpool', 1.0),
+                    'lfc': ('Liverpool', 0.9),
+                    'the reds': ('Liverpool', 0.8),
+                    'manchester united': ('Manchester_United', 1.0),
+                    'manchester utd': ('Manchester_United', 1.0),
+                    'man united': ('Manchester_United', 1.0),
+                    'man utd': ('Manchester_United', 1.0),
+                    'man u': ('Manchester_United', 0.9),
+                    'mufc': ('Manchester_United', 0.9),
+                    'red devils': ('Manchester_United', 0.95),
+                    'united': ('Manchester_United', 0.6)}
+
+    # Words suggesting a club the gazetteer doesn't recognise
+    unknown_club_cues = re.compile(r'\b(fc|afc|city|united|rovers|wanderers|athletic|hotspur|albion|town|county)\b')
+
+    season_range = re.compile(r'\b((?:19|20)\d{2})\s*(?:-|/|to)\s*((?:19|20)?\d{2})\b')
+    short_season_range = re.compile(r'\b(\d{2})\s*/\s*(\d{2})\b')
+    single_year = re.compile(r'\b((?:19|20)\d{2})\b')
+    relative_seasons = re.compile(r'\b(this|current|last|previous|past)\s+(?:(\d+|two|three|four|five)\s+)?seasons?\b')
+    year_cues = re.compile(r'\b(\d{2,4}|season|seasons|year|years|campaign)\b')
+
+    def __init__(self, user_query, today=None):
         self.user_query = user_query
+        self.today = today or datetime.date.today()
         self.years = None
         self.clubs = None
+        self.years_confidence = None
+        self.clubs_confidence = None
+
+
+    def current_season(self):
+        '''Returns the start year of the current season, seasons are taken to start in August'''
+
+        return self.today.year if self.today.month >= 8 else self.today.year - 1
+
+
+    def rule_based_years(self):
+        '''Parses season start years, the year values stored at ingest, from the query with a confidence score.
+            Handles ranges like 2019-20, 2019–20 or 2023/24, short ranges like 19/20, relative phrases like last season and
+            single years, which could be in either of two seasons'''
+
+        # Dashes of every kind are treated the same
+        text = re.sub(r'[\u2010-\u2015]', '-', self.user_query.lower())
+        years = []
+        confidence = 1.0
+
+        for start, end in self.season_range.findall(text):
+            if int(end[-2:]) == (int(start) + 1) % 100:
+                years.append(start)
+            else:
+                confidence = min(confidence, 0.5)
+
+        text = self.season_range.sub(' ', text)
+
+        for start, end in self.short_season_range.findall(text):
+            if int(end) == (int(start) + 1) % 100:
+                years.append(str(2000 + int(start)))
+                confidence = min(confidence, 0.9)
+
+        text = self.short_season_range.sub(' ', text)
+
+        for year in self.single_year.findall(text):
+            years += [str(int(year) - 1), year]
+            confidence = min(confidence, 0.8)
+
+        text = self.single_year.sub(' ', text)
+
+        counts = {'two': 2, 'three': 3, 'four': 4, 'five': 5}
+
+        for relative, count in self.relative_seasons.findall(text):
+            current = self.current_season()
+            count = int(counts.get(count, count or 1))
+
+            if relative in ('this', 'current'):
+                years.append(str(current))
+            elif count == 1 and relative in ('last', 'previous'):
+                years.append(str(current - 1))
+            else:
+                years += [str(current - n) for n in range(1, count + 1)]
 
+            confidence = min(confidence, 0.9)
 
-    def years_extraction(self, model):
-        '''Extracts any year specified in the user query'''
+        text = self.relative_seasons.sub(' ', text)
+
+        # Year-like words left over that no rule understood
+        if self.year_cues.search(text) and not years:
+            confidence = 0.3
+
+        return list(dict.fromkeys(years)), confidence
+
+
+    def rule_based_clubs(self):
+        '''Matches club names and aliases in the query to the club values stored at ingest, with a confidence score. Confidence
+            is low when the rest of the query still looks like it names a club'''
+
+        text = EntityMatcher.normalise(self.user_query)
+        clubs = []
+        confidence = 1.0
+
+        for alias in sorted(self.club_aliases, key=len, reverse=True):
+            pattern = r'\b{}\b'.format(re.escape(alias))
+
+            if re.search(pattern, text):
+                club, alias_confidence = self.club_aliases[alias]
+                clubs.append(club)
+                confidence = min(confidence, alias_confidence)
+                text = re.sub(pattern, ' ', text)
+
+        # Matched aliases have been removed, so a cue left over means a club the gazetteer missed, alongside any it found
+        if self.unknown_club_cues.search(text):
+            confidence = min(confidence, 0.5)
+
+        return list(dict.fromkeys(clubs)), confidence
+
+
+    def standardise_clubs(self, clubs):
+        '''Maps a comma separated list of clubs from the LLM to the club values stored at ingest
+            Params: clubs (str) - LLM output'''
+
+        if clubs is None or clubs.strip() == 'None':
+            return None
+
+        standardised = [self.club_aliases.get(EntityMatcher.normalise(club), (club.strip(), None))[0] for club in clubs.split(',')]
+
+        return ', '.join(dict.fromkeys(standardised))
+
+
+    @traced('Years')
+    def years_extraction(self, model=None, confidence_threshold=0.75):
+        '''Extracts any year specified in the user query, using the rule based parser and only calling the LLM when its
+            confidence is below the threshold
+            Params: model (str) - Model ID for the LLM fallback, None to always use the rules
+                    confidence_threshold (float) - Minimum rule confidence to skip the LLM'''
+
+        years, self.years_confidence = self.rule_based_years()
+
+        if self.years_confidence >= confidence_threshold or model is None:
+            self.years = ', '.join(years) if years else None
+            return
 
         try:
             year_prompt = """Extract the year from this question:
@@ -147,14 +632,27 @@ class MetadataFiltering:
             Output should only be years as a comma separated list. If no year found, output None""".format(self.user_query)
 
             self.years = ExternalInteractions.bedrock_interaction(model=model, prompt=year_prompt)
+
+            if self.years.strip() == 'None':
+                self.years = None
         
         except:
             logging.warning("Unable to extract years from question")
             self.years = None
 
 
-    def club_extraction(self, model):
-        '''Extracts any club specified in the user query'''
+    @traced('Clubs')
+    def club_extraction(self, model=None, confidence_threshold=0.75):
+        '''Extracts any club specified in the user query, using the club gazetteer and only calling the LLM when its
+            confidence is below the threshold
+            Params: model (str) - Model ID for the LLM fallback, None to always use the gazetteer
+                    confidence_threshold (float) - Minimum gazetteer confidence to skip the LLM'''
+
+        clubs, self.clubs_confidence = self.rule_based_clubs()
+
+        if self.clubs_confidence >= confidence_threshold or model is None:
+            self.clubs = ', '.join(clubs) if clubs else None
+            return
 
         club_prompt =  """Extract the club from this question:
 
@@ -163,7 +661,7 @@ class MetadataFiltering:
         Output should only be clubs as a comma separated list. If no club found, output None""".format(self.user_query)
 
         try:
-            self.clubs = ExternalInteractions.bedrock_interaction(model=model, prompt=club_prompt)
+            self.clubs = self.standardise_clubs(ExternalInteractions.bedrock_interaction(model=model, prompt=club_prompt))
 
         except:
             logging.warning("Unable to extract clubs from question")
@@ -173,219 +671,1931 @@ class MetadataFiltering:
 
 
 # Entity Extraction
-class EntityExtraction:
+class EntityMatcher:
 
-    def __init__(self, entity_list_bucket, entity_list_key, user_query):
-        self.entity_list_bucket = entity_list_bucket
-        self.entity_list_key = entity_list_key
-        self.user_query = user_query
-        self.entity_list = None
-        self.query_entities = None
+    def __init__(self, entity_list, fuzzy_threshold=0.88, min_fuzzy_length=4):
+        '''Precompiled matcher over the entity list. Entities and queries are normalised for case, accents and punctuation,
+            exact matches are found in one pass with an Aho-Corasick automaton and a character trigram index backs a fuzzy fallback
+            Params: entity_list (list) - Entities from the lookup list
+                    fuzzy_threshold (float) - Minimum similarity ratio for a fuzzy match
+                    min_fuzzy_length (int) - Shortest query phrase considered for fuzzy matching'''
 
+        self.fuzzy_threshold = fuzzy_threshold
+        self.min_fuzzy_length = min_fuzzy_length
+        self.entities = {}
 
-    def retrieve_lookup_list(self):
-        '''Retrieves list of entities generated on upsert of data into vector database held in s3'''
+        for entity in entity_list:
+            normalised = self.normalise(str(entity))
 
-        try:
-            s3 = boto3.client('s3')
+            if normalised:
+                self.entities.setdefault(normalised, []).append(entity)
 
-            s3.download_file(self.entity_list_bucket, self.entity_list_key, '/tmp/{}'.format(self.entity_list_key))
+        self.max_words = max([len(i.split(' ')) for i in self.entities] or [1])
 
-            with open('/tmp/{}'.format(self.entity_list_key)) as f:
-                self.entity_list = json.load(f)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
 
-        except:
-            logging.error("Unable to retrieve entity list from {}/{}".format(self.entity_list_bucket, self.entity_list_key))
-            raise
-    
-    
-    def entity_extraction(self, model):
-        '''Extracts any entities in user queries that match the retrieved list'''
+        for pattern in self.entities:
+            self.add_pattern(pattern)
 
-        entity_prompt = """Match any entities from this question that appear in the list below:
+        self.build_failure_links()
 
-        Question - {}
+        self.trigram_index = {}
+        self.trigram_counts = {}
 
+        for pattern in self.entities:
+            pattern_trigrams = self.trigrams(pattern)
+            self.trigram_counts[pattern] = len(pattern_trigrams)
 
-        List - {}
+            for trigram in pattern_trigrams:
+                self.trigram_index.setdefault(trigram, []).append(pattern)
 
 
-        Output should only be entities as a comma separated list and no other preamble. If no entities found, output None""".format(self.user_query, self.entity_list)
+    @staticmethod
+    def normalise(text):
+        '''Lower cases text, strips accents and full stops (F.C. becomes fc) and replaces runs of other punctuation and
+            whitespace with a single space
+            Params: text (str) - Text to normalise'''
 
-        try:
-            self.query_entities = ExternalInteractions.bedrock_interaction(model=model, prompt=entity_prompt)
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join([c for c in text if not unicodedata.combining(c)]).replace('.', '')
 
-        except:
-            logging.warning("Unable to extract any entities from user query")
-            self.query_entities = None
+        return re.sub(r'[^a-z0-9]+', ' ', text.lower()).strip()
 
 
-class QueryEncoding:
+    @staticmethod
+    def trigrams(text):
+        '''Returns the set of character trigrams of a padded string
+            Params: text (str) - Normalised text'''
 
-    def __init__(self, decomposition_json, hf_api_url, hf_token, user_query):
-        self.decomposition_json = decomposition_json
-        self.user_query = user_query
-        self.hf_api_url = hf_api_url
-        self.hf_token = hf_token
-        self.user_query_vector = None
-        self.decomposition_vector_list = []
+        padded = ' {} '.format(text)
 
-    
-    def original_query_encoding(self):
-        '''Encodes the original query into an embedding/vector based on the given Hugging Face Model URL'''
+        return set(padded[i:i + 3] for i in range(len(padded) - 2))
 
-        try:
-            self.user_query_vector = ExternalInteractions.huggingface_query(payload={"inputs": self.user_query}, hf_api_url=self.hf_api_url, hf_token=self.hf_token)
-        except:
-            logging.error("Unable to encode original query")
-            raise
-    
 
-    def subquery_encoding(self):
-        '''Encodes the subqueries into an embedding/vector based on the given Hugging Face Model URL'''
+    def add_pattern(self, pattern):
+        '''Adds a normalised entity to the automaton's trie
+            Params: pattern (str) - Normalised entity'''
 
-        try:
-            for i in self.decomposition_json:
-	
-                subquery_output = ExternalInteractions.huggingface_query(payload={"inputs": self.decomposition_json[i]}, hf_api_url=self.hf_api_url, hf_token=self.hf_token)
-                
-                self.decomposition_vector_list.append(subquery_output)
-        
-        except:
-            logging.error("Unable to encode subqueries")
-            raise
+        state = 0
 
+        for character in pattern:
+            if character not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][character] = len(self.goto) - 1
 
+            state = self.goto[state][character]
 
-class VectorRetrieval:
+        self.output[state].append(pattern)
 
-    def __init__(self, user_query_vector, decomposition_vector_list, years, clubs, entity_list, pinecone_api, pinecone_index):
-        self.context_list = []
-        self.user_query_vector = user_query_vector
-        self.decomposition_vector_list = decomposition_vector_list
-        self.years = years
-        self.clubs = clubs
-        self.entity_list = entity_list
-        self.pinecone_api = pinecone_api
-        self.pinecone_index = pinecone_index
 
+    def build_failure_links(self):
+        '''Links each trie state to the longest proper suffix that is also in the trie, breadth first'''
 
-    
-    def build_context_list(self):
-        '''Creates a context list to power retrieval augmented generation based on the filters and subqueries previously generated'''
+        queue = list(self.goto[0].values())
 
+        while queue:
+            state = queue.pop(0)
 
-        # Original user query
+            for character, next_state in self.goto[state].items():
+                queue.append(next_state)
 
-        try:
+                fail_state = self.fail[state]
+                while fail_state and character not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
 
-            original_query_response = ExternalInteractions.pinecone_query(query_vector=self.user_query_vector, query_filter= {}, pinecone_api=self.pinecone_api, pinecone_index=self.pinecone_index)
+                self.fail[next_state] = self.goto[fail_state].get(character, 0) if self.goto[fail_state].get(character, 0) != next_state else 0
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
 
-            for i in original_query_response['matches']:
-                self.context_list.append(i['metadata']['text'])
-        
-        except:
-            
-            logging.error("Unable to retrieve matched vectors for original query")
-            raise
 
-        # Decomposition Queries
+    @staticmethod
+    def longest_non_overlapping(matches):
+        '''Keeps the longest matches that don't overlap, in the order they appear
+            Params: matches (list) - (start, end, pattern) tuples'''
 
-        try:
-            for j in self.decomposition_vector_list:
+        chosen = []
 
-                decomposition_response = ExternalInteractions.pinecone_query(query_vector=j, query_filter= {}, pinecone_api=self.pinecone_api, pinecone_index=self.pinecone_index)
+        for start, end, pattern in sorted(matches, key=lambda x: (x[0] - x[1], x[0])):
+            if all(end <= i[0] or start >= i[1] for i in chosen):
+                chosen.append((start, end, pattern))
 
-                for k in decomposition_response['matches']:
-                    self.context_list.append(k['metadata']['text'])
-        
-        except:
-            
-            logging.error("Unable to retrieve matched vectors for subqueries")
-            raise
+        return sorted(chosen)
 
 
-        # Original query with years filter
+    def exact_matches(self, normalised_query):
+        '''Finds every entity appearing as whole words in the normalised query
+            Params: normalised_query (str) - Normalised query'''
 
-        try:
-            if self.years != None:
+        text = ' {} '.format(normalised_query)
+        state = 0
+        matches = []
 
-                years_list = self.years.split(', ')
+        for i, character in enumerate(text):
+            while state and character not in self.goto[state]:
+                state = self.fail[state]
 
-                original_query_response_years = ExternalInteractions.pinecone_query(query_vector=self.user_query_vector, query_filter= {"year": {"$in":years_list}}, pinecone_api=self.pinecone_api, pinecone_index=self.pinecone_index)
+            state = self.goto[state].get(character, 0)
 
-                for l in original_query_response_years['matches']:
-                    self.context_list.append(l['metadata']['text'])
-        
-        except:
-            
-            logging.error("Unable to retrieve matched vectors for years filter")
-            raise
+            for pattern in self.output[state]:
+                start = i - len(pattern) + 1
 
-        
-        # Original query with clubs filter
+                if text[start - 1] == ' ' and text[i + 1] == ' ':
+                    matches.append((start, i + 1, pattern))
 
-        try:
+        return self.longest_non_overlapping(matches)
 
-            if self.clubs != None:
 
-                clubs_list = self.clubs.split(', ')
+    def fuzzy_matches(self, normalised_query):
+        '''Finds entities close to a phrase of the query, e.g. misspelt names, using shared trigrams to pick candidates
+            Params: normalised_query (str) - Normalised query'''
 
-                original_query_response_clubs = ExternalInteractions.pinecone_query(query_vector=self.user_query_vector, query_filter= {"club": {"$in":clubs_list}}, pinecone_api=self.pinecone_api, pinecone_index=self.pinecone_index)
+        words = normalised_query.split(' ')
+        matches = []
+        position = 0
+        offsets = []
 
-                for m in original_query_response_clubs['matches']:
-                    self.context_list.append(m['metadata']['text'])
-        
-        except:
-            
-            logging.error("Unable to retrieve matched vectors for clubs filter")
-            raise
+        for word in words:
+            offsets.append(position)
+            position += len(word) + 1
 
-        
-        # Original query with entities filter
+        for first in range(len(words)):
+            for last in range(first, min(first + self.max_words, len(words))):
+                phrase = ' '.join(words[first:last + 1])
 
-        try:
+                if len(phrase) < self.min_fuzzy_length:
+                    continue
 
-            if self.entity_list != None:
+                phrase_trigrams = self.trigrams(phrase)
+                shared = {}
 
-                query_entities_list = self.entity_list.split(', ')
+                for trigram in phrase_trigrams:
+                    for pattern in self.trigram_index.get(trigram, []):
+                        shared[pattern] = shared.get(pattern, 0) + 1
 
-                original_query_response_entities = ExternalInteractions.pinecone_query(query_vector=self.user_query_vector, query_filter= {"entities": {"$in":query_entities_list}}, pinecone_api=self.pinecone_api, pinecone_index=self.pinecone_index)
+                best = None
 
-                for m in original_query_response_entities['matches']:
-                    self.context_list.append(m['metadata']['text'])
-        
-        except:
-            
-            logging.error("Unable to retrieve matched vectors for entities filter")
-            raise
+                for pattern, count in shared.items():
+                    # Dice coefficient of the trigram sets bounds how similar the strings can be
+                    if 2 * count / (len(phrase_trigrams) + self.trigram_counts[pattern]) < self.fuzzy_threshold - 0.2:
+                        continue
 
+                    ratio = SequenceMatcher(None, phrase, pattern).ratio()
 
+                    if ratio >= self.fuzzy_threshold and (best is None or ratio > best[0]):
+                        best = (ratio, pattern)
 
-class GenerateFinalAnswer:
+                if best is not None:
+                    matches.append((offsets[first], offsets[last] + len(words[last]), best[1]))
 
-    def __init__(self, user_query, context_list):
-        self.user_query = user_query
-        self.context_list = context_list
-        self.answer = None
+        return self.longest_non_overlapping(matches)
 
-    
-    def generate_answer(self, model):
-        '''Passes original query and context list to LLM to generate a final answer'''
 
-        final_prompt = '''Answer the following question, prioritising information from the context below:
-                    
-                    Question - {}
-                    
-                    Context - {}'''.format(self.user_query, self.context_list)
+    def match(self, query, fuzzy=True):
+        '''Returns the original entities found in a query, falling back to fuzzy matching when nothing matches exactly
+            Params: query (str) - User query
+                    fuzzy (bool) - Use the fuzzy fallback'''
 
-        try:
-            self.answer = ExternalInteractions.bedrock_interaction(model=model, prompt=final_prompt)
-        
-        except:
-            try:
+        normalised_query = self.normalise(query)
+
+        matches = self.exact_matches(normalised_query)
+
+        if not matches and fuzzy:
+            matches = self.fuzzy_matches(normalised_query)
+
+        return list(dict.fromkeys(entity for start, end, pattern in matches for entity in self.entities[pattern]))
+
+
+
+class EntityExtraction:
+
+    def __init__(self, entity_list_bucket, entity_list_key, user_query):
+        self.entity_list_bucket = entity_list_bucket
+        self.entity_list_key = entity_list_key
+        self.user_query = user_query
+        self.entity_list = None
+        self.query_entities = None
+
+
+    def retrieve_lookup_list(self, ttl=300):
+        '''Retrieves list of entities generated on upsert of data into vector database held in s3.
+            The list is cached in memory and only reloaded when its ETag changes
+            Params: ttl (float) - Seconds between checks of the list's ETag'''
+
+        try:
+            self.entity_list = ResourceCache.s3_json(bucket=self.entity_list_bucket, key=self.entity_list_key, ttl=ttl)
+
+        except:
+            logging.error("Unable to retrieve entity list from {}/{}".format(self.entity_list_bucket, self.entity_list_key))
+            raise
+    
+    
+    @traced('Entities')
+    def entity_matching(self, model=None, fuzzy=True):
+        '''Matches entities in the user query against the retrieved list with a local matcher, built once per container and
+            rebuilt when the list changes. The LLM is only used when nothing matches and a model is given
+            Params: model (str) - Model ID for the LLM fallback, None to skip it
+                    fuzzy (bool) - Use the matcher's fuzzy fallback'''
+
+        try:
+            key = ('entity_matcher', self.entity_list_bucket, self.entity_list_key)
+            cached = ResourceCache.get(key)
+
+            if cached is None or cached[0] is not self.entity_list:
+                cached = (self.entity_list, EntityMatcher(self.entity_list))
+                ResourceCache.put(key, cached)
+
+            matches = cached[1].match(self.user_query, fuzzy=fuzzy)
+
+        except:
+            logging.warning("Unable to match entities locally")
+            matches = []
+
+        if matches:
+            self.query_entities = ', '.join(matches)
+
+        elif model is not None:
+            self.entity_extraction(model=model)
+
+        else:
+            self.query_entities = None
+
+
+    def entity_extraction(self, model):
+        '''Extracts any entities in user queries that match the retrieved list'''
+
+        entity_prompt = """Match any entities from this question that appear in the list below:
+
+        Question - {}
+
+
+        List - {}
+
+
+        Output should only be entities as a comma separated list and no other preamble. If no entities found, output None""".format(self.user_query, self.entity_list)
+
+        try:
+            self.query_entities = ExternalInteractions.bedrock_interaction(model=model, prompt=entity_prompt)
+
+        except:
+            logging.warning("Unable to extract any entities from user query")
+            self.query_entities = None
+
+
+class AbstractEncoder(ABC):
+
+    @abstractmethod
+    def encode(self, texts):
+        pass
+
+
+class HuggingFaceEncoder(AbstractEncoder):
+
+    def __init__(self, hf_api_url, hf_token):
+        self.hf_api_url = hf_api_url
+        self.hf_token = hf_token
+        self.session = requests.Session()
+
+
+    def encode(self, texts):
+        '''Encodes a list of strings with a single request to the Hugging Face inference API
+            Params: texts (list) - Strings to encode'''
+
+        vectors = ExternalInteractions.huggingface_query(payload={"inputs": texts}, hf_api_url=self.hf_api_url, hf_token=self.hf_token, session=self.session)
+
+        if len(vectors) != len(texts):
+            raise ValueError("Expected {} vectors from Hugging Face, received {}".format(len(texts), len(vectors)))
+
+        return vectors
+
+
+class LocalEncoder(AbstractEncoder):
+
+    def __init__(self, model_name='BAAI/bge-small-en-v1.5'):
+        '''Runs the embedding model in process with sentence-transformers, which is installed when the image is built with ENCODER_BACKEND=local.
+            Uses the same library and model as ingest, so query vectors match the stored vectors exactly
+            Params: model_name (str) - Sentence Transformers model name or saved model path, must match the model used at ingest'''
+
+        try:
+            from sentence_transformers import SentenceTransformer
+
+        except ImportError:
+            logging.error("sentence-transformers is required for the local encoder")
+            raise
+
+        self.model = SentenceTransformer(model_name)
+
+
+    def encode(self, texts):
+        '''Encodes a list of strings in one batch
+            Params: texts (list) - Strings to encode'''
+
+        return self.model.encode(texts).tolist()
+
+
+
+class QueryEncoding:
+
+    def __init__(self, decomposition_json, hf_api_url, hf_token, user_query, encoder=None):
+        self.decomposition_json = decomposition_json
+        self.user_query = user_query
+        self.hf_api_url = hf_api_url
+        self.hf_token = hf_token
+        self.encoder = encoder or HuggingFaceEncoder(hf_api_url=hf_api_url, hf_token=hf_token)
+        self.user_query_vector = None
+        self.decomposition_vector_list = []
+
+
+    @staticmethod
+    def create_encoder(backend, hf_api_url=None, hf_token=None, model_name='BAAI/bge-small-en-v1.5'):
+        '''Returns a cached encoder for the given backend, so local models are only loaded once per container
+            Params: backend (str) - huggingface or local
+                    hf_api_url (str) - API endpoint for hugging face model
+                    hf_token (str) - API key for hugging face access
+                    model_name (str) - Sentence Transformers model name for the local backends'''
+
+        key = ('encoder', backend, hf_api_url, model_name)
+
+        encoder = ResourceCache.get(key)
+
+        if encoder is None:
+            backends = {'huggingface': lambda: HuggingFaceEncoder(hf_api_url=hf_api_url, hf_token=hf_token),
+                              'local': lambda: LocalEncoder(model_name=model_name)}
+
+            if backend not in backends:
+                raise ValueError("Unknown encoder backend {}".format(backend))
+
+            encoder = backends[backend]()
+            ResourceCache.put(key, encoder)
+
+        return encoder
+
+    
+    def original_query_encoding(self):
+        '''Encodes the original query into an embedding/vector with the configured encoder'''
+
+        try:
+            self.user_query_vector = self.encoder.encode([self.user_query])[0]
+        except:
+            logging.error("Unable to encode original query")
+            raise
+    
+
+    def subquery_encoding(self):
+        '''Encodes the subqueries into embeddings/vectors with the configured encoder'''
+
+        try:
+            subqueries = [self.decomposition_json[i] for i in self.decomposition_json]
+
+            if subqueries:
+                self.decomposition_vector_list = self.encoder.encode(subqueries)
+        
+        except:
+            logging.error("Unable to encode subqueries")
+            raise
+
+
+    @traced('Encoding')
+    def batch_encoding(self):
+        '''Encodes the original query and all subqueries in a single encoder call. A user_query_vector that is already set,
+            e.g. by the semantic cache lookup, is reused'''
+
+        try:
+            subqueries = [self.decomposition_json[i] for i in self.decomposition_json]
+
+            if self.user_query_vector is not None:
+                self.decomposition_vector_list = self.encoder.encode(subqueries) if subqueries else []
+                return
+
+            vectors = self.encoder.encode([self.user_query] + subqueries)
+
+            self.user_query_vector = vectors[0]
+            self.decomposition_vector_list = vectors[1:]
+
+        except:
+            logging.error("Unable to encode query and subqueries")
+            raise
+
+
+
+class QueryRouter:
+
+    # Labelled examples for the nearest centroid classifier, simple queries need one retrieval pass
+    examples = {'simple': ["Who was Chelsea's manager in 2016?",
+                           'Who was Arsenal captain in the 2018-19 season?',
+                           'Where did Liverpool finish in the league in 2020?',
+                           'How many goals did Harry Kane score?',
+                           'When did Jurgen Klopp join Liverpool?',
+                           'Which stadium do Manchester United play at?',
+                           'Who won the FA Cup in 2017?',
+                           'What was the score in the Champions League final?'],
+                'complex': ['Compare Arsenal and Chelsea defensive records over the last three seasons',
+                            'Why did Manchester United struggle after Alex Ferguson retired?',
+                            'How did Liverpool change their playing style between 2015 and 2020?',
+                            'What were the main reasons for Chelsea winning the league and how did it compare to the year before?',
+                            'Explain the impact of injuries on Arsenal title challenges',
+                            'Which club spent most in the transfer market and did it improve their results?',
+                            'Summarise the rivalry between Liverpool and Manchester United in recent seasons',
+                            'How have the top four clubs performed in Europe compared with the league?']}
+
+    complex_cues = re.compile(r'\b(compare|compared|comparison|versus|vs|difference|differ|why|explain|impact|trend|summarise|summarize|rivalry|both|overall|improve|change|changed)\b')
+    factoid_cues = re.compile(r'^(who|what|when|where|which|how many|how much|did|was|is)\b')
+
+    def __init__(self, user_query, encoder=None, query_vector=None, today=None):
+        '''Chooses how much of the pipeline a query needs - direct (original query and local entity matches, no LLM calls
+            before generation), filtered (adds metadata filters) or decomposition (subqueries and every retrieval). Heuristics
+            decide clear cases and an embedding nearest centroid classifier decides the rest
+            Params: user_query (str) - User query
+                    encoder (AbstractEncoder) - Query encoder, the classifier is skipped if not given
+                    query_vector (list) - Already computed query embedding, e.g. from the semantic cache
+                    today (date) - Date used for relative seasons, defaults to today'''
+
+        self.user_query = user_query
+        self.encoder = encoder
+        self.query_vector = query_vector
+        self.today = today
+        self.complexity = None
+        self.plan = None
+        self.reason = None
+
+
+    def centroids(self):
+        '''Returns the normalised class centroids of the labelled examples, embedded once per container for each encoder'''
+
+        key = ('router_centroids', id(self.encoder))
+        centroids = ResourceCache.get(key)
+
+        if centroids is None:
+            labels = list(self.examples)
+            vectors = np.asarray(self.encoder.encode([example for label in labels for example in self.examples[label]]), dtype='float32')
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+            centroids = {}
+            start = 0
+
+            for label in labels:
+                centroid = vectors[start:start + len(self.examples[label])].mean(axis=0)
+                centroids[label] = centroid / max(np.linalg.norm(centroid), 1e-12)
+                start += len(self.examples[label])
+
+            ResourceCache.put(key, centroids)
+
+        return centroids
+
+
+    def heuristic_complexity(self, clubs):
+        '''Returns simple, complex or None when the heuristics can't tell. Short factoid questions and short keyword queries
+            without a question (e.g. Arsenal top scorer 2022) are simple
+            Params: clubs (list) - Clubs found by the gazetteer'''
+
+        text = self.user_query.lower().strip()
+        words = len(text.split())
+
+        if self.complex_cues.search(text) or len(clubs) > 1 or text.count('?') > 1:
+            return 'complex'
+
+        if words > 25:
+            return 'complex'
+
+        if words <= 12 and ' and ' not in text and (self.factoid_cues.search(text) or (words <= 6 and '?' not in text)):
+            return 'simple'
+
+        return None
+
+
+    def classify(self):
+        '''Classifies the query as simple or complex by its nearest example centroid, embedding the query if needed'''
+
+        if self.query_vector is None:
+            self.query_vector = self.encoder.encode([self.user_query])[0]
+
+        vector = np.asarray(self.query_vector, dtype='float32')
+        vector = vector / max(np.linalg.norm(vector), 1e-12)
+
+        similarities = {label: float(centroid @ vector) for label, centroid in self.centroids().items()}
+
+        return max(similarities, key=similarities.get)
+
+
+    @traced('Routing')
+    def route(self, confidence_threshold=0.75):
+        '''Sets the plan for the query. Queries the router can't classify keep the full decomposition plan
+            Params: confidence_threshold (float) - Minimum rule confidence for years or clubs to count as metadata filters'''
+
+        metadata = MetadataFiltering(user_query=self.user_query, today=self.today)
+        years, years_confidence = metadata.rule_based_years()
+        clubs, clubs_confidence = metadata.rule_based_clubs()
+
+        has_metadata = (years and years_confidence >= confidence_threshold) or (clubs and clubs_confidence >= confidence_threshold)
+
+        self.complexity = self.heuristic_complexity(clubs)
+        self.reason = 'heuristics'
+
+        if self.complexity is None and self.encoder is not None:
+            try:
+                self.complexity = self.classify()
+                self.reason = 'classifier'
+
+            except:
+                logging.warning("Unable to classify query, using the full pipeline")
+
+        if self.complexity == 'simple':
+            self.plan = 'filtered' if has_metadata else 'direct'
+        else:
+            self.plan = 'decomposition'
+            self.reason = self.reason if self.complexity else 'default'
+
+        Tracer.metric('{}Plan'.format(self.plan.capitalize()), 1)
+        logging.info("Query routed to {} plan by {}".format(self.plan, self.reason))
+
+
+
+
+class AbstractVectorStore(ABC):
+
+    @abstractmethod
+    def query_many(self, vectors, filters, top_k, partitions):
+        pass
+
+
+    @staticmethod
+    def merge_responses(responses, top_k):
+        '''Merges responses from several partitions into one response holding the top_k matches by score. A chunk merged from
+            several seasons is in each of their partitions, so only its first match is kept
+            Params: responses (list) - Responses for the same query vector
+                    top_k (int) - Number of matches to keep'''
+
+        if len(responses) == 1:
+            return responses[0]
+
+        matches = {}
+
+        for match in sorted((match for response in responses for match in response['matches']), key=lambda x: x['score'], reverse=True):
+            matches.setdefault(match['id'], match)
+
+        return {'matches': list(matches.values())[:top_k]}
+
+
+class PineconeVectorStore(AbstractVectorStore):
+
+    def __init__(self, pinecone_api, pinecone_index, max_workers=8, query_timeout=10, include_metadata=True, season_namespaces_only=False, namespace_ttl=300):
+        self.pinecone_api = pinecone_api
+        self.pinecone_index = pinecone_index
+        self.max_workers = max_workers
+        self.query_timeout = query_timeout
+        self.include_metadata = include_metadata # Chunk text comes from a document store when False
+        self.season_namespaces_only = season_namespaces_only # Vectors are only in season namespaces, so unpartitioned queries search all of them
+        self.namespace_ttl = namespace_ttl
+
+
+    def index_namespaces(self, index):
+        '''Returns every namespace in the index, listed once per namespace_ttl seconds so new seasons are picked up
+            Params: index (Index) - Pinecone index handle'''
+
+        key = ('pinecone_namespaces', self.pinecone_api, self.pinecone_index)
+        namespaces = ResourceCache.get(key, ttl=self.namespace_ttl)
+
+        if namespaces is None:
+            namespaces = sorted(index.describe_index_stats()['namespaces'])
+            ResourceCache.put(key, namespaces)
+
+        return namespaces
+
+
+    def query_many(self, vectors, filters, top_k=30, partitions=None):
+        '''Sends every query to Pinecone through one shared index handle, up to max_workers at a time.
+            Queries limited to season partitions are sent to each of those namespaces and the results merged.
+            Returns one response per query in the order given
+            Params: vectors (list) - Query vectors
+                    filters (list) - Pinecone metadata filter for each vector
+                    top_k (int) - Number of matches per query
+                    partitions (list) - Season namespaces to search for each vector, None searches the default namespace, or
+                                        every namespace when season_namespaces_only is set'''
+
+        index = ExternalInteractions.pinecone_index(pinecone_api=self.pinecone_api, pinecone_index=self.pinecone_index)
+
+        partitions = partitions or [None] * len(vectors)
+        unpartitioned = self.index_namespaces(index) if self.season_namespaces_only and not all(partitions) else [None]
+        namespaces = [query_partitions or unpartitioned for query_partitions in partitions]
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, sum(len(i) for i in namespaces))))
+
+        try:
+            futures = [[executor.submit(ExternalInteractions.pinecone_query,
+                                        query_vector=vector,
+                                        query_filter=query_filter,
+                                        pinecone_api=self.pinecone_api,
+                                        pinecone_index=self.pinecone_index,
+                                        index=index,
+                                        timeout=self.query_timeout,
+                                        namespace=namespace,
+                                        top_k=top_k,
+                                        include_metadata=self.include_metadata) for namespace in query_namespaces]
+                       for vector, query_filter, query_namespaces in zip(vectors, filters, namespaces)]
+
+            return [self.merge_responses([future.result() for future in query_futures], top_k) for query_futures in futures]
+
+        finally:
+            executor.shutdown(wait=False)
+
+
+class LocalVectorStore(AbstractVectorStore):
+
+    filter_fields = ('year', 'club', 'entities')
+
+    def __init__(self, index_path, approximate_threshold=100000, n_lists=None, n_probe=8, exact_filter_limit=20000):
+        '''In process vector index over a memory-mapped vectors.npy matrix and row aligned metadata.json, as written by the
+            ingest pipeline's LocalVectorUpsert. Search is exact below approximate_threshold vectors, above it an IVF index is
+            built and n_probe of its n_lists clusters are searched
+            Params: index_path (str) - Directory holding vectors.npy and metadata.json
+                    approximate_threshold (int) - Number of vectors at which the IVF index is used
+                    n_lists (int) - Number of IVF clusters, defaults to the square root of the number of vectors
+                    n_probe (int) - Clusters searched per query
+                    exact_filter_limit (int) - Filtered queries matching at most this many vectors are searched exactly'''
+
+        self.index_path = index_path
+        self.n_probe = n_probe
+        self.exact_filter_limit = exact_filter_limit
+        self.vectors = np.load(os.path.join(index_path, 'vectors.npy'), mmap_mode='r')
+
+        with open(os.path.join(index_path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+
+        self.norms = np.linalg.norm(self.vectors, axis=1).astype('float32')
+        self.norms[self.norms == 0] = 1
+        self.field_rows = self.build_field_rows()
+        self.centroids = None
+        self.lists = None
+
+        if len(self.metadata) >= approximate_threshold:
+            self.build_ivf(n_lists or int(np.sqrt(len(self.metadata))))
+
+        logging.info("Local vector index loaded with {} vectors".format(len(self.metadata)))
+
+
+    def build_field_rows(self):
+        '''Builds an inverted index of metadata value to row numbers for each filterable field'''
+
+        field_rows = {field: {} for field in self.filter_fields}
+
+        for row, metadata in enumerate(self.metadata):
+            for field in self.filter_fields:
+                values = metadata.get(field)
+                values = values if isinstance(values, list) else [values]
+
+                for value in values:
+                    field_rows[field].setdefault(value, []).append(row)
+
+        return {field: {value: np.array(rows) for value, rows in values.items()} for field, values in field_rows.items()}
+
+
+    def build_ivf(self, n_lists, iterations=10, sample_size=50000, block_size=65536):
+        '''Clusters the vectors with k-means and assigns every vector to its nearest centroid
+            Params: n_lists (int) - Number of clusters
+                    iterations (int) - k-means iterations
+                    sample_size (int) - Vectors sampled to train the centroids
+                    block_size (int) - Vectors assigned per block, bounding memory use'''
+
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(len(self.metadata), size=min(sample_size, len(self.metadata)), replace=False))
+        sample = np.asarray(self.vectors[sample_rows], dtype='float32') / self.norms[sample_rows, None]
+
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+
+            for c in range(n_lists):
+                members = sample[assignment == c]
+
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        assignment = np.empty(len(self.metadata), dtype='int64')
+
+        for start in range(0, len(self.metadata), block_size):
+            block = np.asarray(self.vectors[start:start + block_size], dtype='float32')
+            assignment[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+
+        self.centroids = centroids
+        self.lists = [np.flatnonzero(assignment == c) for c in range(n_lists)]
+        logging.info("IVF index built with {} lists".format(n_lists))
+
+
+    def filter_rows(self, query_filter):
+        '''Returns the sorted rows matching a Pinecone style metadata filter, or None if the filter is empty.
+            Fields are combined with AND and support $in, $eq or a plain value
+            Params: query_filter (dict) - Metadata filter e.g. {"year": {"$in": ["2019", "2020"]}}'''
+
+        if not query_filter:
+            return None
+
+        rows = None
+
+        for field, condition in query_filter.items():
+            if isinstance(condition, dict):
+                if set(condition) - {'$in', '$eq'}:
+                    raise ValueError("Unsupported filter {} on {}".format(condition, field))
+
+                values = condition.get('$in', []) + ([condition['$eq']] if '$eq' in condition else [])
+            else:
+                values = [condition]
+
+            field_values = self.field_rows.get(field, {})
+            matches = [field_values[value] for value in values if value in field_values]
+            field_rows = np.unique(np.concatenate(matches)) if matches else np.array([], dtype='int64')
+
+            rows = field_rows if rows is None else np.intersect1d(rows, field_rows)
+
+        return rows
+
+
+    def top_matches(self, scores, rows, top_k):
+        '''Builds a Pinecone style response from the top_k scores
+            Params: scores (ndarray) - Similarity of each candidate row
+                    rows (ndarray) - Row number of each candidate
+                    top_k (int) - Number of matches to return'''
+
+        k = min(top_k, len(rows))
+
+        if k == 0:
+            return {'matches': []}
+
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+
+        return {'matches': [{'id': self.metadata[rows[b]]['id'], 'score': float(scores[b]), 'metadata': self.metadata[rows[b]]} for b in best]}
+
+
+    def candidate_rows(self, query_filter, partitions):
+        '''Returns the sorted rows a query can match, or None if it can match any row. Season partitions are the local
+            equivalent of Pinecone namespaces, held as the rows of each year
+            Params: query_filter (dict) - Metadata filter
+                    partitions (list) - Seasons to search, None searches every season'''
+
+        rows = self.filter_rows(query_filter)
+
+        if partitions:
+            year_rows = self.field_rows['year']
+            matches = [year_rows[partition] for partition in partitions if partition in year_rows]
+            partition_rows = np.unique(np.concatenate(matches)) if matches else np.array([], dtype='int64')
+
+            rows = partition_rows if rows is None else np.intersect1d(rows, partition_rows)
+
+        return rows
+
+
+    def query_many(self, vectors, filters, top_k=30, partitions=None):
+        '''Answers several queries at once. Unrestricted exact queries are scored against every vector with a single matrix
+            multiply, filtered or partitioned queries only score their candidate rows, and IVF search scores each query against
+            the vectors in its nearest clusters
+            Params: vectors (list) - Query vectors
+                    filters (list) - Metadata filter for each vector
+                    top_k (int) - Number of matches per query
+                    partitions (list) - Seasons to search for each vector, None searches every season'''
+
+        queries = np.asarray(vectors, dtype='float32')
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        partitions = partitions or [None] * len(queries)
+        query_rows = [self.candidate_rows(query_filter, query_partitions) for query_filter, query_partitions in zip(filters, partitions)]
+        responses = [None] * len(queries)
+
+        full_scan = [q for q, rows in enumerate(query_rows) if rows is None and self.centroids is None]
+
+        if full_scan:
+            scores = (queries[full_scan] @ self.vectors.T) / self.norms
+            all_rows = np.arange(len(self.metadata))
+
+            for n, q in enumerate(full_scan):
+                responses[q] = self.top_matches(scores[n], all_rows, top_k)
+
+        if self.centroids is not None:
+            probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :self.n_probe]
+
+        for q, rows in enumerate(query_rows):
+            if responses[q] is not None:
+                continue
+
+            if rows is not None and (self.centroids is None or len(rows) <= self.exact_filter_limit):
+                candidates = rows
+            else:
+                candidates = np.sort(np.concatenate([self.lists[c] for c in probes[q]]))
+
+                if rows is not None:
+                    candidates = np.intersect1d(candidates, rows)
+
+            scores = (np.asarray(self.vectors[candidates], dtype='float32') @ queries[q]) / self.norms[candidates]
+            responses[q] = self.top_matches(scores, candidates, top_k)
+
+        return responses
+
+
+
+class AbstractDocumentStore(ABC):
+
+    @abstractmethod
+    def fetch(self, ids):
+        pass
+
+
+class S3DocumentStore(AbstractDocumentStore):
+
+    def __init__(self, bucket, prefix='document-store', max_workers=10, max_documents=20000, index_ttl=300):
+        '''Chunk text written by the ingest pipeline's DocumentStore, packed into immutable shards of one season and club that
+            are listed in index.json. A request reads the index and then each shard it needs once, so the ids fused from one
+            retrieval cost one read per season and club rather than one per id. Vector ids contain the chunk's content hash and
+            their text never changes, so text from fetched shards is kept in memory between warm invocations
+            Params: bucket (str) - S3 bucket holding the document objects
+                    prefix (str) - Key prefix of the document objects, must match the ingest pipeline
+                    max_workers (int) - Shards read at once, at most the shared S3 client's connection pool
+                    max_documents (int) - Documents kept in memory, least recently used are evicted first
+                    index_ttl (float) - Seconds between ETag checks of the shard index'''
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_workers = max_workers
+        self.max_documents = max_documents
+        self.index_ttl = index_ttl
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def shard_name(vector_id):
+        '''Returns the shard of a vector id, its year and club without the content hash, as written by the ingest pipeline
+            Params: vector_id (str) - Vector id'''
+
+        return vector_id.rsplit('-', 1)[0]
+
+
+    def shard_keys(self, ttl):
+        '''Returns the shard name to object key mapping, empty if nothing has been ingested
+            Params: ttl (float) - Seconds the cached index is used before its ETag is checked'''
+
+        try:
+            return ResourceCache.s3_json(self.bucket, '{}/index.json'.format(self.prefix), ttl=ttl)['shards']
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return {}
+
+            raise
+
+
+    def load_shard(self, key):
+        '''Returns the documents of a shard object, or None if a newer ingest has replaced it
+            Params: key (str) - Shard object key'''
+
+        try:
+            return json.loads(ResourceCache.client('s3').get_object(Bucket=self.bucket, Key=key)['Body'].read())
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+
+            raise
+
+
+    def load_shards(self, names):
+        '''Reads the named shards concurrently, returning their documents merged. Shards replaced since the index was cached are
+            read again from the current index
+            Params: names (list) - Shard names'''
+
+        documents = {}
+
+        for ttl in (self.index_ttl, 0):
+            keys = self.shard_keys(ttl)
+            keys = [keys[name] for name in names if name in keys]
+
+            if not keys:
+                break
+
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(keys))) as executor:
+                shards = list(executor.map(self.load_shard, keys))
+
+            for shard in shards:
+                documents.update(shard or {})
+
+            names = [name for name, shard in zip(names, shards) if shard is None]
+
+            if not names:
+                break
+
+        return documents
+
+
+    @traced('DocumentFetch')
+    def fetch(self, ids):
+        '''Returns the text of every id found, reading only the shards of ids not already held in memory
+            Params: ids (list) - Vector ids'''
+
+        ids = list(dict.fromkeys(ids))
+
+        with self.lock:
+            documents = {vector_id: self.documents[vector_id] for vector_id in ids if vector_id in self.documents}
+
+            for vector_id in documents:
+                self.documents.move_to_end(vector_id)
+
+        missing_ids = [vector_id for vector_id in ids if vector_id not in documents]
+        shard_names = list(dict.fromkeys(self.shard_name(vector_id) for vector_id in missing_ids))
+
+        if missing_ids:
+            loaded = self.load_shards(shard_names)
+            requested = {vector_id: loaded[vector_id] for vector_id in missing_ids if vector_id in loaded}
+
+            # The rest of each shard is kept too, the requested ids last so they are evicted last
+            with self.lock:
+                for vector_id, text in loaded.items():
+                    if vector_id not in requested:
+                        self.documents.setdefault(vector_id, text)
+
+                for vector_id, text in requested.items():
+                    self.documents[vector_id] = text
+                    self.documents.move_to_end(vector_id)
+
+                while len(self.documents) > self.max_documents:
+                    self.documents.popitem(last=False)
+
+            documents.update(requested)
+
+        Tracer.metric('DocumentsFetched', len(missing_ids))
+        Tracer.metric('DocumentShardsFetched', len(shard_names))
+        Tracer.metric('DocumentCacheHits', len(ids) - len(missing_ids))
+
+        return documents
+
+
+class LocalDocumentStore(AbstractDocumentStore):
+
+    def __init__(self, index_path):
+        '''Chunk text of a local index, loaded from the documents.json written by the ingest pipeline's LocalVectorUpsert
+            Params: index_path (str) - Directory holding documents.json'''
+
+        self.documents = {}
+
+        if os.path.exists(os.path.join(index_path, 'documents.json')):
+            with open(os.path.join(index_path, 'documents.json')) as f:
+                self.documents = json.load(f)
+
+
+    def fetch(self, ids):
+        return {vector_id: self.documents[vector_id] for vector_id in ids if vector_id in self.documents}
+
+
+class VectorRetrieval:
+
+    def __init__(self, user_query_vector, decomposition_vector_list, years, clubs, entity_list, pinecone_api=None, pinecone_index=None, max_workers=8, query_timeout=10, vector_store=None, partitioned_by_season=False):
+        self.retrieved_ids = []
+        self.partitioned_by_season = partitioned_by_season
+        self.query_responses = []
+        self.user_query_vector = user_query_vector
+        self.decomposition_vector_list = decomposition_vector_list
+        self.years = years
+        self.clubs = clubs
+        self.entity_list = entity_list
+        self.vector_store = vector_store or PineconeVectorStore(pinecone_api=pinecone_api, pinecone_index=pinecone_index, max_workers=max_workers, query_timeout=query_timeout)
+
+
+    def retrieval_queries(self):
+        '''Lists the (description, vector, filter, partitions) queries to run based on the filters and subqueries previously generated.
+            When the index is partitioned by season, year constrained queries only search the matching partitions'''
+
+        # Original user query
+        queries = [('original query', self.user_query_vector, {}, None)]
+
+        # Decomposition Queries
+        for j in self.decomposition_vector_list:
+            queries.append(('subqueries', j, {}, None))
+
+        # Original query with years filter
+        if self.years != None:
+            years_list = self.years.split(', ')
+            queries.append(('years filter', self.user_query_vector, {"year": {"$in":years_list}}, years_list if self.partitioned_by_season else None))
+
+        # Original query with clubs filter
+        if self.clubs != None:
+            queries.append(('clubs filter', self.user_query_vector, {"club": {"$in":self.clubs.split(', ')}}, None))
+
+        # Original query with entities filter
+        if self.entity_list != None:
+            queries.append(('entities filter', self.user_query_vector, {"entities": {"$in":self.entity_list.split(', ')}}, None))
+
+        return queries
+
+    
+    @traced('Retrieval')
+    def build_context_list(self):
+        '''Retrieves the matches used to build the context for retrieval augmented generation, based on the filters and subqueries
+            previously generated. All queries are passed to the vector store together so it can run them in a single pass'''
+
+        queries = self.retrieval_queries()
+
+        try:
+            responses = self.vector_store.query_many(vectors=[i[1] for i in queries], filters=[i[2] for i in queries], top_k=30, partitions=[i[3] for i in queries])
+
+        except:
+            logging.error("Unable to retrieve matched vectors for {}".format(', '.join(dict.fromkeys(i[0] for i in queries))))
+            raise
+
+        for query, response in zip(queries, responses):
+            self.query_responses.append((query[0], response))
+
+            for i in response['matches']:
+                self.retrieved_ids.append(i['id'])
+
+        Tracer.metric('RetrievalQueries', len(queries))
+        Tracer.metric('RetrievedChunks', len(self.retrieved_ids))
+
+
+class ContextAssembly:
+
+    def __init__(self, query_responses, token_budget=6000, rrf_k=60, document_store=None):
+        self.query_responses = query_responses
+        self.token_budget = token_budget
+        self.rrf_k = rrf_k
+        self.document_store = document_store
+        self.context_list = []
+        self.context_ids = []
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.tokens_saved = 0
+
+
+    @staticmethod
+    def estimate_tokens(text):
+        '''Approximates the token count of a string, roughly 4 characters per token for English text
+            Params: text (str) - Text to measure'''
+
+        return len(text) // 4 + 1
+
+
+    @staticmethod
+    def match_text(match):
+        '''Returns the chunk text held in a match's metadata, or None for matches returned without it
+            Params: match (dict) - Vector store match'''
+
+        try:
+            return match['metadata']['text']
+
+        except (KeyError, TypeError, AttributeError):
+            return None
+
+
+    def fuse_rankings(self):
+        '''Deduplicates matches by vector id and fuses the per-query rankings with reciprocal rank fusion. Text missing from
+            the match metadata is fetched from the document store in one call for the deduplicated ids.
+            Returns (id, text) pairs ordered by fused score'''
+
+        fused_scores = {}
+        match_counts = {}
+        texts = {}
+
+        for description, response in self.query_responses:
+            for rank, match in enumerate(response['matches']):
+                fused_scores[match['id']] = fused_scores.get(match['id'], 0) + 1 / (self.rrf_k + rank + 1)
+                match_counts[match['id']] = match_counts.get(match['id'], 0) + 1
+                text = self.match_text(match)
+
+                if text is not None:
+                    texts[match['id']] = text
+
+        ranked_ids = sorted(fused_scores, key=lambda x: fused_scores[x], reverse=True)
+        missing_ids = [i for i in ranked_ids if i not in texts]
+
+        if missing_ids and self.document_store is not None:
+            texts.update(self.document_store.fetch(missing_ids))
+
+        if len(texts) < len(ranked_ids):
+            logging.warning("No text found for {} matched ids".format(len(ranked_ids) - len(texts)))
+
+        self.tokens_before = sum(self.estimate_tokens(texts[i]) * match_counts[i] for i in ranked_ids if i in texts)
+
+        return [(i, texts[i]) for i in ranked_ids if i in texts]
+
+
+    @traced('ContextAssembly')
+    def assemble_context(self):
+        '''Builds the context list from the best fused chunks that fit within the token budget'''
+
+        try:
+            seen_texts = set()
+
+            for vector_id, text in self.fuse_rankings():
+
+                # Identical text stored under different ids
+                if text in seen_texts:
+                    continue
+
+                tokens = self.estimate_tokens(text)
+
+                if self.tokens_after + tokens > self.token_budget:
+                    continue
+
+                seen_texts.add(text)
+                self.context_ids.append(vector_id)
+                self.context_list.append(text)
+                self.tokens_after += tokens
+
+            self.tokens_saved = self.tokens_before - self.tokens_after
+
+            Tracer.metric('ContextChunks', len(self.context_list))
+            Tracer.metric('ContextTokens', self.tokens_after)
+            Tracer.metric('ContextTokensSaved', self.tokens_saved)
+            logging.info("Context assembled with {} chunks, {} of {} estimated tokens saved".format(len(self.context_list), self.tokens_saved, self.tokens_before))
+
+        except:
+            logging.error("Unable to assemble context")
+            raise
+
+
+
+class GenerateFinalAnswer:
+
+    def __init__(self, user_query, context_list):
+        self.user_query = user_query
+        self.context_list = context_list
+        self.answer = None
+
+    
+    def final_prompt(self):
+        '''Builds the final prompt from the original query and context list'''
+
+        return '''Answer the following question, prioritising information from the context below:
+                    
+                    Question - {}
+                    
+                    Context -
+                    {}'''.format(self.user_query, '\n\n'.join(self.context_list))
+
+
+    @traced('Generation')
+    def generate_answer(self, model):
+        '''Passes original query and context list to LLM to generate a final answer'''
+
+        final_prompt = self.final_prompt()
+
+        try:
+            self.answer = ExternalInteractions.bedrock_interaction(model=model, prompt=final_prompt)
+        
+        except:
+            try:
                 self.answer = ExternalInteractions.bedrock_interaction(model=model, prompt=final_prompt)
             
             except:
                 logging.error("Unable to generate final answer")
                 raise
+
+
+    def stream_answer(self, model):
+        '''Generator yielding the final answer as the LLM produces it, the full answer is set once the stream completes.
+            A stream that fails before any text has been yielded is retried once
+            Params: model (str) - Model ID for model in AWS Bedrock'''
+
+        final_prompt = self.final_prompt()
+        answer_parts = []
+
+        for attempt in range(2):
+            try:
+                for text in ExternalInteractions.bedrock_stream(model=model, prompt=final_prompt):
+                    answer_parts.append(text)
+                    yield text
+
+                break
+
+            except Exception:
+                if answer_parts or attempt == 1:
+                    logging.error("Unable to generate final answer")
+                    raise
+
+        self.answer = ''.join(answer_parts)
+
+
+    async def astream_answer(self, model):
+        '''Async iterator over the streamed final answer, each blocking read from the stream runs on the default executor
+            Params: model (str) - Model ID for model in AWS Bedrock'''
+
+        loop = asyncio.get_running_loop()
+        stream = self.stream_answer(model)
+        finished = object()
+
+        while True:
+            text = await loop.run_in_executor(None, next, stream, finished)
+
+            if text is finished:
+                break
+
+            yield text
+
+
+
+class StageRunner:
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.results = {}
+
+
+    def run_stages(self, stages, concurrent=True):
+        '''Runs independent query stages, either together on a bounded thread pool or one after another.
+            Optional stages that fail or exceed their timeout fall back to None, required stages re-raise
+            Params: stages (list) - List of (name, function, timeout, required) tuples, function takes no arguments and returns the stage result
+                    concurrent (bool) - Run the stages concurrently so latency is set by the slowest stage rather than the sum'''
+
+        self.results = {}
+
+        if not concurrent:
+            for name, function, timeout, required in stages:
+                try:
+                    self.results[name] = function()
+
+                except:
+                    self.stage_failure(name, required)
+
+            return self.results
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        try:
+            start = time.monotonic()
+            futures = [(name, executor.submit(function), timeout, required) for name, function, timeout, required in stages]
+
+            for name, future, timeout, required in futures:
+                remaining = max(0, timeout - (time.monotonic() - start))
+
+                try:
+                    self.results[name] = future.result(timeout=remaining)
+
+                except:
+                    self.stage_failure(name, required)
+
+        finally:
+            # Don't hold the response for stages that have already timed out
+            executor.shutdown(wait=False)
+
+        return self.results
+
+
+    def stage_failure(self, name, required):
+        '''Applies the fallback for a failed or timed out stage
+            Params: name (str) - Name of the stage
+                    required (bool) - Whether the stage result is needed to answer the query'''
+
+        if required:
+            logging.error("Unable to complete {} stage".format(name))
+            raise
+
+        logging.warning("Unable to complete {} stage, continuing without it".format(name))
+        Tracer.metric('StageFallbacks', 1)
+        self.results[name] = None
+
+
+
+class BatchQuery:
+
+    def __init__(self, user_queries, encoder, vector_store, entity_list_bucket=None, entity_list_key=None, partitioned_by_season=False, max_workers=8, document_store=None):
+        '''Answers many queries together, sharing prompts, encoder calls and retrieval requests between them. A failure only
+            affects its own query and results keep the input order
+            Params: user_queries (list) - Queries to answer
+                    encoder (AbstractEncoder) - Encoder for queries and subqueries
+                    vector_store (AbstractVectorStore) - Vector store to retrieve from
+                    entity_list_bucket (str) - S3 bucket holding the entity lookup list
+                    entity_list_key (str) - S3 key of the entity lookup list
+                    partitioned_by_season (bool) - Index has a partition per season
+                    max_workers (int) - Maximum concurrent Bedrock requests
+                    document_store (AbstractDocumentStore) - Store holding chunk text when matches are returned without it'''
+
+        self.user_queries = user_queries
+        self.encoder = encoder
+        self.vector_store = vector_store
+        self.document_store = document_store
+        self.entity_list_bucket = entity_list_bucket
+        self.entity_list_key = entity_list_key
+        self.entity_list = None
+        self.partitioned_by_season = partitioned_by_season
+        self.max_workers = max_workers
+        self.decompositions = [None] * len(user_queries)
+        self.years = [None] * len(user_queries)
+        self.clubs = [None] * len(user_queries)
+        self.entities = [None] * len(user_queries)
+        self.query_vectors = [None] * len(user_queries)
+        self.subquery_vectors = [None] * len(user_queries)
+        self.context_lists = [None] * len(user_queries)
+        self.answers = [None] * len(user_queries)
+        self.errors = {}
+        self.retrieval_requests = 0
+        self.unique_retrieval_requests = 0
+
+
+    def retrieve_lookup_list(self, ttl=300):
+        '''Retrieves the entity lookup list once for the whole batch, entity matching is skipped if it can't be loaded
+            Params: ttl (float) - Seconds between checks of the list's ETag'''
+
+        try:
+            entities = EntityExtraction(entity_list_bucket=self.entity_list_bucket, entity_list_key=self.entity_list_key, user_query=None)
+            entities.retrieve_lookup_list(ttl=ttl)
+            self.entity_list = entities.entity_list
+
+        except:
+            logging.warning("Continuing batch without entity matching")
+            self.entity_list = None
+
+
+    def pending(self):
+        '''Returns the positions of queries that have not failed'''
+
+        return [n for n in range(len(self.user_queries)) if n not in self.errors]
+
+
+    def fail(self, n, stage):
+        '''Records the failure of one query, called from an except block
+            Params: n (int) - Position of the query
+                    stage (str) - Stage that failed'''
+
+        logging.warning("Batch query {} failed during {}".format(n, stage))
+        self.errors[n] = "Unable to complete {} stage".format(stage)
+
+
+    def single_decomposition(self, n, model):
+        '''Decomposes one query with the single query prompt
+            Params: n (int) - Position of the query
+                    model (str) - Model ID for model in AWS Bedrock'''
+
+        subqueries = SubqueryGeneration(model=model, user_query=self.user_queries[n])
+        subqueries.generate_subqueries()
+
+        return subqueries.decomposition_json
+
+
+    def packed_decomposition(self, positions, model):
+        '''Decomposes several queries with one prompt, falling back to one prompt per query if the response can't be parsed.
+            Returns a dict of position to decomposition JSON
+            Params: positions (list) - Positions of the queries
+                    model (str) - Model ID for model in AWS Bedrock'''
+
+        if len(positions) == 1:
+            return {positions[0]: self.single_decomposition(positions[0], model)}
+
+        questions = '\n\n'.join(['Question {}:\n{}'.format(n + 1, self.user_queries[i]) for n, i in enumerate(positions)])
+
+        prompt = '''You are an expert at converting user questions into sub-queries for retrieving relevant information from a vector database, taking context from your training data. Perform query decomposition for each of the numbered user questions below. Given a user question, break it down into distinct sub questions that you need to answer in order to answer the original question. If there are acronyms or words you are not familiar with, do not try to rephrase them.
+
+        {}
+
+        Output only JSON with a key for every question number in the following format - {{"1": {{"1": "question", "2": "question"}}, "2": {{"1": "question", "2": "question"}}}}'''.format(questions)
+
+        try:
+            response = json.loads(ExternalInteractions.bedrock_interaction(model=model, prompt=prompt))
+
+            return {i: {str(key): str(value) for key, value in response[str(n + 1)].items()} for n, i in enumerate(positions)}
+
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logging.warning("Unable to parse packed decomposition response, decomposing queries individually")
+
+            return {i: self.single_decomposition(i, model) for i in positions}
+
+
+    @traced('BatchSubqueries')
+    def generate_subqueries(self, model, queries_per_prompt=10):
+        '''Decomposes every query, packing queries_per_prompt queries into each prompt and sending prompts concurrently.
+            Queries in a prompt that fails are retried individually so one bad query doesn't fail the rest
+            Params: model (str) - Model ID for model in AWS Bedrock
+                    queries_per_prompt (int) - Queries decomposed by each prompt'''
+
+        positions = self.pending()
+        groups = [positions[start:start + queries_per_prompt] for start in range(0, len(positions), queries_per_prompt)]
+
+        def decompose(group):
+            try:
+                return self.packed_decomposition(group, model)
+
+            except:
+                decompositions = {}
+
+                for n in group:
+                    try:
+                        decompositions[n] = self.single_decomposition(n, model)
+                    except:
+                        self.fail(n, 'subqueries')
+
+                return decompositions
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for decompositions in executor.map(decompose, groups):
+                for n, decomposition in decompositions.items():
+                    self.decompositions[n] = decomposition
+
+
+    @traced('BatchExtraction')
+    def extract_metadata(self, model=None, confidence_threshold=0.75, entity_model=None):
+        '''Extracts years, clubs and entities for every query. Rules, the gazetteer and the shared entity matcher answer most
+            queries locally, LLM fallbacks run concurrently. Extraction is optional so failures leave the value as None
+            Params: model (str) - Model ID for low confidence year and club extraction, None to use rules only
+                    confidence_threshold (float) - Minimum rule confidence to skip the LLM
+                    entity_model (str) - Model ID for the entity LLM fallback, None to skip it'''
+
+        def extract(n):
+            metadata = MetadataFiltering(user_query=self.user_queries[n])
+            metadata.years_extraction(model=model, confidence_threshold=confidence_threshold)
+            metadata.club_extraction(model=model, confidence_threshold=confidence_threshold)
+            self.years[n] = metadata.years
+            self.clubs[n] = metadata.clubs
+
+            if self.entity_list is not None:
+                entities = EntityExtraction(entity_list_bucket=self.entity_list_bucket, entity_list_key=self.entity_list_key, user_query=self.user_queries[n])
+                entities.entity_list = self.entity_list
+                entities.entity_matching(model=entity_model)
+                self.entities[n] = entities.query_entities
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(extract, n) for n in self.pending()]
+
+            for future in futures:
+                try:
+                    future.result()
+                except:
+                    logging.warning("Unable to extract metadata for a batch query, continuing without it")
+
+
+    @traced('BatchEncoding')
+    def batch_encoding(self):
+        '''Encodes every distinct query and subquery across the batch in a single encoder call'''
+
+        positions = self.pending()
+        texts = {}
+
+        for n in positions:
+            texts[self.user_queries[n]] = None
+
+            for subquery in self.decompositions[n].values():
+                texts[subquery] = None
+
+        try:
+            vectors = dict(zip(texts, self.encoder.encode(list(texts)))) if texts else {}
+
+        except:
+            logging.error("Unable to encode batch queries")
+
+            for n in positions:
+                self.fail(n, 'encoding')
+
+            return
+
+        for n in positions:
+            self.query_vectors[n] = vectors[self.user_queries[n]]
+            self.subquery_vectors[n] = [vectors[subquery] for subquery in self.decompositions[n].values()]
+
+
+    @staticmethod
+    def request_key(vector, query_filter, partitions):
+        '''Returns a key identifying a retrieval request, identical requests from different queries share one key'''
+
+        return (np.asarray(vector, dtype='float32').tobytes(), json.dumps(query_filter, sort_keys=True), tuple(partitions) if partitions else None)
+
+
+    @traced('BatchRetrieval')
+    def retrieve_context(self, token_budget=6000, top_k=30):
+        '''Builds every query's retrieval requests, sends each distinct request to the vector store once and assembles
+            each query's context from the shared responses
+            Params: token_budget (int) - Estimated tokens of context per query
+                    top_k (int) - Matches per retrieval request'''
+
+        positions = self.pending()
+        query_requests = {}
+        unique_requests = {}
+
+        for n in positions:
+            retrieval = VectorRetrieval(user_query_vector=self.query_vectors[n], decomposition_vector_list=self.subquery_vectors[n], years=self.years[n],
+                                        clubs=self.clubs[n], entity_list=self.entities[n], vector_store=self.vector_store, partitioned_by_season=self.partitioned_by_season)
+            query_requests[n] = []
+
+            for description, vector, query_filter, partitions in retrieval.retrieval_queries():
+                key = self.request_key(vector, query_filter, partitions)
+                unique_requests.setdefault(key, (vector, query_filter, partitions))
+                query_requests[n].append((description, key))
+
+        keys = list(unique_requests)
+        self.retrieval_requests = sum(len(requests) for requests in query_requests.values())
+        self.unique_retrieval_requests = len(keys)
+
+        Tracer.metric('RetrievalQueries', self.retrieval_requests)
+        Tracer.metric('UniqueRetrievalQueries', self.unique_retrieval_requests)
+
+        try:
+            responses = self.vector_store.query_many(vectors=[unique_requests[key][0] for key in keys], filters=[unique_requests[key][1] for key in keys],
+                                                     top_k=top_k, partitions=[unique_requests[key][2] for key in keys]) if keys else []
+
+        except:
+            logging.error("Unable to retrieve matched vectors for batch queries")
+
+            for n in positions:
+                self.fail(n, 'retrieval')
+
+            return
+
+        responses = dict(zip(keys, responses))
+
+        # Fetches the text of every query's matches together, so each query's assembly reads from the cached documents
+        if self.document_store is not None:
+            self.document_store.fetch([match['id'] for response in responses.values() for match in response['matches'] if ContextAssembly.match_text(match) is None])
+
+        for n in positions:
+            try:
+                context = ContextAssembly(query_responses=[(description, responses[key]) for description, key in query_requests[n]], token_budget=token_budget,
+                                          document_store=self.document_store)
+                context.assemble_context()
+                self.context_lists[n] = context.context_list
+
+            except:
+                self.fail(n, 'context assembly')
+
+
+    @traced('BatchGeneration')
+    def generate_answers(self, model, max_workers=None):
+        '''Generates the final answers with at most max_workers Bedrock requests in flight
+            Params: model (str) - Model ID for model in AWS Bedrock
+                    max_workers (int) - Concurrent generations, defaults to the batch max_workers'''
+
+        def generate(n):
+            generation = GenerateFinalAnswer(user_query=self.user_queries[n], context_list=self.context_lists[n])
+            generation.generate_answer(model=model)
+            self.answers[n] = generation.answer
+
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            futures = {n: executor.submit(generate, n) for n in self.pending()}
+
+            for n, future in futures.items():
+                try:
+                    future.result()
+                except:
+                    self.fail(n, 'final answer')
+
+
+    def results(self):
+        '''Returns one result per query in input order, holding either the answer or the error'''
+
+        return [{'user_query': query, 'error': self.errors[n]} if n in self.errors else {'user_query': query, 'answer': self.answers[n]}
+                for n, query in enumerate(self.user_queries)]
+
+
+
+class AbstractCacheStore(ABC):
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, entry):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def candidates(self, scope):
+        pass
+
+
+class CacheVectorIndex:
+
+    def __init__(self):
+        '''Normalised query vectors of cache entries grouped by scope, held in memory so a similarity lookup is one matrix
+            product over the entries sharing the query's scope instead of a read of every entry in the store'''
+
+        self.entries = {}
+        self.matrices = {}
+        self.lock = threading.Lock()
+
+
+    def add(self, key, entry):
+        '''Indexes an entry, replacing any earlier entry with the same key
+            Params: key (str) - Cache key
+                    entry (dict) - Cache entry'''
+
+        vector = np.asarray(entry['vector'], dtype='float32')
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+        with self.lock:
+            previous = self.entries.get(key)
+
+            if previous is not None:
+                self.matrices.pop(previous['scope'], None)
+
+            self.entries[key] = {'scope': entry.get('scope'), 'vector': vector, 'index_version': entry.get('index_version'), 'created': entry.get('created', 0)}
+            self.matrices.pop(entry.get('scope'), None)
+
+
+    def remove(self, key):
+        '''Removes an entry from the index
+            Params: key (str) - Cache key'''
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+
+            if previous is not None:
+                self.matrices.pop(previous['scope'], None)
+
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+
+    def candidates(self, scope):
+        '''Returns (keys, matrix, index_versions, created) for the entries in a scope. The matrix is rebuilt only after the
+            scope has changed
+            Params: scope (str) - Scope of the query'''
+
+        with self.lock:
+            if scope not in self.matrices:
+                keys = [key for key, entry in self.entries.items() if entry['scope'] == scope]
+                matrix = np.stack([self.entries[key]['vector'] for key in keys]) if keys else np.zeros((0, 0), dtype='float32')
+
+                self.matrices[scope] = (keys, matrix, [self.entries[key]['index_version'] for key in keys],
+                                        np.asarray([self.entries[key]['created'] for key in keys], dtype='float64'))
+
+            return self.matrices[scope]
+
+
+class InMemoryCacheStore(AbstractCacheStore):
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.store = OrderedDict()
+        self.index = CacheVectorIndex()
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        '''Returns an entry and marks it as recently used
+            Params: key (str) - Cache key'''
+
+        with self.lock:
+            if key not in self.store:
+                return None
+
+            self.store.move_to_end(key)
+
+            return self.store[key]
+
+
+    def set(self, key, entry):
+        '''Stores an entry, evicting the least recently used entries over max_entries
+            Params: key (str) - Cache key
+                    entry (dict) - Cache entry'''
+
+        with self.lock:
+            self.store[key] = entry
+            self.store.move_to_end(key)
+            self.index.add(key, entry)
+
+            while len(self.store) > self.max_entries:
+                self.index.remove(self.store.popitem(last=False)[0])
+
+
+    def delete(self, key):
+        '''Removes an entry
+            Params: key (str) - Cache key'''
+
+        with self.lock:
+            self.store.pop(key, None)
+            self.index.remove(key)
+
+
+    def candidates(self, scope):
+        '''Returns (keys, matrix, index_versions, created) for the entries in a scope
+            Params: scope (str) - Scope of the query'''
+
+        return self.index.candidates(scope)
+
+
+class DiskCacheStore(AbstractCacheStore):
+
+    def __init__(self, directory, max_entries=1000):
+        '''Cache held as one JSON file per entry, a directory on shared storage (e.g. EFS) shares the cache between containers.
+            File modification times track recent use for LRU eviction
+            Params: directory (str) - Cache directory
+                    max_entries (int) - Maximum entries kept'''
+
+        self.directory = directory
+        self.max_entries = max_entries
+        self.index = CacheVectorIndex()
+        os.makedirs(directory, exist_ok=True)
+
+
+    def path(self, key):
+        return os.path.join(self.directory, '{}.json'.format(key))
+
+
+    def get(self, key):
+        '''Returns an entry and marks it as recently used
+            Params: key (str) - Cache key'''
+
+        try:
+            with open(self.path(key)) as f:
+                entry = json.load(f)
+
+            os.utime(self.path(key))
+
+            return entry
+
+        except (OSError, ValueError):
+            return None
+
+
+    def set(self, key, entry):
+        '''Stores an entry, written to a temporary file first so readers never see a partial entry, then evicts the least
+            recently used entries over max_entries
+            Params: key (str) - Cache key
+                    entry (dict) - Cache entry'''
+
+        temporary_path = '{}.{}.tmp'.format(self.path(key), threading.get_ident())
+
+        with open(temporary_path, 'w') as f:
+            json.dump(entry, f)
+
+        os.replace(temporary_path, self.path(key))
+        self.index.add(key, entry)
+
+        files = [os.path.join(self.directory, i) for i in os.listdir(self.directory) if i.endswith('.json')]
+
+        if len(files) > self.max_entries:
+            for stale_path in sorted(files, key=os.path.getmtime)[:len(files) - self.max_entries]:
+                self.delete(os.path.basename(stale_path)[:-5])
+
+
+    def delete(self, key):
+        '''Removes an entry
+            Params: key (str) - Cache key'''
+
+        self.index.remove(key)
+
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+
+    def sync_index(self):
+        '''Brings the in memory index up to date with the directory from a listing, reading only entries written since the
+            last sync by this container or another one sharing the directory'''
+
+        keys = set(i[:-5] for i in os.listdir(self.directory) if i.endswith('.json'))
+        indexed = set(self.index.keys())
+
+        for key in indexed - keys:
+            self.index.remove(key)
+
+        for key in keys - indexed:
+            try:
+                with open(self.path(key)) as f:
+                    self.index.add(key, json.load(f))
+
+            except (OSError, ValueError, KeyError):
+                continue
+
+
+    def candidates(self, scope):
+        '''Returns (keys, matrix, index_versions, created) for the entries in a scope
+            Params: scope (str) - Scope of the query'''
+
+        self.sync_index()
+
+        return self.index.candidates(scope)
+
+
+class SemanticCache:
+
+    def __init__(self, store, encoder, index_version, similarity_threshold=0.95, ttl=86400, scope_confidence=0.75):
+        '''Answer cache keyed on the normalised query, with a fallback to the most similar cached query embedding among
+            queries naming the same years and clubs. Entries written against a different index version are treated as misses
+            Params: store (AbstractCacheStore) - Store holding cache entries
+                    encoder (AbstractEncoder) - Encoder for query embeddings, must match the retrieval encoder for the vector to be reused
+                    index_version (str) - Version of the ingested index, from the ingest pipeline
+                    similarity_threshold (float) - Minimum cosine similarity for a near-duplicate hit
+                    ttl (float) - Seconds an entry stays valid
+                    scope_confidence (float) - Minimum year and club rule confidence for near-duplicate hits, below it only exact hits are returned'''
+
+        self.store = store
+        self.encoder = encoder
+        self.index_version = index_version
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.scope_confidence = scope_confidence
+        self.query_vector = None
+        self.hit_type = None
+
+
+    @staticmethod
+    def current_index_version(bucket, key, ttl=300):
+        '''Returns the index version written by the ingest pipeline, or None if it cannot be read
+            Params: bucket (str) - S3 bucket name
+                    key (str) - S3 object key
+                    ttl (float) - Seconds between ETag checks'''
+
+        try:
+            return ResourceCache.s3_json(bucket, key, ttl)['version']
+
+        except:
+            logging.warning("Unable to read index version, cached answers only match entries without a version")
+            return None
+
+
+    @staticmethod
+    def cache_key(query):
+        '''Returns the exact match key for a query, based on its normalised text
+            Params: query (str) - User query'''
+
+        return hashlib.sha256(EntityMatcher.normalise(query).encode('utf-8')).hexdigest()
+
+
+    @staticmethod
+    def query_scope(query, confidence_threshold=0.75):
+        '''Returns the years and clubs the rules find in a query as a scope string, or None when the rules are unsure.
+            Queries differing only in season or club embed almost identically, so near-duplicate hits need the same scope
+            Params: query (str) - User query
+                    confidence_threshold (float) - Minimum year and club rule confidence'''
+
+        filtering = MetadataFiltering(query)
+        years, years_confidence = filtering.rule_based_years()
+        clubs, clubs_confidence = filtering.rule_based_clubs()
+
+        if min(years_confidence, clubs_confidence) < confidence_threshold:
+            return None
+
+        return '{}|{}'.format(','.join(sorted(years)), ','.join(sorted(clubs)))
+
+
+    def valid(self, key, entry):
+        '''Checks an entry is still in date and from the current index version, removing it if not
+            Params: key (str) - Cache key
+                    entry (dict) - Cache entry'''
+
+        if entry['index_version'] != self.index_version or time.time() - entry['created'] > self.ttl:
+            self.store.delete(key)
+            return False
+
+        return True
+
+
+    @traced('CacheLookup')
+    def lookup(self, query):
+        '''Returns the cached answer for a query, or None on a miss. The query embedding computed for the similarity
+            lookup is kept in query_vector so retrieval can reuse it
+            Params: query (str) - User query'''
+
+        key = self.cache_key(query)
+        entry = self.store.get(key)
+
+        if entry is not None and self.valid(key, entry):
+            self.hit_type = 'exact'
+            return entry['answer']
+
+        self.query_vector = self.encoder.encode([query])[0]
+        scope = self.query_scope(query, self.scope_confidence)
+
+        if scope is None:
+            return None
+
+        keys, matrix, index_versions, created = self.store.candidates(scope)
+
+        if not keys:
+            return None
+
+        vector = np.asarray(self.query_vector, dtype='float32')
+        similarities = matrix @ (vector / max(float(np.linalg.norm(vector)), 1e-12))
+
+        # Stale entries are skipped here and left for LRU eviction
+        current = np.asarray([i == self.index_version for i in index_versions]) & (time.time() - created <= self.ttl)
+        similarities = np.where(current, similarities, -np.inf)
+
+        best = int(np.argmax(similarities))
+
+        if similarities[best] >= self.similarity_threshold:
+            entry = self.store.get(keys[best])
+
+            if entry is not None and entry.get('scope') == scope and self.valid(keys[best], entry):
+                self.hit_type = 'semantic'
+                return entry['answer']
+
+        return None
+
+
+    def save(self, query, answer):
+        '''Stores the answer for a query
+            Params: query (str) - User query
+                    answer (str) - Generated answer'''
+
+        if self.query_vector is None:
+            self.query_vector = self.encoder.encode([query])[0]
+
+        self.store.set(self.cache_key(query), {'query': EntityMatcher.normalise(query),
+                                               'scope': self.query_scope(query, self.scope_confidence),
+                                               'vector': [float(i) for i in self.query_vector],
+                                               'answer': answer,
+                                               'index_version': self.index_version,
+                                               'created': time.time()})
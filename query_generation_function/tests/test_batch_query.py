@@ -0,0 +1,92 @@
+import json
+import query_generation.query_generation as qg
+
+
+class RecordingEncoder(qg.AbstractEncoder):
+
+    def __init__(self):
+        self.batches = []
+
+
+    def encode(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+
+class RecordingVectorStore(qg.AbstractVectorStore):
+
+    def __init__(self):
+        self.calls = []
+
+
+    def query_many(self, vectors, filters, top_k=30, partitions=None):
+        self.calls.append(len(vectors))
+        return [{'matches': [{'id': 'v{}'.format(vector[0]), 'score': 1.0, 'metadata': {'text': 'text {}'.format(vector[0])}}]} for vector in vectors]
+
+
+def batch(user_queries, **kwargs):
+    return qg.BatchQuery(user_queries=user_queries, encoder=RecordingEncoder(), vector_store=RecordingVectorStore(), **kwargs)
+
+
+def test_queries_are_decomposed_with_one_packed_prompt(monkeypatch):
+    prompts = []
+
+    def bedrock_interaction(model, prompt):
+        prompts.append(prompt)
+        return json.dumps({'1': {'1': 'Arsenal goals'}, '2': {'1': 'Chelsea goals', '2': 'Chelsea assists'}})
+
+    monkeypatch.setattr(qg.ExternalInteractions, 'bedrock_interaction', staticmethod(bedrock_interaction))
+    queries = batch(['Arsenal?', 'Chelsea?'])
+    queries.generate_subqueries(model='haiku')
+
+    assert len(prompts) == 1
+    assert queries.decompositions == [{'1': 'Arsenal goals'}, {'1': 'Chelsea goals', '2': 'Chelsea assists'}]
+
+
+def test_unparseable_packed_prompt_falls_back_to_single_queries(monkeypatch):
+    def bedrock_interaction(model, prompt):
+        return 'not json' if 'numbered user questions' in prompt else '{"1": "single"}'
+
+    monkeypatch.setattr(qg.ExternalInteractions, 'bedrock_interaction', staticmethod(bedrock_interaction))
+    queries = batch(['Arsenal?', 'Chelsea?'])
+    queries.generate_subqueries(model='haiku')
+
+    assert queries.decompositions == [{'1': 'single'}, {'1': 'single'}]
+
+
+def test_distinct_texts_are_encoded_in_one_call():
+    queries = batch(['Arsenal?', 'Chelsea?'])
+    queries.decompositions = [{'1': 'goals'}, {'1': 'goals', '2': 'Chelsea assists'}]
+    queries.batch_encoding()
+
+    assert queries.encoder.batches == [['Arsenal?', 'goals', 'Chelsea?', 'Chelsea assists']]
+    assert queries.subquery_vectors[1] == [[5.0], [15.0]]
+
+
+def test_identical_retrieval_requests_are_sent_once():
+    queries = batch(['Same question', 'Same question'])
+    queries.decompositions = [{'1': 'sub'}, {'1': 'sub'}]
+    queries.batch_encoding()
+    queries.retrieve_context()
+
+    assert queries.retrieval_requests == 4
+    assert queries.unique_retrieval_requests == 2
+    assert queries.vector_store.calls == [2]
+    assert queries.context_lists[0] == queries.context_lists[1] == ['text 13.0', 'text 3.0']
+
+
+def test_results_keep_input_order_with_per_query_errors(monkeypatch):
+    def bedrock_interaction(model, prompt):
+        if 'broken' in prompt:
+            raise RuntimeError('failed')
+
+        return 'answer'
+
+    monkeypatch.setattr(qg.ExternalInteractions, 'bedrock_interaction', staticmethod(bedrock_interaction))
+    queries = batch(['first', 'broken', 'third'])
+    queries.context_lists = [[], [], []]
+    queries.generate_answers(model='sonnet', max_workers=2)
+
+    assert queries.results() == [{'user_query': 'first', 'answer': 'answer'},
+                                 {'user_query': 'broken', 'error': 'Unable to complete final answer stage'},
+                                 {'user_query': 'third', 'answer': 'answer'}]
@@ -0,0 +1,58 @@
+import query_generation.query_generation as qg
+
+
+def response(*matches):
+    return {'matches': [{'id': vector_id, 'metadata': {'text': text}} for vector_id, text in matches]}
+
+
+class FakeDocumentStore:
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.requested = []
+
+
+    def fetch(self, vector_ids):
+        self.requested.append(list(vector_ids))
+        return {i: self.texts[i] for i in vector_ids if i in self.texts}
+
+
+def test_duplicate_ids_are_fused_and_ranked_first():
+    assembly = qg.ContextAssembly([('first', response(('a', 'alpha'), ('b', 'beta'))),
+                                   ('second', response(('b', 'beta'), ('c', 'gamma')))])
+    assembly.assemble_context()
+
+    assert assembly.context_ids == ['b', 'a', 'c']
+    assert assembly.context_list == ['beta', 'alpha', 'gamma']
+
+
+def test_identical_text_under_different_ids_is_kept_once():
+    assembly = qg.ContextAssembly([('first', response(('a', 'same text'), ('b', 'same text'), ('c', 'other')))])
+    assembly.assemble_context()
+
+    assert assembly.context_list == ['same text', 'other']
+
+
+def test_context_is_packed_within_the_token_budget():
+    long_text = 'x' * 400
+    assembly = qg.ContextAssembly([('first', response(('a', long_text), ('b', long_text + 'y'), ('c', 'short')))], token_budget=110)
+    assembly.assemble_context()
+
+    # The second long chunk does not fit, the short chunk after it still does
+    assert assembly.context_ids == ['a', 'c']
+    assert assembly.tokens_after <= 110
+    assert assembly.tokens_saved == assembly.tokens_before - assembly.tokens_after
+    assert assembly.tokens_saved > 0
+
+
+def test_missing_text_is_fetched_once_for_the_deduplicated_ids():
+    store = FakeDocumentStore({'a': 'alpha', 'b': 'beta'})
+    responses = [('first', {'matches': [{'id': 'a'}, {'id': 'b', 'metadata': {}}]}),
+                 ('second', {'matches': [{'id': 'a'}, {'id': 'gone'}]})]
+
+    assembly = qg.ContextAssembly(responses, document_store=store)
+    assembly.assemble_context()
+
+    assert assembly.context_list == ['alpha', 'beta']
+    assert len(store.requested) == 1
+    assert sorted(store.requested[0]) == ['a', 'b', 'gone']
@@ -0,0 +1,144 @@
+from botocore.exceptions import ClientError
+
+import io
+import json
+import pytest
+import query_generation.query_generation as qg
+import threading
+
+
+SHARDS = {'2019-Arsenal': {'2019-Arsenal-a': 'alpha text', '2019-Arsenal-b': 'beta text here'}, '2020-Chelsea': {'2020-Chelsea-c': 'gamma'}}
+
+
+class RecordingS3Client:
+
+    def __init__(self, shards):
+        self.objects = {}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.write(shards)
+
+
+    def write(self, shards):
+        index = {}
+
+        for name, documents in shards.items():
+            index[name] = 'document-store/shards/{}-{}.json'.format(name, len(self.objects))
+            self.objects[index[name]] = json.dumps(documents)
+
+        self.objects['document-store/index.json'] = json.dumps({'shards': index})
+
+
+    def read(self, operation, Key):
+        with self.lock:
+            self.calls.append((operation, Key))
+
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}}, operation)
+
+        return self.objects[Key].encode('utf-8')
+
+
+    def get_object(self, Bucket, Key):
+        body = self.read('get', Key)
+        return {'Body': io.BytesIO(body), 'ETag': '"{}"'.format(hash(body))}
+
+
+    def head_object(self, Bucket, Key):
+        return {'ETag': '"{}"'.format(hash(self.read('head', Key)))}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    client = RecordingS3Client(SHARDS)
+    monkeypatch.setattr(qg.ResourceCache, 'entries', {})
+    monkeypatch.setattr(qg.ResourceCache, 'client', staticmethod(lambda service_name, region_name=None: client))
+
+    return client
+
+
+def test_cold_fetch_reads_the_index_and_each_shard_once(s3):
+    store = qg.S3DocumentStore(bucket='bucket')
+
+    assert store.fetch(['2019-Arsenal-a', '2020-Chelsea-c', '2019-Arsenal-b', '2019-Arsenal-a', '2021-Leeds-missing']) == {
+        '2019-Arsenal-a': 'alpha text', '2020-Chelsea-c': 'gamma', '2019-Arsenal-b': 'beta text here'}
+    assert sorted(s3.calls) == [('get', 'document-store/index.json'), ('get', 'document-store/shards/2019-Arsenal-0.json'),
+                                ('get', 'document-store/shards/2020-Chelsea-1.json')]
+
+
+def test_warm_fetches_make_no_s3_calls_within_the_index_ttl(s3):
+    store = qg.S3DocumentStore(bucket='bucket')
+    store.fetch(['2019-Arsenal-a'])
+    s3.calls.clear()
+
+    assert store.fetch(['2019-Arsenal-a', '2019-Arsenal-b']) == {'2019-Arsenal-a': 'alpha text', '2019-Arsenal-b': 'beta text here'}
+    assert s3.calls == []
+
+
+def test_index_is_revalidated_with_one_head_after_the_ttl(s3):
+    store = qg.S3DocumentStore(bucket='bucket', index_ttl=0)
+    store.fetch(['2019-Arsenal-a'])
+    s3.calls.clear()
+
+    store.fetch(['2020-Chelsea-c'])
+
+    assert s3.calls == [('head', 'document-store/index.json'), ('get', 'document-store/shards/2020-Chelsea-1.json')]
+
+
+def test_replaced_shards_are_read_from_the_current_index(s3):
+    store = qg.S3DocumentStore(bucket='bucket')
+    store.fetch(['2019-Arsenal-a'])
+    s3.objects.clear()
+    s3.write({'2020-Chelsea': {'2020-Chelsea-c': 'gamma updated'}})
+    s3.calls.clear()
+
+    assert store.fetch(['2020-Chelsea-c']) == {'2020-Chelsea-c': 'gamma updated'}
+    assert s3.calls == [('get', 'document-store/shards/2020-Chelsea-1.json'), ('head', 'document-store/index.json'),
+                        ('get', 'document-store/index.json'), ('get', 'document-store/shards/2020-Chelsea-0.json')]
+
+
+def test_least_recently_used_documents_are_evicted(s3):
+    store = qg.S3DocumentStore(bucket='bucket', max_documents=2)
+    store.fetch(['2019-Arsenal-a'])
+    store.fetch(['2019-Arsenal-a'])
+    store.fetch(['2020-Chelsea-c'])
+
+    assert list(store.documents) == ['2019-Arsenal-a', '2020-Chelsea-c']
+
+
+def test_missing_index_returns_nothing(s3):
+    s3.objects.clear()
+
+    assert qg.S3DocumentStore(bucket='bucket').fetch(['2019-Arsenal-a']) == {}
+
+
+def test_other_errors_are_raised(monkeypatch):
+    class FailingS3Client:
+        def get_object(self, Bucket, Key):
+            raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Denied'}}, 'GetObject')
+
+    monkeypatch.setattr(qg.ResourceCache, 'entries', {})
+    monkeypatch.setattr(qg.ResourceCache, 'client', staticmethod(lambda service_name, region_name=None: FailingS3Client()))
+
+    with pytest.raises(ClientError):
+        qg.S3DocumentStore(bucket='bucket').fetch(['2019-Arsenal-a'])
+
+
+def test_context_assembly_fetches_text_missing_from_matches(s3):
+    responses = [('original query', {'matches': [{'id': '2019-Arsenal-a', 'score': 0.9}, {'id': '2019-Arsenal-b', 'score': 0.5}]}),
+                 ('entities filter', {'matches': [{'id': '2019-Arsenal-b', 'score': 0.9, 'metadata': {'text': 'beta text here'}},
+                                                  {'id': '2021-Leeds-missing', 'score': 0.2}]})]
+    context = qg.ContextAssembly(query_responses=responses, document_store=qg.S3DocumentStore(bucket='bucket'))
+
+    context.assemble_context()
+
+    assert context.context_ids == ['2019-Arsenal-b', '2019-Arsenal-a']
+    assert context.context_list == ['beta text here', 'alpha text']
+    assert context.tokens_before == 2 * qg.ContextAssembly.estimate_tokens('beta text here') + qg.ContextAssembly.estimate_tokens('alpha text')
+
+
+def test_local_document_store(tmp_path):
+    (tmp_path / 'documents.json').write_text('{"a": "alpha text"}')
+
+    assert qg.LocalDocumentStore(index_path=str(tmp_path)).fetch(['a', 'b']) == {'a': 'alpha text'}
+    assert qg.LocalDocumentStore(index_path=str(tmp_path / 'missing')).fetch(['a']) == {}
@@ -0,0 +1,62 @@
+import query_generation.query_generation as qg
+
+
+ENTITIES = ['Bukayo Saka', 'Arsenal F.C.', 'Premier League', 'Emirates Stadium', 'Thierry Henry', 'Saka']
+
+
+def test_exact_matches_ignore_case_accents_and_punctuation():
+    matcher = qg.EntityMatcher(ENTITIES + ['Martin Ødegaard', 'Pépé'])
+
+    assert matcher.match('How did ARSENAL FC do in the premier-league?') == ['Arsenal F.C.', 'Premier League']
+    assert matcher.match('Goals for Pepe and Martin Odegaard') == ['Pépé']
+
+
+def test_longest_match_wins_and_partial_words_are_ignored():
+    matcher = qg.EntityMatcher(ENTITIES)
+
+    assert matcher.match('What did Bukayo Saka score?') == ['Bukayo Saka']
+    assert matcher.match('Sakamoto played well', fuzzy=False) == []
+
+
+def test_misspelt_entities_fall_back_to_fuzzy_matching():
+    matcher = qg.EntityMatcher(ENTITIES)
+
+    assert matcher.match('Goals by Thierry Henri') == ['Thierry Henry']
+    assert matcher.match('Goals by Thierry Henri', fuzzy=False) == []
+    assert matcher.match('What happened at the weekend?') == []
+
+
+def test_llm_is_only_called_when_nothing_matches(monkeypatch):
+    monkeypatch.setattr(qg.ResourceCache, 'entries', {})
+    prompts = []
+    monkeypatch.setattr(qg.ExternalInteractions, 'bedrock_interaction', staticmethod(lambda model, prompt: prompts.append(prompt) or 'None'))
+
+    extraction = qg.EntityExtraction('bucket', 'entities.json', 'Did Saka play at the Emirates Stadium?')
+    extraction.entity_list = ENTITIES
+    extraction.entity_matching(model='haiku')
+
+    assert extraction.query_entities == 'Saka, Emirates Stadium'
+    assert prompts == []
+
+    extraction = qg.EntityExtraction('bucket', 'entities.json', 'Who won the cup?')
+    extraction.entity_list = ENTITIES
+    extraction.entity_matching(model='haiku')
+
+    assert len(prompts) == 1
+
+
+def test_matcher_is_rebuilt_only_when_the_list_changes(monkeypatch):
+    monkeypatch.setattr(qg.ResourceCache, 'entries', {})
+    key = ('entity_matcher', 'bucket', 'entities.json')
+
+    extraction = qg.EntityExtraction('bucket', 'entities.json', 'Saka')
+    extraction.entity_list = ENTITIES
+    extraction.entity_matching()
+    first = qg.ResourceCache.get(key)[1]
+
+    extraction.entity_matching()
+    assert qg.ResourceCache.get(key)[1] is first
+
+    extraction.entity_list = ENTITIES + ['Gabriel Jesus']
+    extraction.entity_matching()
+    assert qg.ResourceCache.get(key)[1] is not first
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+import pytest
+import query_generation.query_generation as qg
+
+
+def test_astream_answer_yields_the_streamed_text(monkeypatch):
+    monkeypatch.setattr(qg.ExternalInteractions, 'bedrock_stream', staticmethod(lambda model, prompt: iter(['Saka ', 'scored ', '14'])))
+    generation = qg.GenerateFinalAnswer(user_query='Arsenal top scorer 2022', context_list=['context'])
+
+    async def collect():
+        return [text async for text in generation.astream_answer(model='model')]
+
+    assert asyncio.run(collect()) == ['Saka ', 'scored ', '14']
+    assert generation.answer == 'Saka scored 14'
+
+
+def test_stream_retried_when_it_fails_before_any_text(monkeypatch):
+    attempts = []
+
+    def bedrock_stream(model, prompt):
+        attempts.append(model)
+
+        if len(attempts) == 1:
+            raise RuntimeError('throttled')
+
+        yield 'Answer'
+
+    monkeypatch.setattr(qg.ExternalInteractions, 'bedrock_stream', staticmethod(bedrock_stream))
+    generation = qg.GenerateFinalAnswer(user_query='query', context_list=[])
+
+    assert list(generation.stream_answer(model='model')) == ['Answer']
+    assert len(attempts) == 2
+
+
+def test_stream_not_retried_after_text(monkeypatch):
+    def bedrock_stream(model, prompt):
+        yield 'Partial'
+        raise RuntimeError('connection reset')
+
+    monkeypatch.setattr(qg.ExternalInteractions, 'bedrock_stream', staticmethod(bedrock_stream))
+
+    with pytest.raises(RuntimeError):
+        list(qg.GenerateFinalAnswer(user_query='query', context_list=[]).stream_answer(model='model'))
+
+
+def test_closing_the_stream_is_not_logged_as_a_failure(monkeypatch, caplog):
+    monkeypatch.setattr(qg.ExternalInteractions, 'bedrock_stream', staticmethod(lambda model, prompt: iter(['First', 'Second'])))
+    stream = qg.GenerateFinalAnswer(user_query='query', context_list=[]).stream_answer(model='model')
+
+    next(stream)
+
+    with caplog.at_level(logging.ERROR):
+        stream.close()
+
+    assert 'Unable to generate final answer' not in caplog.text
@@ -0,0 +1,85 @@
+import json
+import numpy as np
+import os
+import pytest
+import query_generation.query_generation as qg
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(400, 16)).astype('float32')
+    metadata = [{'id': 'v{}'.format(n),
+                 'year': str(2018 + n % 4),
+                 'club': ['Arsenal', 'Chelsea'][n % 2],
+                 'entities': ['Player {}'.format(n % 5)]} for n in range(400)]
+
+    np.save(os.path.join(tmp_path, 'vectors.npy'), vectors)
+
+    with open(os.path.join(tmp_path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    return str(tmp_path)
+
+
+def ids(response):
+    return [match['id'] for match in response['matches']]
+
+
+def test_exact_search_ranks_by_cosine_similarity(index_path):
+    store = qg.LocalVectorStore(index_path)
+    query = store.vectors[7] * 3
+
+    response = store.query_many([query], [None], top_k=5)[0]
+
+    assert ids(response)[0] == 'v7'
+    assert response['matches'][0]['score'] == pytest.approx(1.0, abs=1e-5)
+    assert [m['score'] for m in response['matches']] == sorted([m['score'] for m in response['matches']], reverse=True)
+
+
+def test_filters_combine_fields_with_and(index_path):
+    store = qg.LocalVectorStore(index_path)
+    query_filter = {'year': {'$in': ['2019', '2021']}, 'club': {'$eq': 'Chelsea'}, 'entities': {'$in': ['Player 1']}}
+
+    response = store.query_many([store.vectors[0]], [query_filter], top_k=400)[0]
+
+    assert response['matches']
+    assert all(m['metadata']['year'] in ('2019', '2021') and m['metadata']['club'] == 'Chelsea' and m['metadata']['entities'] == ['Player 1']
+               for m in response['matches'])
+    assert len(response['matches']) == sum(1 for n in range(400) if n % 4 in (1, 3) and n % 2 == 1 and n % 5 == 1)
+
+
+def test_unsupported_filter_operator_is_rejected(index_path):
+    store = qg.LocalVectorStore(index_path)
+
+    with pytest.raises(ValueError):
+        store.query_many([store.vectors[0]], [{'year': {'$gt': '2019'}}])
+
+
+def test_batched_queries_match_single_queries(index_path):
+    store = qg.LocalVectorStore(index_path)
+    vectors = [store.vectors[n] for n in (3, 50, 99)]
+    filters = [None, {'club': 'Arsenal'}, None]
+
+    batched = store.query_many(vectors, filters, top_k=10)
+    single = [store.query_many([vector], [query_filter], top_k=10)[0] for vector, query_filter in zip(vectors, filters)]
+
+    assert [ids(response) for response in batched] == [ids(response) for response in single]
+
+
+def test_partitions_limit_the_search_to_their_seasons(index_path):
+    store = qg.LocalVectorStore(index_path)
+
+    response = store.query_many([store.vectors[0]], [None], top_k=400, partitions=[['2019']])[0]
+
+    assert len(response['matches']) == 100
+    assert {m['metadata']['year'] for m in response['matches']} == {'2019'}
+
+
+def test_ivf_probing_every_list_matches_exact_search(index_path):
+    exact = qg.LocalVectorStore(index_path)
+    approximate = qg.LocalVectorStore(index_path, approximate_threshold=100, n_lists=8, n_probe=8, exact_filter_limit=0)
+    vectors = [exact.vectors[n] for n in (5, 120, 333)]
+
+    assert approximate.centroids is not None
+    assert [ids(r) for r in approximate.query_many(vectors, [None] * 3, top_k=10)] == [ids(r) for r in exact.query_many(vectors, [None] * 3, top_k=10)]
@@ -0,0 +1,59 @@
+import datetime
+
+import query_generation.query_generation as qg
+
+
+def rule_based_clubs(query):
+    return qg.MetadataFiltering(query).rule_based_clubs()
+
+
+def rule_based_years(query):
+    return qg.MetadataFiltering(query, today=datetime.date(2024, 10, 1)).rule_based_years()
+
+
+def test_known_clubs_are_confident():
+    assert rule_based_clubs('Arsenal FC results') == (['Arsenal'], 1.0)
+    assert rule_based_clubs('Chelsea vs Man Utd') == (['Chelsea', 'Manchester_United'], 1.0)
+
+
+def test_unknown_club_alongside_known_club_lowers_confidence():
+    clubs, confidence = rule_based_clubs('Manchester City vs Arsenal')
+
+    assert clubs == ['Arsenal']
+    assert confidence < 0.75
+
+
+def test_unknown_club_on_its_own_lowers_confidence():
+    assert rule_based_clubs('Leicester City top scorer') == ([], 0.5)
+
+
+def test_no_club_is_confident():
+    assert rule_based_clubs('Who scored the most goals?') == ([], 1.0)
+
+
+def test_club_extraction_falls_back_to_llm_for_unknown_club(monkeypatch):
+    monkeypatch.setattr(qg.ExternalInteractions, 'bedrock_interaction', staticmethod(lambda model, prompt: 'Manchester City, Arsenal'))
+
+    filtering = qg.MetadataFiltering('Manchester City vs Arsenal')
+    filtering.club_extraction(model='model', confidence_threshold=0.75)
+
+    assert filtering.clubs == 'Manchester City, Arsenal'
+
+
+def test_season_ranges():
+    assert rule_based_years('Arsenal in 2019-20') == (['2019'], 1.0)
+    assert rule_based_years('Arsenal in 2019–20') == (['2019'], 1.0)
+    assert rule_based_years('Arsenal in 19/20') == (['2019'], 0.9)
+
+
+def test_single_year_could_be_either_season():
+    assert rule_based_years('Arsenal top scorer 2022') == (['2021', '2022'], 0.8)
+
+
+def test_relative_seasons():
+    assert rule_based_years('Arsenal last season') == (['2023'], 0.9)
+    assert rule_based_years('Arsenal over the past three seasons') == (['2023', '2022', '2021'], 0.9)
+
+
+def test_unparsed_year_cue_is_not_confident():
+    assert rule_based_years('Arsenal in the 90s season')[1] == 0.3
@@ -0,0 +1,80 @@
+import pytest
+import query_generation.query_generation as qg
+
+
+class RecordingEncoder(qg.AbstractEncoder):
+
+    def __init__(self):
+        self.batches = []
+
+
+    def encode(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+
+def test_query_and_subqueries_are_encoded_in_one_call():
+    encoder = RecordingEncoder()
+    encoding = qg.QueryEncoding({'1': 'Leeds tries', '2': 'Bath tries'}, None, None, 'Who scored more?', encoder=encoder)
+    encoding.batch_encoding()
+
+    assert encoder.batches == [['Who scored more?', 'Leeds tries', 'Bath tries']]
+    assert encoding.user_query_vector == [16.0]
+    assert encoding.decomposition_vector_list == [[11.0], [10.0]]
+
+
+def test_existing_query_vector_is_not_encoded_again():
+    encoder = RecordingEncoder()
+    encoding = qg.QueryEncoding({}, None, None, 'Who won?', encoder=encoder)
+    encoding.user_query_vector = [1.0]
+    encoding.batch_encoding()
+
+    assert encoder.batches == []
+    assert encoding.decomposition_vector_list == []
+
+
+def test_huggingface_encoder_sends_one_request(monkeypatch):
+    payloads = []
+
+    def huggingface_query(payload, hf_api_url, hf_token, session=None):
+        payloads.append(payload)
+        return [[0.1], [0.2]]
+
+    monkeypatch.setattr(qg.ExternalInteractions, 'huggingface_query', staticmethod(huggingface_query))
+    encoder = qg.HuggingFaceEncoder(hf_api_url='url', hf_token='token')
+
+    assert encoder.encode(['a', 'b']) == [[0.1], [0.2]]
+    assert payloads == [{'inputs': ['a', 'b']}]
+
+    with pytest.raises(ValueError):
+        encoder.encode(['a', 'b', 'c'])
+
+
+def test_encoders_are_cached_per_backend(monkeypatch):
+    monkeypatch.setattr(qg.ResourceCache, 'entries', {})
+
+    first = qg.QueryEncoding.create_encoder('huggingface', hf_api_url='url', hf_token='token')
+
+    assert qg.QueryEncoding.create_encoder('huggingface', hf_api_url='url', hf_token='token') is first
+
+    with pytest.raises(ValueError):
+        qg.QueryEncoding.create_encoder('unknown')
+
+
+def test_each_backend_builds_an_encoder(monkeypatch, tmp_path):
+    models = pytest.importorskip('sentence_transformers.models')
+    from sentence_transformers import SentenceTransformer
+
+    monkeypatch.setattr(qg.ResourceCache, 'entries', {})
+    SentenceTransformer(modules=[models.BoW(vocab=['arsenal', 'chelsea', 'goals', 'season'])]).save(str(tmp_path))
+
+    local = qg.QueryEncoding.create_encoder('local', model_name=str(tmp_path))
+    vectors = local.encode(['Arsenal goals', 'Chelsea season'])
+
+    assert isinstance(local, qg.LocalEncoder)
+    assert [len(vector) for vector in vectors] == [4, 4]
+    assert vectors[0] != vectors[1]
+    assert isinstance(qg.QueryEncoding.create_encoder('huggingface', hf_api_url='url', hf_token='token'), qg.HuggingFaceEncoder)
+
+    with pytest.raises(ValueError):
+        qg.QueryEncoding.create_encoder('local-onnx', model_name=str(tmp_path))
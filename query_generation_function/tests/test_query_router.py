@@ -0,0 +1,67 @@
+import datetime
+import numpy as np
+import pytest
+import query_generation.query_generation as qg
+
+
+def route(query, encoder=None):
+    router = qg.QueryRouter(user_query=query, encoder=encoder, today=datetime.date(2024, 10, 1))
+    router.route(confidence_threshold=0.75)
+
+    return router
+
+
+@pytest.mark.parametrize('query, plan', [("Who was Chelsea's manager in 2016?", 'filtered'),
+                                         ('Who was Arsenal captain in the 2018-19 season?', 'filtered'),
+                                         ('Arsenal top scorer 2022', 'filtered'),
+                                         ('Liverpool league position last season', 'filtered'),
+                                         ('When did Jurgen Klopp join Liverpool?', 'filtered'),
+                                         ('How many goals did Harry Kane score?', 'direct'),
+                                         ('What was the score in the Champions League final?', 'direct'),
+                                         ('Harry Kane goals', 'direct')])
+def test_simple_queries(query, plan):
+    router = route(query)
+
+    assert router.complexity == 'simple'
+    assert router.plan == plan
+
+
+@pytest.mark.parametrize('query', ['Compare Arsenal and Chelsea defensive records over the last three seasons',
+                                   'Why did Manchester United struggle after Alex Ferguson retired?',
+                                   'How did Liverpool change their playing style between 2015 and 2020?',
+                                   'Arsenal vs Chelsea 2022',
+                                   'Arsenal and Chelsea top scorers',
+                                   'Who was the top scorer? Who had the most assists?',
+                                   'Explain the impact of injuries on Arsenal title challenges'])
+def test_complex_queries(query):
+    router = route(query)
+
+    assert router.complexity == 'complex'
+    assert router.plan == 'decomposition'
+
+
+@pytest.mark.parametrize('query', ["Who were Arsenal's top scorer and assist leader in 2022?",
+                                   'Which Arsenal players scored in the Europa League semi final against Valencia in 2019?',
+                                   'Tell me about the players Arsenal signed in the summer transfer window'])
+def test_unclear_queries_keep_the_full_pipeline_without_an_encoder(query):
+    router = route(query)
+
+    assert router.complexity is None
+    assert router.plan == 'decomposition'
+    assert router.reason == 'default'
+
+
+class KeywordEncoder(qg.AbstractEncoder):
+    '''Embeds queries by whether they read like a single lookup or an open question'''
+
+    def encode(self, texts):
+        return [np.asarray([0.0, 1.0] if any(word in text.lower() for word in ('tell', 'reasons', 'compare', 'struggle', 'impact', 'rivalry', 'spent', 'performed'))
+                           else [1.0, 0.0], dtype='float32') for text in texts]
+
+
+def test_classifier_decides_unclear_queries():
+    qg.ResourceCache.entries.clear()
+    router = route('Tell me about the players Arsenal signed in the summer transfer window', encoder=KeywordEncoder())
+
+    assert router.reason == 'classifier'
+    assert router.plan == 'decomposition'
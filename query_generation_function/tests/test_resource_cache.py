@@ -0,0 +1,125 @@
+import io
+import json
+import pytest
+import query_generation.query_generation as qg
+
+
+class CountingS3Client:
+
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+        self.calls = []
+
+
+    def head_object(self, Bucket, Key):
+        self.calls.append('head_object')
+        return {'ETag': self.etag}
+
+
+    def get_object(self, Bucket, Key):
+        self.calls.append('get_object')
+        return {'Body': io.BytesIO(json.dumps(self.body).encode('utf-8')), 'ETag': self.etag}
+
+
+class CountingSecretsClient:
+
+    def __init__(self):
+        self.calls = 0
+
+
+    def get_secret_value(self, SecretId):
+        self.calls += 1
+        return {'SecretString': json.dumps({'key': 'secret-for-{}'.format(SecretId)})}
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(qg.ResourceCache, 'entries', {})
+
+
+def age(key, seconds):
+    qg.ResourceCache.entries[key]['stored'] -= seconds
+
+
+def test_get_respects_ttl():
+    qg.ResourceCache.put(('item',), 'value')
+
+    assert qg.ResourceCache.get(('item',), ttl=60) == 'value'
+
+    age(('item',), 120)
+
+    assert qg.ResourceCache.get(('item',), ttl=60) is None
+    assert qg.ResourceCache.get(('item',)) == 'value'
+    assert qg.ResourceCache.get(('missing',)) is None
+
+
+def test_s3_json_skips_s3_within_ttl(monkeypatch):
+    s3 = CountingS3Client({'clubs': ['Leeds']}, '"v1"')
+    monkeypatch.setattr(qg.ResourceCache, 'client', staticmethod(lambda service_name, region_name=None: s3))
+
+    assert qg.ResourceCache.s3_json('bucket', 'lookup.json', ttl=300) == {'clubs': ['Leeds']}
+    assert qg.ResourceCache.s3_json('bucket', 'lookup.json', ttl=300) == {'clubs': ['Leeds']}
+    assert s3.calls == ['get_object']
+
+
+def test_s3_json_revalidates_etag_after_ttl(monkeypatch):
+    s3 = CountingS3Client({'clubs': ['Leeds']}, '"v1"')
+    monkeypatch.setattr(qg.ResourceCache, 'client', staticmethod(lambda service_name, region_name=None: s3))
+    cache_key = ('s3_json', 'bucket', 'lookup.json')
+
+    qg.ResourceCache.s3_json('bucket', 'lookup.json', ttl=300)
+    age(cache_key, 600)
+
+    # Unchanged ETag keeps the parsed copy and only costs a HEAD request
+    assert qg.ResourceCache.s3_json('bucket', 'lookup.json', ttl=300) == {'clubs': ['Leeds']}
+    assert s3.calls == ['get_object', 'head_object']
+
+    s3.body, s3.etag = {'clubs': ['Leeds', 'Bath']}, '"v2"'
+    age(cache_key, 600)
+
+    assert qg.ResourceCache.s3_json('bucket', 'lookup.json', ttl=300) == {'clubs': ['Leeds', 'Bath']}
+    assert s3.calls == ['get_object', 'head_object', 'head_object', 'get_object']
+
+
+def test_secrets_are_fetched_once_per_ttl(monkeypatch):
+    secrets = CountingSecretsClient()
+    monkeypatch.setattr(qg.ResourceCache, 'client', staticmethod(lambda service_name, region_name=None: secrets))
+
+    assert qg.ExternalInteractions.get_secret('pinecone') == 'secret-for-pinecone'
+    assert qg.ExternalInteractions.get_secret('pinecone') == 'secret-for-pinecone'
+    assert secrets.calls == 1
+
+    age(('secret', 'pinecone'), 7200)
+    qg.ExternalInteractions.get_secret('pinecone')
+
+    assert secrets.calls == 2
+
+
+def test_pinecone_index_handle_is_shared(monkeypatch):
+    created = []
+
+    class FakePinecone:
+
+        def __init__(self, api_key):
+            created.append(api_key)
+
+
+        def Index(self, name):
+            return ('index', name)
+
+    monkeypatch.setattr(qg, 'Pinecone', FakePinecone)
+
+    first = qg.ExternalInteractions.pinecone_index('api', 'rugby')
+    second = qg.ExternalInteractions.pinecone_index('api', 'rugby')
+
+    assert first is second
+    assert created == ['api']
+
+
+def test_boto3_clients_are_created_once(monkeypatch):
+    created = []
+    monkeypatch.setattr(qg.boto3, 'client', lambda service_name, region_name=None: created.append(service_name) or object())
+
+    assert qg.ResourceCache.client('s3') is qg.ResourceCache.client('s3')
+    assert created == ['s3']
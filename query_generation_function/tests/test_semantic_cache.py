@@ -0,0 +1,98 @@
+from unittest import mock
+
+import json
+import numpy as np
+import query_generation.query_generation as qg
+
+
+class ConstantEncoder(qg.AbstractEncoder):
+    '''Embeds every query identically, the worst case of queries differing only in season or club scoring above the threshold'''
+
+    def encode(self, texts):
+        return [np.ones(8, dtype='float32') for _ in texts]
+
+
+def semantic_cache(store, index_version='v1'):
+    return qg.SemanticCache(store=store, encoder=ConstantEncoder(), index_version=index_version)
+
+
+def test_exact_hit():
+    store = qg.InMemoryCacheStore()
+    semantic_cache(store).save('Arsenal top scorer 2022', 'Answer')
+
+    cache = semantic_cache(store)
+
+    assert cache.lookup('  arsenal TOP scorer 2022 ') == 'Answer'
+    assert cache.hit_type == 'exact'
+
+
+def test_semantic_hit_within_the_same_years_and_clubs():
+    store = qg.InMemoryCacheStore()
+    semantic_cache(store).save('Arsenal top scorer 2022', 'Answer')
+
+    cache = semantic_cache(store)
+
+    assert cache.lookup("Who was Arsenal's top scorer in 2022?") == 'Answer'
+    assert cache.hit_type == 'semantic'
+
+
+def test_no_semantic_hit_for_a_different_season_or_club():
+    store = qg.InMemoryCacheStore()
+    semantic_cache(store).save('Arsenal top scorer 2022', 'Answer')
+
+    assert semantic_cache(store).lookup('Arsenal top scorer 2021') is None
+    assert semantic_cache(store).lookup('Chelsea top scorer 2022') is None
+    assert semantic_cache(store).lookup('Arsenal and Chelsea top scorer 2022') is None
+
+
+def test_no_semantic_hit_when_the_rules_are_unsure():
+    store = qg.InMemoryCacheStore()
+    semantic_cache(store).save('Leicester City top scorer', 'Answer')
+
+    assert semantic_cache(store).lookup('Manchester City top scorer') is None
+
+
+def test_entries_from_another_index_version_are_misses():
+    store = qg.InMemoryCacheStore()
+    semantic_cache(store, index_version='v1').save('Arsenal top scorer 2022', 'Answer')
+
+    assert semantic_cache(store, index_version='v2').lookup("Arsenal's top scorer in 2022") is None
+    assert semantic_cache(store, index_version='v2').lookup('Arsenal top scorer 2022') is None
+
+
+def test_evicted_entries_leave_the_index():
+    store = qg.InMemoryCacheStore(max_entries=1)
+    semantic_cache(store).save('Arsenal top scorer 2022', 'First')
+    semantic_cache(store).save('Chelsea top scorer 2022', 'Second')
+
+    assert store.index.keys() == [qg.SemanticCache.cache_key('Chelsea top scorer 2022')]
+    assert semantic_cache(store).lookup("Arsenal's top scorer in 2022") is None
+
+
+def test_disk_store_shared_between_containers(tmp_path):
+    writer = qg.DiskCacheStore(directory=str(tmp_path))
+    reader = qg.DiskCacheStore(directory=str(tmp_path))
+
+    semantic_cache(writer).save('Arsenal top scorer 2022', 'First')
+    assert semantic_cache(reader).lookup("Arsenal's top scorer in 2022") == 'First'
+
+    semantic_cache(writer).save('Chelsea top scorer 2022', 'Second')
+
+    # Only the entry written since the last lookup is read to find candidates, the hit itself is read once more
+    with mock.patch.object(qg.json, 'load', wraps=json.load) as load:
+        assert semantic_cache(reader).lookup("Chelsea's top scorer in 2022") == 'Second'
+
+    assert load.call_count == 2
+
+
+def test_disk_store_drops_entries_removed_by_another_container(tmp_path):
+    writer = qg.DiskCacheStore(directory=str(tmp_path))
+    reader = qg.DiskCacheStore(directory=str(tmp_path))
+
+    semantic_cache(writer).save('Arsenal top scorer 2022', 'Answer')
+    assert semantic_cache(reader).lookup("Arsenal's top scorer in 2022") == 'Answer'
+
+    writer.delete(qg.SemanticCache.cache_key('Arsenal top scorer 2022'))
+
+    assert semantic_cache(reader).lookup("Arsenal's top scorer in 2022") is None
+    assert reader.index.keys() == []
@@ -0,0 +1,54 @@
+import pytest
+import query_generation.query_generation as qg
+import time
+
+
+def sleeping(seconds, result):
+    def stage():
+        time.sleep(seconds)
+        return result
+
+    return stage
+
+
+def failing():
+    raise RuntimeError('Bedrock unavailable')
+
+
+def test_stages_run_concurrently():
+    start = time.monotonic()
+    results = qg.StageRunner(max_workers=3).run_stages([('subqueries', sleeping(0.2, {'q': 1}), 5, True),
+                                                        ('years', sleeping(0.2, '2019'), 5, False),
+                                                        ('clubs', sleeping(0.2, 'Arsenal'), 5, False)])
+
+    assert results == {'subqueries': {'q': 1}, 'years': '2019', 'clubs': 'Arsenal'}
+    assert time.monotonic() - start < 0.5
+
+
+def test_stages_run_one_after_another_when_not_concurrent():
+    order = []
+    stages = [(name, lambda name=name: order.append(name) or name, 5, False) for name in ('years', 'clubs', 'entities')]
+
+    assert qg.StageRunner().run_stages(stages, concurrent=False) == {'years': 'years', 'clubs': 'clubs', 'entities': 'entities'}
+    assert order == ['years', 'clubs', 'entities']
+
+
+@pytest.mark.parametrize('concurrent', [True, False])
+def test_optional_stage_failure_falls_back_to_none(concurrent):
+    results = qg.StageRunner().run_stages([('years', sleeping(0, '2019'), 5, False), ('entities', failing, 5, False)], concurrent=concurrent)
+
+    assert results == {'years': '2019', 'entities': None}
+
+
+@pytest.mark.parametrize('concurrent', [True, False])
+def test_required_stage_failure_is_raised(concurrent):
+    with pytest.raises(RuntimeError):
+        qg.StageRunner().run_stages([('subqueries', failing, 5, True)], concurrent=concurrent)
+
+
+def test_timed_out_stage_does_not_hold_the_response():
+    start = time.monotonic()
+    results = qg.StageRunner().run_stages([('years', sleeping(0, '2019'), 0.1, False), ('entities', sleeping(1, 'late'), 0.1, False)])
+
+    assert results == {'years': '2019', 'entities': None}
+    assert time.monotonic() - start < 0.5
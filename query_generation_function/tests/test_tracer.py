@@ -0,0 +1,63 @@
+import json
+import pytest
+import query_generation.query_generation as qg
+
+
+@qg.traced('Example')
+def example(fail=False):
+    if fail:
+        raise ValueError('failed')
+
+    return 'done'
+
+
+@pytest.fixture(autouse=True)
+def no_active_tracer(monkeypatch):
+    monkeypatch.setattr(qg.Tracer, 'active', None)
+
+
+def emitted(capsys):
+    return json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+
+
+def test_calls_pass_through_without_a_tracer(capsys):
+    assert example() == 'done'
+
+    qg.Tracer.metric('Ignored', 1)
+    qg.Tracer.finish()
+
+    assert capsys.readouterr().out == ''
+
+
+def test_spans_and_metrics_are_emitted_as_one_emf_line(capsys):
+    qg.Tracer.start(request_id='req-1')
+    example()
+    example()
+    qg.Tracer.metric('ContextChunks', 12)
+    qg.Tracer.usage({'inputTokens': 900, 'outputTokens': 120})
+    qg.Tracer.finish()
+
+    line = emitted(capsys)
+    names = [metric['Name'] for metric in line['_aws']['CloudWatchMetrics'][0]['Metrics']]
+
+    assert line['Service'] == 'query-generation'
+    assert line['RequestId'] == 'req-1'
+    assert len(line['ExampleLatency']) == 2
+    assert line['ContextChunks'] == 12
+    assert (line['InputTokens'], line['OutputTokens']) == (900, 120)
+    assert {'ExampleLatency', 'ContextChunks', 'RequestLatency'} <= set(names)
+    assert 'Trace' not in line
+    assert qg.Tracer.active is None
+
+
+def test_errors_are_counted_and_traced(capsys):
+    qg.Tracer.start(trace=True)
+
+    with pytest.raises(ValueError):
+        example(fail=True)
+
+    qg.Tracer.finish()
+    line = emitted(capsys)
+
+    assert line['ExampleErrors'] == 1
+    assert [(span['name'], span['error']) for span in line['Trace']] == [('Example', True)]
@@ -0,0 +1,109 @@
+import pytest
+import query_generation.query_generation as qg
+import threading
+import time
+
+
+class SlowIndex:
+    '''Pinecone index stand-in returning one match per query, named after the query vector and namespace'''
+
+    def __init__(self, latency=0.1):
+        self.latency = latency
+        self.calls = []
+        self.lock = threading.Lock()
+
+
+    def query(self, vector, filter, namespace, top_k, include_metadata, timeout):
+        time.sleep(self.latency)
+
+        with self.lock:
+            self.calls.append({'vector': vector, 'filter': filter, 'namespace': namespace, 'include_metadata': include_metadata})
+
+        return {'matches': [{'id': '{}-{}'.format(vector[0], namespace), 'score': vector[0] + (int(namespace) if namespace else 0) / 10000}]}
+
+
+@pytest.fixture
+def index(monkeypatch):
+    index = SlowIndex()
+    handles = []
+
+    def pinecone_index(pinecone_api, pinecone_index):
+        handles.append(pinecone_index)
+        return index
+
+    monkeypatch.setattr(qg.ExternalInteractions, 'pinecone_index', staticmethod(pinecone_index))
+    index.handles = handles
+
+    return index
+
+
+def test_queries_share_one_handle_and_run_concurrently(index):
+    store = qg.PineconeVectorStore(pinecone_api='key', pinecone_index='index', max_workers=8)
+    start = time.monotonic()
+
+    responses = store.query_many(vectors=[[n] for n in range(6)], filters=[{}] * 6, top_k=5)
+
+    assert time.monotonic() - start < 0.4
+    assert [response['matches'][0]['id'] for response in responses] == ['{}-None'.format(n) for n in range(6)]
+    assert index.handles == ['index']
+
+
+def test_metadata_is_only_requested_when_configured(index):
+    qg.PineconeVectorStore(pinecone_api='key', pinecone_index='index', include_metadata=False).query_many(vectors=[[1]], filters=[{}])
+
+    assert index.calls[0]['include_metadata'] is False
+
+
+def test_build_context_list_keeps_responses_in_query_order(index):
+    retrieval = qg.VectorRetrieval(user_query_vector=[1], decomposition_vector_list=[[2]], years=None, clubs=None, entity_list=None,
+                                   vector_store=qg.PineconeVectorStore(pinecone_api='key', pinecone_index='index'))
+
+    retrieval.build_context_list()
+
+    assert [(description, response['matches'][0]['id']) for description, response in retrieval.query_responses] == [('original query', '1-None'), ('subqueries', '2-None')]
+    assert retrieval.retrieved_ids == ['1-None', '2-None']
+
+
+def test_partitioned_queries_search_each_season_and_merge(index):
+    store = qg.PineconeVectorStore(pinecone_api='key', pinecone_index='index')
+
+    responses = store.query_many(vectors=[[1], [2]], filters=[{'year': {'$in': ['2018', '2019']}}, {}], top_k=1, partitions=[['2018', '2019'], None])
+
+    assert sorted(call['namespace'] for call in index.calls if call['vector'] == [1]) == ['2018', '2019']
+    assert responses[0]['matches'] == [{'id': '1-2019', 'score': 1.2019}]
+    assert responses[1]['matches'][0]['id'] == '2-None'
+
+
+def test_unpartitioned_queries_search_every_season_namespace(index, monkeypatch):
+    monkeypatch.setattr(qg.ResourceCache, 'entries', {})
+    stats_calls = []
+    index.describe_index_stats = lambda: stats_calls.append(1) or {'namespaces': {'2019': {}, '2018': {}}}
+    store = qg.PineconeVectorStore(pinecone_api='key', pinecone_index='index', season_namespaces_only=True)
+
+    responses = store.query_many(vectors=[[1], [2]], filters=[{}, {}], top_k=5, partitions=[None, ['2018']])
+    store.query_many(vectors=[[3]], filters=[{}], top_k=5)
+
+    assert sorted(call['namespace'] for call in index.calls if call['vector'] == [1]) == ['2018', '2019']
+    assert [match['id'] for match in responses[0]['matches']] == ['1-2019', '1-2018']
+    assert [call['namespace'] for call in index.calls if call['vector'] == [2]] == ['2018']
+    assert len(stats_calls) == 1
+
+
+def test_chunks_in_several_seasons_are_merged_once():
+    responses = [{'matches': [{'id': 'a', 'score': 0.9}, {'id': 'b', 'score': 0.5}]}, {'matches': [{'id': 'a', 'score': 0.9}, {'id': 'c', 'score': 0.7}]}]
+
+    assert [match['id'] for match in qg.PineconeVectorStore.merge_responses(responses, top_k=5)['matches']] == ['a', 'c', 'b']
+
+
+def test_retrieval_queries_add_filters_and_season_partitions():
+    retrieval = qg.VectorRetrieval(user_query_vector=[0.1], decomposition_vector_list=[[0.2], [0.3]], years='2018, 2019', clubs='Arsenal',
+                                   entity_list='Bukayo Saka', vector_store=object(), partitioned_by_season=True)
+
+    queries = retrieval.retrieval_queries()
+
+    assert [query[0] for query in queries] == ['original query', 'subqueries', 'subqueries', 'years filter', 'clubs filter', 'entities filter']
+    assert queries[3][2:] == ({'year': {'$in': ['2018', '2019']}}, ['2018', '2019'])
+    assert queries[4][2:] == ({'club': {'$in': ['Arsenal']}}, None)
+    assert queries[5][2:] == ({'entities': {'$in': ['Bukayo Saka']}}, None)
+
+
@@ -1,4 +1,6 @@
 from abc import ABC, abstractmethod
+from botocore.config import Config
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import boto3
 import logging
@@ -18,24 +20,63 @@ class AbstractDataLoad(ABC):
 
 class S3DataLoad(AbstractDataLoad):
 
-    def __init__(self):
+    def __init__(self, max_workers=16):
         self.file_list = None
         self.directory_list = []
-        self.s3 = boto3.client('s3')
+        self.file_etags = {}
+        self.removed_keys = []
+        self.prefix = ''
+        self.suffix = None
+        self.max_workers = max_workers
+        self.s3 = boto3.client('s3', config=Config(max_pool_connections=max_workers))
 
-    def list_files(self, s3_bucket):
-        '''Lists files in given S3 bucket
+    def list_files(self, s3_bucket, prefix='', suffix=None):
+        '''Lists files in given S3 bucket, following continuation tokens past 1,000 keys
             
-            params - s3_bucket (str) : Name of S3 bucket'''
+            params - s3_bucket (str) : Name of S3 bucket
+                     prefix (str) : Only list keys starting with this prefix
+                     suffix (str) : Only keep keys ending with this suffix e.g. .pdf'''
         
+        self.prefix = prefix
+        self.suffix = suffix
+
         try:
-            self.file_list = self.s3.list_objects(Bucket = s3_bucket)
-            logging.info('S3 file list loaded')
+            paginator = self.s3.get_paginator('list_objects_v2')
+            contents = []
+
+            for page in paginator.paginate(Bucket = s3_bucket, Prefix = prefix):
+                contents.extend([i for i in page.get('Contents', []) if self.key_selected(i['Key'])])
+
+            self.file_list = {'Contents': contents}
+            logging.info('S3 file list loaded with {} files'.format(len(contents)))
         
         except:
             logging.error('Unable to obtain S3 file list')
             raise
 
+
+    def key_selected(self, key):
+        '''Checks a key against the prefix and suffix filters of the last listing
+            
+            params - key (str) : S3 object key'''
+
+        return key.startswith(self.prefix) and (self.suffix is None or key.endswith(self.suffix)) and not key.endswith('/')
+
+    
+    def select_changed_files(self, known_etags):
+        '''Keeps only files that are new or have changed since the last ingest and records files that have been removed
+            
+            params - known_etags (dict) : S3 key to ETag of previously ingested files'''
+
+        contents = self.file_list.get('Contents', [])
+        current_keys = set(i['Key'] for i in contents)
+
+        self.removed_keys = [key for key in known_etags if key not in current_keys and self.key_selected(key)]
+        self.file_list['Contents'] = [i for i in contents if known_etags.get(i['Key']) != i['ETag']]
+        self.file_etags = {i['Key']: i['ETag'] for i in self.file_list['Contents']}
+
+        logging.info("{} new or changed files, {} removed files".format(len(self.file_list['Contents']), len(self.removed_keys)))
+
     
     def create_tmp_directories(self):
         '''Creates directories in tmp directory to download files'''
@@ -47,19 +88,71 @@ class S3DataLoad(AbstractDataLoad):
 
 
         for j in self.directory_list:
-            os.mkdir('/tmp/{}'.format(j))
+            os.makedirs('/tmp/{}'.format(j), exist_ok=True)
+
+
+    def download_file(self, s3_bucket, key):
+        '''Downloads a single file into the temp directory
+            
+            params - s3_bucket (str) : Name of S3 bucket
+                     key (str) : S3 object key'''
+
+        try:
+            self.s3.download_file(s3_bucket, key, '/tmp/{}'.format(key))
+            logging.info("{} downloaded".format(key))
+        
+        except:
+            logging.error("Unable to download file {}".format(key))
         
     
     def load_data(self, s3_bucket):
-        '''Loads data from S3 and stores within a temp directory'''
+        '''Loads data from S3 and stores within a temp directory, downloading up to max_workers files at once
+            
+            params - s3_bucket (str) : Name of S3 bucket'''
 
-        for i in self.file_list['Contents']:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda i: self.download_file(s3_bucket, i['Key']), self.file_list['Contents']))
 
-            try:
-                self.s3.download_file(s3_bucket, i['Key'], '/tmp/{}'.format(i['Key']))
-                logging.info("{} downloaded".format(i['Key']))
+
+    def iterate_file_bytes(self, s3_bucket, max_pending=None):
+        '''Streams file contents straight from S3 without staging them in the temp directory. Yields (key, bytes) pairs as
+            downloads complete, with at most max_pending files held in memory
             
-            except:
-                logging.error("Unable to download file {}".format(i['Key']))
-   
-        
+            params - s3_bucket (str) : Name of S3 bucket
+                     max_pending (int) : Maximum files downloaded but not yet consumed, defaults to twice max_workers'''
+
+        max_pending = max_pending or 2 * self.max_workers
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+            keys = [i['Key'] for i in self.file_list['Contents']]
+
+            for key in keys:
+                if len(pending) >= max_pending:
+                    yield from self.completed_downloads(pending)
+
+                pending[executor.submit(lambda x: self.s3.get_object(Bucket=s3_bucket, Key=x)['Body'].read(), key)] = key
+
+            while pending:
+                yield from self.completed_downloads(pending)
+
+
+    def completed_downloads(self, pending):
+        '''Waits for at least one download to finish and yields every finished (key, bytes) pair
+            
+            params - pending (dict) : Download futures mapped to their key, finished futures are removed'''
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            key = pending.pop(future)
+
+            try:
+                data = future.result()
+
+            except Exception:
+                logging.error("Unable to download file {}".format(key))
+                continue
+
+            logging.info("{} downloaded".format(key))
+            yield key, data
@@ -0,0 +1,430 @@
+from abc import ABC, abstractmethod
+from botocore.exceptions import ClientError
+
+import boto3
+import data_vectorisation.vectorise as vec
+import hashlib
+import io
+import json
+import logging
+import numpy as np
+import os
+import threading
+import time
+import uuid
+
+
+class AbstractShardStore(ABC):
+
+    @abstractmethod
+    def create(self, key, body):
+        pass
+
+    @abstractmethod
+    def put(self, key, body):
+        pass
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def list_keys(self, prefix):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+
+class S3ShardStore(AbstractShardStore):
+
+    def __init__(self, bucket, prefix='ingest-shards'):
+        '''Coordination objects held in S3, shared by every ECS worker. Claims use conditional writes so only one worker
+            can create each claim object
+
+            params - bucket (str) : Name of S3 bucket
+                     prefix (str) : Key prefix for coordination objects'''
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = boto3.client('s3')
+
+    def s3_key(self, key):
+        return '{}/{}'.format(self.prefix, key)
+
+    def create(self, key, body):
+        '''Writes an object only if it does not already exist, returning whether it was created
+
+            params - key (str) : Object key below the prefix
+                     body (bytes) : Object contents'''
+
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self.s3_key(key), Body=body, IfNoneMatch='*')
+            return True
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+                return False
+
+            logging.error("Unable to create {}".format(key))
+            raise
+
+    def put(self, key, body):
+        self.s3.put_object(Bucket=self.bucket, Key=self.s3_key(key), Body=body)
+
+    def get(self, key):
+        '''Returns the contents of an object, or None if it does not exist
+
+            params - key (str) : Object key below the prefix'''
+
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=self.s3_key(key))['Body'].read()
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+
+            raise
+
+    def list_keys(self, prefix):
+        paginator = self.s3.get_paginator('list_objects_v2')
+        keys = []
+
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.s3_key(prefix)):
+            keys.extend(os.path.relpath(i['Key'], self.prefix) for i in page.get('Contents', []))
+
+        return keys
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.s3_key(key))
+
+
+class LocalShardStore(AbstractShardStore):
+
+    def __init__(self, directory):
+        '''Coordination files in a local directory, used by the local multi process mode. Claims are created with a hard
+            link, which fails if the file already exists
+
+            params - directory (str) : Directory for coordination files'''
+
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def write_tmp(self, key, body):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path(key), uuid.uuid4().hex)
+
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+
+        return tmp_path
+
+    def create(self, key, body):
+        tmp_path = self.write_tmp(key, body)
+
+        try:
+            os.link(tmp_path, self.path(key))
+            return True
+
+        except FileExistsError:
+            return False
+
+        finally:
+            os.remove(tmp_path)
+
+    def put(self, key, body):
+        os.replace(self.write_tmp(key, body), self.path(key))
+
+    def get(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def list_keys(self, prefix):
+        keys = []
+
+        for root, _, files in os.walk(self.directory):
+            keys.extend(os.path.relpath(os.path.join(root, file_name), self.directory) for file_name in files if not file_name.endswith('.tmp'))
+
+        return sorted(key for key in keys if key.startswith(prefix))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+
+        except FileNotFoundError:
+            pass
+
+        # Remove directories left empty, stopping at the store directory. Another worker may remove or write to them first
+        directory = os.path.dirname(self.path(key))
+
+        try:
+            while os.path.abspath(directory) != os.path.abspath(self.directory) and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+
+        except OSError:
+            pass
+
+
+class ShardCoordinator:
+
+    def __init__(self, store, worker_id=None, lease_seconds=900):
+        '''Splits an ingest into shards of S3 keys through a coordinator plan and lets workers claim, complete and finalise
+            them. A claim is renewed while its worker is alive, a claim that has not been renewed within lease_seconds is
+            taken over by the next worker to look for work
+
+            params - store (AbstractShardStore) : Store shared by every worker
+                     worker_id (str) : Identifies this worker in claims, defaults to the host name and process id
+                     lease_seconds (int) : Seconds without renewal before a claim can be taken over'''
+
+        self.store = store
+        self.worker_id = worker_id or '{}-{}'.format(os.uname().nodename, os.getpid())
+        self.lease_seconds = lease_seconds
+        self.plan = None
+        self.heartbeats = {}
+        self.claims = {}
+
+    @staticmethod
+    def shard_name(key, shard_by, shard_count):
+        '''Returns the shard for an S3 key, either its year directory and club or a hash bucket. The club is found the same
+            way as the club metadata, from any part of the file name
+
+            params - key (str) : S3 object key e.g. 2014/2014–15_Arsenal_F.C._season.pdf
+                     shard_by (str) : prefix or hash
+                     shard_count (int) : Number of hash buckets'''
+
+        if shard_by == 'hash':
+            return 'hash-{:04d}'.format(int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % shard_count)
+
+        club = vec.MetadataExtraction.club_select(os.path.basename(key)) or 'other'
+
+        return '{}-{}'.format(os.path.dirname(key) or 'root', club).replace('/', '-')
+
+    @staticmethod
+    def shard_files(contents, shard_by='prefix', shard_count=32):
+        '''Groups listed files into shards, largest first so the longest shards start earliest
+
+            params - contents (list) : S3 listing entries with Key, ETag and Size
+                     shard_by (str) : prefix or hash
+                     shard_count (int) : Number of hash buckets'''
+
+        shards = {}
+
+        for i in contents:
+            shards.setdefault(ShardCoordinator.shard_name(i['Key'], shard_by, shard_count), []).append({'Key': i['Key'], 'ETag': i['ETag'], 'Size': i.get('Size', 0)})
+
+        return sorted(({'id': name, 'files': files} for name, files in shards.items()),
+                      key=lambda shard: (-sum(i['Size'] for i in shard['files']), -len(shard['files']), shard['id']))
+
+    def run_key(self, key):
+        return '{}/{}'.format(self.plan['run_id'], key)
+
+    def load_plan(self):
+        '''Loads the plan of the ingest in progress, returning whether there is one'''
+
+        body = self.store.get('plan.json')
+        self.plan = json.loads(body) if body is not None else None
+
+        return self.plan is not None
+
+    def create_plan(self, contents, removed_keys, shard_by='prefix', shard_count=32):
+        '''Writes the plan for a new ingest. If another worker wrote a plan first, that plan is loaded instead
+
+            params - contents (list) : S3 listing entries of the new and changed files
+                     removed_keys (list) : S3 keys of documents deleted from the bucket
+                     shard_by (str) : prefix or hash
+                     shard_count (int) : Number of hash buckets'''
+
+        plan = {'run_id': uuid.uuid4().hex,
+                'created': time.time(),
+                'shards': self.shard_files(contents, shard_by, shard_count),
+                'removed_keys': list(removed_keys)}
+
+        if self.store.create('plan.json', json.dumps(plan).encode('utf-8')):
+            self.plan = plan
+            logging.info("Ingest plan {} created with {} shards".format(plan['run_id'], len(plan['shards'])))
+
+        else:
+            self.load_plan()
+            logging.info("Joined ingest plan {}".format(self.plan['run_id']))
+
+    def file_etags(self):
+        return {i['Key']: i['ETag'] for shard in self.plan['shards'] for i in shard['files']}
+
+    def completed_shards(self):
+        return set(os.path.basename(key)[:-len('.json')] for key in self.store.list_keys(self.run_key('done/')))
+
+    def pending_shards(self):
+        completed = self.completed_shards()
+
+        return [shard for shard in self.plan['shards'] if shard['id'] not in completed]
+
+    def finished(self):
+        '''Checks whether the run has been finalised, its marker outlives the rest of the run's objects'''
+
+        return self.store.get(self.run_key('finished.json')) is not None
+
+    def claim_key(self, name, attempt):
+        return self.run_key('claims/{}/{:04d}.json'.format(name, attempt))
+
+    def claim_attempts(self, name):
+        return sorted(int(os.path.basename(key).split('.')[0]) for key in self.store.list_keys(self.run_key('claims/{}/'.format(name))))
+
+    def holds_claim(self, name):
+        '''Checks this worker's claim is still the latest attempt, it is not once an expired claim has been taken over
+
+            params - name (str) : Shard id or finalise'''
+
+        attempts = self.claim_attempts(name)
+
+        return bool(attempts) and self.claims.get(name) == self.claim_key(name, attempts[-1])
+
+    def claim(self, name):
+        '''Claims a shard (or the finalise step), taking over an expired claim by creating the next attempt. Returns whether
+            this worker now holds the claim. Nothing can be claimed once the run has finished
+
+            params - name (str) : Shard id or finalise'''
+
+        if self.finished():
+            return False
+
+        attempts = self.claim_attempts(name)
+
+        if attempts:
+            claim = json.loads(self.store.get(self.claim_key(name, attempts[-1])) or b'{"renewed": 0}')
+
+            if time.time() - claim['renewed'] < self.lease_seconds:
+                return False
+
+            logging.warning("Claim on {} by {} has expired".format(name, claim.get('worker')))
+
+        key = self.claim_key(name, attempts[-1] + 1 if attempts else 0)
+
+        if not self.store.create(key, self.claim_body()):
+            return False
+
+        # The run may have finished and removed its shard records while this claim was being created
+        if self.finished():
+            self.store.delete(key)
+            return False
+
+        self.claims[name] = key
+        self.start_heartbeat(name, key)
+
+        return True
+
+    def claim_body(self):
+        return json.dumps({'worker': self.worker_id, 'renewed': time.time()}).encode('utf-8')
+
+    def start_heartbeat(self, name, key):
+        '''Renews a claim every third of the lease until release is called, or until another worker has taken it over
+
+            params - name (str) : Shard id or finalise
+                     key (str) : Claim key'''
+
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    if not self.holds_claim(name):
+                        logging.warning("Claim on {} has been taken over, no longer renewing".format(name))
+                        stop.set()
+                        break
+
+                    self.store.put(key, self.claim_body())
+
+                except:
+                    logging.error("Unable to renew claim on {}".format(name))
+
+        threading.Thread(target=renew, daemon=True).start()
+        self.heartbeats[name] = stop
+
+    def release(self, name):
+        if name in self.heartbeats:
+            self.heartbeats.pop(name).set()
+
+        self.claims.pop(name, None)
+
+    def claim_shard(self):
+        '''Returns the next pending shard this worker has claimed, or None when every pending shard is held by a live worker
+            or the run has finished'''
+
+        if self.finished():
+            return None
+
+        for shard in self.pending_shards():
+            if self.claim(shard['id']):
+                logging.info("{} claimed shard {} with {} files".format(self.worker_id, shard['id'], len(shard['files'])))
+                return shard
+
+        return None
+
+    def complete_shard(self, shard, rows, entities, embeddings):
+        '''Records the outcome of a shard for the finalise step and marks it complete, returning whether it was recorded.
+            A worker whose claim was taken over discards its results, the worker now holding the shard records them
+
+            params - shard (dict) : Shard from claim_shard
+                     rows (list) : [source, id, hash] of every ingested chunk
+                     entities (dict) : Chunk hash to entities extracted for this shard
+                     embeddings (dict) : Chunk hash to vector encoded for this shard'''
+
+        if not self.holds_claim(shard['id']):
+            logging.warning("{} no longer holds shard {}, discarding its results".format(self.worker_id, shard['id']))
+            self.release(shard['id'])
+            return False
+
+        embedding_hashes = list(embeddings)
+
+        if embedding_hashes:
+            buffer = io.BytesIO()
+            np.save(buffer, np.stack([embeddings[chunk_hash] for chunk_hash in embedding_hashes]).astype('float32'))
+            self.store.put(self.run_key('results/{}-embeddings.npy'.format(shard['id'])), buffer.getvalue())
+
+        result = {'rows': rows, 'entities': entities, 'embedding_hashes': embedding_hashes}
+
+        self.store.put(self.run_key('results/{}.json'.format(shard['id'])), json.dumps(result).encode('utf-8'))
+        self.store.create(self.run_key('done/{}.json'.format(shard['id'])), self.claim_body())
+        self.release(shard['id'])
+
+        logging.info("{} completed shard {}".format(self.worker_id, shard['id']))
+
+        return True
+
+    def results(self):
+        '''Yields (rows, entities, embeddings) for every completed shard'''
+
+        for shard in self.plan['shards']:
+            result = json.loads(self.store.get(self.run_key('results/{}.json'.format(shard['id']))))
+            embeddings = {}
+
+            if result['embedding_hashes']:
+                matrix = np.load(io.BytesIO(self.store.get(self.run_key('results/{}-embeddings.npy'.format(shard['id'])))))
+                embeddings = dict(zip(result['embedding_hashes'], matrix))
+
+            yield result['rows'], result['entities'], embeddings
+
+    def claim_finalise(self):
+        '''Claims the finalise step once every shard is complete, returning whether this worker should run it'''
+
+        return not self.pending_shards() and self.claim('finalise')
+
+    def finish(self):
+        '''Marks the run finished, then removes the plan and every other coordination object of the run so the next ingest
+            starts a new plan. The marker stops workers still holding this plan from claiming its shards again'''
+
+        self.store.create(self.run_key('finished.json'), self.claim_body())
+        self.release('finalise')
+
+        for key in self.store.list_keys(self.plan['run_id'] + '/'):
+            if key != self.run_key('finished.json'):
+                self.store.delete(key)
+
+        self.store.delete('plan.json')
+        logging.info("Ingest plan {} finished".format(self.plan['run_id']))
@@ -1,27 +1,85 @@
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
 from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pinecone.grpc import PineconeGRPC
 from sentence_transformers import SentenceTransformer
 
 import boto3
+import hashlib
+import io
 import json
 import logging
+import numpy as np
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pypdf
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zlib
 
 
 class PDFLoader:
 
-    def __init__(self):
+    def __init__(self, chunk_size=500, chunk_overlap=20):
         self.file_paths = []
         self.all_chunks = []
-        self.text_splitter = RecursiveCharacterTextSplitter(
-                                                            chunk_size=500,
-                                                            chunk_overlap=20,
-                                                            length_function=len,
-                                                            is_separator_regex=False,
-                                                        )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.text_splitter = PDFLoader.create_text_splitter(chunk_size, chunk_overlap)
+
+
+    @staticmethod
+    def create_text_splitter(chunk_size, chunk_overlap):
+        '''Creates the text splitter used to chunk PDF text
+            Params: chunk_size (int) - Maximum characters per chunk
+                    chunk_overlap (int) - Characters shared between neighbouring chunks'''
+
+        return RecursiveCharacterTextSplitter(
+                                            chunk_size=chunk_size,
+                                            chunk_overlap=chunk_overlap,
+                                            length_function=len,
+                                            is_separator_regex=False,
+                                        )
+
+
+    @staticmethod
+    def split_pdf(file_path, chunk_size, chunk_overlap):
+        '''Loads and splits a single PDF, run in a worker process
+            Params: file_path (str) - PDF filepath
+                    chunk_size (int) - Maximum characters per chunk
+                    chunk_overlap (int) - Characters shared between neighbouring chunks'''
+
+        loader = PyPDFLoader(file_path)
+
+        return loader.load_and_split(text_splitter=PDFLoader.create_text_splitter(chunk_size, chunk_overlap))
+
+
+    @staticmethod
+    def split_pdf_bytes(key, data, chunk_size, chunk_overlap):
+        '''Loads and splits a PDF held in memory, run in a worker process. Sources are given the filepath the file would have been
+            downloaded to, so metadata extraction works the same as for files loaded from the tmp directory
+            Params: key (str) - S3 key of the PDF
+                    data (bytes) - PDF contents
+                    chunk_size (int) - Maximum characters per chunk
+                    chunk_overlap (int) - Characters shared between neighbouring chunks'''
+
+        reader = pypdf.PdfReader(io.BytesIO(data))
+        source = '/tmp/{}'.format(key)
+
+        pages = [Document(page_content=page.extract_text(), metadata={'source': source, 'page': n}) for n, page in enumerate(reader.pages)]
+
+        return PDFLoader.create_text_splitter(chunk_size, chunk_overlap).split_documents(pages)
 
     
     def retrieve_file_paths(self):
@@ -36,26 +94,238 @@ class PDFLoader:
             raise
         
     
-    def load_and_split_pdfs(self):
-        '''Load pdfs into list object'''
+    def iterate_pdfs(self, processes=None, max_pending=None, files=None):
+        '''Parses PDFs in a process pool and yields each file's chunks as soon as it is split. At most max_pending files are
+            parsed ahead of the consumer, so memory stays bounded however many files there are
+            Params: processes (int) - Number of parsing processes, defaults to the number of CPUs
+                    max_pending (int) - Maximum files parsed but not yet consumed, defaults to twice the number of processes
+                    files (iterable) - (key, bytes) pairs streamed from S3, files in the tmp directory are parsed if not given'''
+
+        if files is None:
+            tasks = (('/tmp/{}/{}'.format(i[0], j), PDFLoader.split_pdf, ('/tmp/{}/{}'.format(i[0], j),)) for i in self.file_paths for j in i[1])
+        else:
+            tasks = ((key, PDFLoader.split_pdf_bytes, (key, data)) for key, data in files)
+
+        max_pending = max_pending or 2 * (processes or os.cpu_count())
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = {}
+
+            for file_path, function, args in tasks:
+                if len(pending) >= max_pending:
+                    yield from self.completed_pdfs(pending)
+
+                pending[executor.submit(function, *args, self.chunk_size, self.chunk_overlap)] = file_path
+
+            while pending:
+                yield from self.completed_pdfs(pending)
+
+
+    def completed_pdfs(self, pending):
+        '''Waits for at least one PDF to finish parsing and yields the chunks of every finished PDF
+            Params: pending (dict) - Parsing futures mapped to their filepath, finished futures are removed'''
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            file_path = pending.pop(future)
+
+            # The yield stays outside the try so closing the generator is not caught as a parsing failure
+            try:
+                chunks = future.result()
+
+            except Exception:
+                logging.error('Unable to load PDF {}'.format(file_path))
+                continue
+
+            yield chunks
+
+    
+    def load_and_split_pdfs(self, processes=None, files=None):
+        '''Load pdfs into list object, parsing files in parallel
+            Params: processes (int) - Number of parsing processes, defaults to the number of CPUs
+                    files (iterable) - (key, bytes) pairs streamed from S3, files in the tmp directory are parsed if not given'''
 
         try:
-            for i in self.file_paths:
-                for j in i[1]:
-                    loader = PyPDFLoader('/tmp/{}/{}'.format(i[0], j))
-                    chunks = loader.load_and_split(text_splitter=self.text_splitter)
-                    self.all_chunks.append(chunks)
+            for chunks in self.iterate_pdfs(processes=processes, files=files):
+                self.all_chunks.append(chunks)
         except:
             logging.error('Unable to load PDFs')
 
 
 
 
+class ChunkDeduplication:
+
+    mersenne_prime = (1 << 31) - 1
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.8, shingle_size=5, seed=1):
+        '''Finds exact and near duplicate chunks across the corpus, using a hash of the normalised text for exact duplicates
+            and MinHash signatures of word shingles with locality sensitive hashing for near duplicates. The first occurrence
+            is kept as the canonical chunk and the sources of its duplicates are merged into it. State is kept between calls
+            so duplicates are also found across streaming batches
+            Params: num_perm (int) - MinHash permutations, must be divisible by bands
+                    bands (int) - LSH bands, more bands surface less similar candidates
+                    threshold (float) - Minimum estimated Jaccard similarity of word shingles for a near duplicate
+                    shingle_size (int) - Words per shingle
+                    seed (int) - Seed for the MinHash permutations'''
+
+        generator = np.random.default_rng(seed)
+
+        self.a = generator.integers(1, self.mersenne_prime, num_perm, dtype=np.uint64)
+        self.b = generator.integers(0, self.mersenne_prime, num_perm, dtype=np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.exact = {} # Normalised text hash - canonical chunk hash
+        self.buckets = {} # (band, band signature) - canonical chunk hashes
+        self.signatures = {} # Canonical chunk hash - MinHash signature
+        self.sources = {} # Canonical chunk hash - its own source followed by the sources of its duplicates
+        self.late_sources = {} # Canonical chunk hash - sources of duplicates found after the canonical chunk was upserted
+        self.canonical_ids = {}
+        self.current = set()
+        self.duplicate_count = 0
+
+
+    @staticmethod
+    def normalise(text):
+        return re.sub(r'\s+', ' ', text.lower()).strip()
+
+
+    def signature(self, normalised_text):
+        '''Returns the MinHash signature of a chunk's word shingles
+            Params: normalised_text (str) - Normalised chunk text'''
+
+        words = normalised_text.split(' ')
+        shingles = [' '.join(words[x:x + self.shingle_size]) for x in range(max(1, len(words) - self.shingle_size + 1))]
+        hashes = np.fromiter(set(zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64)
+
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % self.mersenne_prime).min(axis=1).astype(np.uint32)
+
+
+    def near_duplicate(self, signature):
+        '''Returns the hash of the most similar canonical chunk sharing an LSH band with the signature, or None if no
+            candidate reaches the similarity threshold
+            Params: signature (ndarray) - MinHash signature'''
+
+        candidates = set()
+
+        for band in range(self.bands):
+            candidates.update(self.buckets.get((band, signature[band * self.rows:(band + 1) * self.rows].tobytes()), []))
+
+        best, best_similarity = None, self.threshold
+
+        for candidate in candidates:
+            similarity = float(np.mean(self.signatures[candidate] == signature))
+
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+
+        return best
+
+
+    def add_canonical(self, chunk_hash, signature):
+        self.signatures[chunk_hash] = signature
+
+        for band in range(self.bands):
+            self.buckets.setdefault((band, signature[band * self.rows:(band + 1) * self.rows].tobytes()), []).append(chunk_hash)
+
+
+    def deduplicate(self, all_chunks):
+        '''Returns the chunks with exact and near duplicates removed, keeping the list of lists structure from PDFLoader.
+            Duplicates of a chunk kept in this call are added to sources, duplicates of a chunk kept in an earlier call to late_sources
+            Params: all_chunks (list) - List of text chunks in document format from langchain loader'''
+
+        self.current = set()
+        deduplicated = []
+        total = 0
+
+        for documents in all_chunks:
+            kept = []
+
+            for document in documents:
+                total += 1
+                normalised_text = self.normalise(document.page_content)
+                exact_key = hashlib.sha256(normalised_text.encode('utf-8')).hexdigest()
+                canonical = self.exact.get(exact_key)
+
+                if canonical is None:
+                    signature = self.signature(normalised_text)
+                    canonical = self.near_duplicate(signature)
+
+                    if canonical is None:
+                        chunk_hash = IngestManifest.chunk_hash(document.page_content)
+                        self.exact[exact_key] = chunk_hash
+                        self.add_canonical(chunk_hash, signature)
+                        self.sources[chunk_hash] = [document.metadata['source']]
+                        self.current.add(chunk_hash)
+                        kept.append(document)
+                        continue
+
+                    self.exact[exact_key] = canonical
+
+                if canonical in self.current:
+                    self.sources[canonical].append(document.metadata['source'])
+                else:
+                    self.late_sources.setdefault(canonical, []).append(document.metadata['source'])
+
+                self.duplicate_count += 1
+
+            deduplicated.append(kept)
+
+        logging.info("{} of {} chunks removed as duplicates".format(total - sum(len(i) for i in deduplicated), total))
+
+        return deduplicated
+
+
+    def ingested_rows(self, chunks_df):
+        '''Returns the source, id and hash of each upserted chunk plus a row for every duplicate merged into it, so each
+            duplicate's document records the canonical id. Also records the ids of the canonical chunks for late duplicates
+            Params: chunks_df (DataFrame) - Upserted chunks'''
+
+        self.canonical_ids.update(zip(chunks_df['hash'], chunks_df['id']))
+
+        rows = [(source, vector_id, chunk_hash) for vector_id, chunk_hash in zip(chunks_df['id'], chunks_df['hash'])
+                for source in dict.fromkeys(self.sources.get(chunk_hash, [])[1:])]
+
+        return pd.concat([chunks_df[['source', 'id', 'hash']], pd.DataFrame(rows, columns=['source', 'id', 'hash'])], ignore_index=True)
+
+
+    def late_duplicates(self):
+        '''Returns (id, hash, previous sources, new sources) for canonical chunks that gained duplicates after they were upserted
+            and merges the new sources into them. Duplicates of chunks that were never upserted are dropped'''
+
+        late = []
+
+        for chunk_hash, late_sources in self.late_sources.items():
+            if chunk_hash in self.canonical_ids:
+                late.append((self.canonical_ids[chunk_hash], chunk_hash, list(dict.fromkeys(self.sources[chunk_hash])), list(dict.fromkeys(late_sources))))
+                self.sources[chunk_hash].extend(late_sources)
+
+        self.late_sources = {}
+
+        return late
+
+
+
+
 class EntityExtraction:
+
+    throttling_codes = ('ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException')
     
-    def __init__(self):
+    def __init__(self, max_workers=8, min_workers=1, max_retries=6, base_backoff=1, max_backoff=30):
         self.chunks_list = []
-        self.bedrock = boto3.client('bedrock-runtime')
+        self.bedrock = boto3.client('bedrock-runtime', config=Config(max_pool_connections=max_workers))
+        self.max_workers = max_workers
+        self.min_workers = min_workers
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.concurrency = max_workers
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
 
     
     def bedrock_interaction(self, model, prompt):
@@ -83,47 +353,164 @@ class EntityExtraction:
             raise
         
     
-    def entity_extraction(self, all_chunks, model):
-        '''Extract entities from chunks of text using AWS Bedrock
-            Params: all_chunks (list) - List of text chunks in document format from langchain loader'''
-        
-        for i in all_chunks:
-            for j in i:
+    def acquire_slot(self):
+        '''Waits until fewer than the current concurrency limit of requests are in flight'''
 
-                try:
-                    chunk = j.page_content
-                    source = j.metadata['source']
+        with self.condition:
+            while self.in_flight >= self.concurrency:
+                self.condition.wait()
+
+            self.in_flight += 1
+
+
+    def release_slot(self, outcome):
+        '''Frees a request slot and adapts the concurrency limit - halved on throttling, raised by one after a full window of successes
+            Params: outcome (str) - success, throttled or error'''
+
+        with self.condition:
+            self.in_flight -= 1
+
+            if outcome == 'throttled':
+                self.concurrency = max(self.min_workers, self.concurrency // 2)
+                self.successes = 0
+                logging.warning("Bedrock throttling, concurrency reduced to {}".format(self.concurrency))
+
+            elif outcome == 'success':
+                self.successes += 1
+
+                if self.successes >= self.concurrency and self.concurrency < self.max_workers:
+                    self.concurrency += 1
+                    self.successes = 0
+
+            self.condition.notify_all()
+
+
+    def rate_limited_interaction(self, model, prompt):
+        '''Sends a prompt to Bedrock within the adaptive concurrency limit, retrying throttled requests with jittered exponential backoff
+            Params: model (str) - Model ID for model in AWS Bedrock
+                    prompt (str) - Prompt to send the model'''
+
+        attempt = 0
+
+        while True:
+            self.acquire_slot()
+            outcome = 'error'
 
+            try:
+                bedrock_response = self.bedrock_interaction(model = model, prompt = prompt)
+                outcome = 'success'
+
+                return bedrock_response
+
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in self.throttling_codes or attempt >= self.max_retries:
+                    raise
+
+                outcome = 'throttled'
+
+            finally:
+                self.release_slot(outcome)
+
+            time.sleep(min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1))
+            attempt += 1
+
+
+    def single_chunk_entities(self, chunk, model):
+        '''Extracts entities from one chunk of text
+            Params: chunk (str) - Chunk text
+                    model (str) - Model ID for model in AWS Bedrock'''
+
+        prompt = '''Provide a comma separated list of unique entities (organisation, person, league, place etc.) found in this text:
+
+                    {}
+
+                    Output the requested results in the following format - entity 1, entity 2, entity 3, entity n'''.format(chunk)
+
+        bedrock_response = self.rate_limited_interaction(model = model, prompt = prompt)
+
+        return bedrock_response.split(', ')
+
+
+    def packed_chunk_entities(self, chunks, model):
+        '''Extracts entities from several chunks of text with one prompt, falling back to one prompt per chunk if the
+            response can't be parsed
+            Params: chunks (list) - Chunk texts
+                    model (str) - Model ID for model in AWS Bedrock'''
+
+        if len(chunks) == 1:
+            return [self.single_chunk_entities(chunks[0], model)]
 
-                    prompt = '''Provide a comma separated list of unique entities (organisation, person, league, place etc.) found in this text:
+        texts = '\n\n'.join(['Text {}:\n{}'.format(n + 1, chunk) for n, chunk in enumerate(chunks)])
 
-                                {}
+        prompt = '''Provide a list of unique entities (organisation, person, league, place etc.) found in each of the numbered texts below:
 
-                                Output the requested results in the following format - entity 1, entity 2, entity 3, entity n'''.format(chunk)
-                    
+                    {}
 
-                    bedrock_response = self.bedrock_interaction(model = model, prompt= prompt)
+                    Output only JSON with a key for every text number in the following format - {{"1": ["entity 1", "entity 2"], "2": ["entity 1", "entity n"]}}'''.format(texts)
 
-                    entities = bedrock_response.split(', ')
+        try:
+            bedrock_response = json.loads(self.rate_limited_interaction(model = model, prompt = prompt))
+
+            return [[str(entity) for entity in bedrock_response[str(n + 1)]] for n in range(len(chunks))]
+
+        except (ValueError, KeyError, TypeError):
+            logging.warning("Unable to parse packed entity response, extracting chunks individually")
+
+            return [self.single_chunk_entities(chunk, model) for chunk in chunks]
+
+    
+    def entity_extraction(self, all_chunks, model, chunks_per_prompt=1, entity_cache=None):
+        '''Extract entities from chunks of text using AWS Bedrock. Requests run concurrently within an adaptive limit and
+            chunks_list keeps the input order
+            Params: all_chunks (list) - List of text chunks in document format from langchain loader
+                    model (str) - Model ID for model in AWS Bedrock
+                    chunks_per_prompt (int) - Number of chunks packed into each prompt
+                    entity_cache (dict) - Chunk hash to entities from previous runs, only uncached chunks are sent to Bedrock and new results are added'''
+
+        documents = [[j.page_content, j.metadata['source']] for i in all_chunks for j in i]
+        entities = [None] * len(documents)
+
+        if entity_cache is not None:
+            hashes = [IngestManifest.chunk_hash(document[0]) for document in documents]
+            entities = [entity_cache.get(chunk_hash) for chunk_hash in hashes]
 
-                    self.chunks_list.append([chunk, source, entities])
+        pending = [x for x in range(len(documents)) if entities[x] is None]
+        groups = [pending[start:start + chunks_per_prompt] for start in range(0, len(pending), chunks_per_prompt)]
+        logging.info("Extracting entities for {} of {} chunks".format(len(pending), len(documents)))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.packed_chunk_entities, [documents[x][0] for x in group], model) for group in groups]
+
+            for group, future in zip(groups, futures):
+                try:
+                    for x, chunk_entities in zip(group, future.result()):
+                        entities[x] = chunk_entities
+
+                        if entity_cache is not None:
+                            entity_cache[hashes[x]] = chunk_entities
                 
                 except:
                     logging.error('Unable to extract entities')
 
+        for document, chunk_entities in zip(documents, entities):
+            if chunk_entities is not None:
+                self.chunks_list.append([document[0], document[1], chunk_entities])
+
 
 
 
 class MetadataExtraction:
 
-    def __init__(self, chunks_list):
+    def __init__(self, chunks_list, duplicate_sources=None):
 
         self.chunks_list = chunks_list
+        self.duplicate_sources = duplicate_sources
         self.metadata_list = []
         self.chunks_df = None
 
 
-    def club_select(self, source):
+    @staticmethod
+    def club_select(source):
         '''Method for matching clubs from source string
             Params: source (str) - source filepath'''
         
@@ -144,31 +531,62 @@ class MetadataExtraction:
             raise
     
 
+    def source_metadata(self, source):
+        '''Returns the year and club for a source filepath
+            Params: source (str) - source filepath'''
+
+        return os.path.dirname(source)[-4:], self.club_select(source)
+
+
+    def merged_metadata(self, chunk_hash, source):
+        '''Returns the sorted years and clubs of a chunk and every duplicate merged into it
+            Params: chunk_hash (str) - Content hash of the canonical chunk
+                    source (str) - source filepath of the canonical chunk'''
+
+        sources = (self.duplicate_sources or {}).get(chunk_hash) or [source]
+        metadata = [self.source_metadata(i) for i in dict.fromkeys(sources)]
+
+        return sorted(set(i[0] for i in metadata)), sorted(set(i[1] for i in metadata if i[1] is not None))
+
+
+    @staticmethod
+    def metadata_value(values):
+        '''Returns merged years or clubs as vector metadata, a single value when they all agree
+            Params: values (list) - Sorted years or clubs from merged_metadata'''
+
+        return values[0] if len(values) == 1 else list(values) or None
+
+
     def metadata_extraction(self):
         '''Extracts metadata from filepath'''
 
         for i in self.chunks_list:
             try:
-                chunk_year = os.path.dirname(i.source)[-4:]
-                club = self.club_select(i.source)
-
-                self.metadata_list.append([chunk_year, club])
+                self.metadata_list.append(list(self.source_metadata(i[1])))
             
             except:
                 logging.error("Unable to extract metadata for {}".format(i))
 
     
     def chunks_dataframe_creation(self):
-        '''Concatenates the chunks and metadata lists into a pandas dataframe and generates a unique id for each chunk'''
+        '''Concatenates the chunks and metadata lists into a pandas dataframe and generates a unique, content based id for each chunk'''
 
         try:
-            self.chunks_df = pd.DataFrame(self.chunks_list)
-            metadata_df = pd.DataFrame(self.metadata_list)
+            self.chunks_df = pd.DataFrame(self.chunks_list, columns=['chunk', 'source', 'entities'])
+            metadata_df = pd.DataFrame(self.metadata_list, columns=['year', 'club'])
+
+            self.chunks_df = pd.concat([self.chunks_df, metadata_df], axis=1)
 
-            self.chunks_df = pd.concat([self.chunks_df, metadata_df], ignore_index= True)
+            # Ids are based on chunk content so unchanged chunks keep their id between ingests
+            self.chunks_df['hash'] = self.chunks_df['chunk'].apply(IngestManifest.chunk_hash)
+            self.chunks_df['id'] = self.chunks_df['year'].astype(str) + '-' + self.chunks_df['club'] + '-' + self.chunks_df['hash'].str[:16]
+            self.chunks_df = self.chunks_df.drop_duplicates(subset='id').reset_index(drop=True)
 
-            self.chunks_df['rn'] = self.chunks_df.groupby(['year', 'club']).cumcount()+1
-            self.chunks_df['id'] = self.chunks_df['year'].astype(str) + '-' + self.chunks_df['club'] + '-' + self.chunks_df['rn'].astype(str)
+            # Chunks with duplicates removed by ChunkDeduplication carry the metadata of every source
+            if self.duplicate_sources is not None:
+                merged = [self.merged_metadata(chunk_hash, source) for chunk_hash, source in zip(self.chunks_df['hash'], self.chunks_df['source'])]
+                self.chunks_df['years'] = [i[0] for i in merged]
+                self.chunks_df['clubs'] = [i[1] for i in merged]
 
             logging.info("Chunks dataframe created")
 
@@ -182,16 +600,46 @@ class VectorGeneration:
 
     def __init__(self, chunks_df):
         self.chunks_df = chunks_df
+        self.vectors = None
 
     
-    def vector_generation(self, encoding_model):
-        '''Generates vectors for chunks in a given dataframe with the provide model
-            Params: encoding_model (str): Sentence Transformers model name'''
-        
-        model = SentenceTransformer(encoding_model)
+    def vector_generation(self, encoding_model, batch_size=64, processes=None, dtype='float32', embedding_cache=None, model=None):
+        '''Generates vectors for chunks in a given dataframe with the provide model. Vectors are stored in self.vectors as one
+            contiguous matrix, row i holding the vector for row i of chunks_df
+            Params: encoding_model (str): Sentence Transformers model name
+                    batch_size (int): Number of chunks encoded per batch
+                    processes (int): Number of encoding processes to spread across CPU cores, None or 1 encodes in this process
+                    dtype (str): float32 or float16 storage for the vector matrix
+                    embedding_cache (dict): Chunk hash to vector from previous runs with the same model, only uncached chunks are encoded and new vectors are added
+                    model (SentenceTransformer): Already loaded encoding_model to reuse across calls'''
 
         try:
-            self.chunks_df['vector'] = self.chunks_df['chunk'].apply(lambda x: model.encode(x))
+            chunks = self.chunks_df['chunk'].tolist()
+            hashes = self.chunks_df['hash'].tolist() if 'hash' in self.chunks_df else [IngestManifest.chunk_hash(chunk) for chunk in chunks]
+
+            cache = embedding_cache if embedding_cache is not None else {}
+            pending = [x for x in range(len(chunks)) if hashes[x] not in cache]
+            logging.info("Encoding {} of {} chunks".format(len(pending), len(chunks)))
+
+            if pending:
+                model = model or SentenceTransformer(encoding_model)
+                pending_chunks = [chunks[x] for x in pending]
+
+                if processes is not None and processes > 1:
+                    pool = model.start_multi_process_pool(target_devices=['cpu'] * processes)
+
+                    try:
+                        vectors = model.encode_multi_process(pending_chunks, pool, batch_size=batch_size)
+                    finally:
+                        model.stop_multi_process_pool(pool)
+
+                else:
+                    vectors = model.encode(pending_chunks, batch_size=batch_size, convert_to_numpy=True)
+
+                for x, vector in zip(pending, vectors):
+                    cache[hashes[x]] = np.asarray(vector, dtype='float32')
+
+            self.vectors = np.ascontiguousarray(np.stack([cache[chunk_hash] for chunk_hash in hashes]) if hashes else np.empty((0, 0)), dtype=dtype)
             logging.info("Vectors created")
         
         except:
@@ -202,11 +650,16 @@ class VectorGeneration:
 
 class PineconeUpsert:
 
-    def __init__(self, chunks_df):
+    def __init__(self, chunks_df, vectors, document_store=None):
 
         self.chunks_df = chunks_df
+        self.vectors = vectors
+        self.document_store = document_store
+        self.batch_results = []
+        self.upsert_summary = {}
 
     
+    @staticmethod
     def get_secret(secret_name):
 
         region_name = "eu-west-2"
@@ -230,59 +683,1262 @@ class PineconeUpsert:
         return json.loads(get_secret_value_response['SecretString'])['key']
     
     
-    def pinecone_upsert(self, pinecone_secret_name, index_name):
-        '''Upserts data from chunks_df into given pinecone index
-            Params: pinecone_api (str) - api key for pinecone instance
+    @staticmethod
+    def pinecone_index(pinecone_secret_name, index_name):
+        '''Creates a Pinecone index handle that can be shared across upserts
+            Params: pinecone_secret_name (str) - name of the secret holding the pinecone api key
                     index_name (str) - name of pinecone index'''
+
+        pinecone_api = PineconeUpsert.get_secret(pinecone_secret_name)
+
+        pc = PineconeGRPC(api_key=pinecone_api)
+
+        return pc.Index(index_name)
+
+
+    def upsert_columns(self):
+        '''Pulls each upsert column out of chunks_df once as a plain list, so batches are sliced without per-row lookups.
+            The merged years and clubs of deduplicated chunks are used when present'''
+
+        years = [MetadataExtraction.metadata_value(i) for i in self.chunks_df['years'].tolist()] if 'years' in self.chunks_df else self.chunks_df['year'].tolist()
+        clubs = [MetadataExtraction.metadata_value(i) for i in self.chunks_df['clubs'].tolist()] if 'clubs' in self.chunks_df else self.chunks_df['club'].tolist()
+
+        return {'id': self.chunks_df['id'].tolist(),
+                'year': years,
+                'club': clubs,
+                'entities': self.chunks_df['entities'].tolist(),
+                'chunk': self.chunks_df['chunk'].tolist()}
+
+
+    def batch_vectors(self, columns, rows):
+        '''Builds the (id, vector, metadata) tuples for the given rows. Chunk text is only kept in the metadata when there is
+            no document store to hold it
+            Params: columns (dict) - Columns from upsert_columns
+                    rows (ndarray) - Row numbers in the batch'''
+
+        embeds = self.vectors[rows].astype('float32', copy=False).tolist()
+        meta_batch = [{
+                "year" : columns['year'][r],
+                "club" : columns['club'][r],
+                "entities" : columns['entities'][r]
+            } for r in rows]
+
+        if self.document_store is None:
+            for metadata, r in zip(meta_batch, rows):
+                metadata['text'] = columns['chunk'][r]
+
+        return list(zip([columns['id'][r] for r in rows], embeds, meta_batch))
+
+
+    def partition_rows(self, columns, partition_by_season, default_namespace=False):
+        '''Returns (namespace, rows) pairs to upsert. When partitioned, each season's rows go to a namespace named after the
+            year from MetadataExtraction and unfiltered queries search every namespace. Rows merged from several seasons are
+            written to each of their seasons
+            Params: columns (dict) - Columns from upsert_columns
+                    partition_by_season (bool) - Write per season namespaces
+                    default_namespace (bool) - Also keep every row in the default namespace when partitioned, which doubles the
+                                               vectors stored and upserted'''
+
+        if not partition_by_season:
+            return [('', np.arange(len(columns['id'])))]
+
+        partitions = [('', np.arange(len(columns['id'])))] if default_namespace else []
+        season_rows = {}
+
+        for row, years in enumerate(columns['year']):
+            for year in (years if isinstance(years, list) else [years]):
+                season_rows.setdefault(str(year), []).append(row)
+
+        for year in sorted(season_rows):
+            partitions.append((year, np.array(season_rows[year])))
+
+        return partitions
+
+
+    def send_batch(self, index, batch):
+        '''Sends a batch as an asynchronous gRPC upsert. Errors raised while sending are returned in the future so they are
+            retried in the same way as failed requests
+            Params: index (GRPCIndex) - Pinecone index handle
+                    batch (dict) - Batch record with columns, rows and namespace'''
+
+        try:
+            batch['future'] = index.upsert(vectors=self.batch_vectors(batch['columns'], batch['rows']), namespace=batch['namespace'], async_req=True)
+
+        except Exception as e:
+            batch['future'] = Future()
+            batch['future'].set_exception(e)
+
+        batch['attempts'] += 1
+
+        return batch
+
+
+    def complete_batch(self, index, batch, max_retries, base_backoff):
+        '''Waits for a batch to finish, resending it with exponential backoff if it fails, and records its outcome
+            Params: index (GRPCIndex) - Pinecone index handle
+                    batch (dict) - Batch record returned by send_batch
+                    max_retries (int) - Resends allowed after the first attempt
+                    base_backoff (float) - Seconds to wait before the first resend, doubled for each further resend'''
+
+        result = {'batch': batch['batch'], 'namespace': batch['namespace'], 'size': len(batch['rows'])}
+
+        while True:
+            try:
+                response = batch['future'].result()
+                self.batch_results.append(dict(result, attempts=batch['attempts'], status='upserted', upserted_count=response.upserted_count))
+                return
+
+            except Exception as e:
+                if batch['attempts'] > max_retries:
+                    logging.error("Unable to upsert batch {} to Pinecone namespace '{}' after {} attempts".format(batch['batch'], batch['namespace'], batch['attempts']))
+                    self.batch_results.append(dict(result, attempts=batch['attempts'], status='failed', error=str(e)))
+                    return
+
+                logging.warning("Retrying batch {} after upsert error".format(batch['batch']))
+                time.sleep(base_backoff * 2 ** (batch['attempts'] - 1))
+                self.send_batch(index, batch)
+
+    
+    def pinecone_upsert(self, pinecone_secret_name, index_name, index=None, batch_size=100, max_in_flight=4, max_retries=3, base_backoff=1, partition_by_season=False,
+                        default_namespace=False):
+        '''Upserts data from chunks_df into given pinecone index. Batches are sent as parallel asynchronous gRPC requests,
+            failed batches are retried and the outcome of every batch is recorded in batch_results. Chunk text is written to
+            the document store first, so every vector a query can return already has its text
+            Params: pinecone_secret_name (str) - name of the secret holding the pinecone api key
+                    index_name (str) - name of pinecone index
+                    index (GRPCIndex) - existing index handle to reuse, a new one is created if not given
+                    batch_size (int) - vectors per upsert request
+                    max_in_flight (int) - upsert requests sent before waiting for the oldest to finish
+                    max_retries (int) - resends allowed for a failed batch
+                    base_backoff (float) - seconds before the first resend of a failed batch
+                    partition_by_season (bool) - write each vector to a namespace for its season instead of the default namespace
+                    default_namespace (bool) - also write every vector to the default namespace when partitioned'''
+        
+        if index is None:
+            index = self.pinecone_index(pinecone_secret_name, index_name)
+
+        self.batch_results = []
+
+        try:
+            columns = self.upsert_columns()
+            pending = deque()
+            batch_number = 0
+
+            if self.document_store is not None:
+                self.document_store.upsert(columns['id'], columns['chunk'])
+
+            for namespace, rows in self.partition_rows(columns, partition_by_season, default_namespace):
+                for start in range(0, len(rows), batch_size):
+                    if len(pending) >= max_in_flight:
+                        self.complete_batch(index, pending.popleft(), max_retries, base_backoff)
+
+                    batch = {'batch': batch_number, 'namespace': namespace, 'rows': rows[start:start + batch_size], 'attempts': 0, 'columns': columns}
+                    pending.append(self.send_batch(index, batch))
+                    batch_number += 1
+
+            while pending:
+                self.complete_batch(index, pending.popleft(), max_retries, base_backoff)
+
+            self.upsert_summary = {'batches': len(self.batch_results),
+                                   'upserted_vectors': sum(i.get('upserted_count', 0) for i in self.batch_results),
+                                   'retried_batches': sum(1 for i in self.batch_results if i['attempts'] > 1),
+                                   'failed_batches': [i['batch'] for i in self.batch_results if i['status'] == 'failed']}
+
+            logging.info("Upsert to Pinecone complete - {}".format(self.upsert_summary))
         
+        except:
+            logging.error("Unable to upsert to Pinecone")
+
+
+    def pinecone_delete(self, ids, pinecone_secret_name, index_name, batch_size=1000, partition_by_season=False):
+        '''Deletes vectors that are no longer part of any ingested document from the given pinecone index
+            Params: ids (list) - vector ids to delete
+                    pinecone_secret_name (str) - name of the secret holding the pinecone api key
+                    index_name (str) - name of pinecone index
+                    batch_size (int) - ids per delete request
+                    partition_by_season (bool) - delete from the season namespaces, every namespace in the index is used as
+                                                 deduplicated chunks can be in seasons other than the year at the start of their id'''
+
+        if not ids:
+            return
 
         pinecone_api = self.get_secret(pinecone_secret_name)
 
         pc = PineconeGRPC(api_key=pinecone_api)
         index = pc.Index(index_name)
 
+        try:
+            namespaces = list(index.describe_index_stats()['namespaces']) if partition_by_season else ['']
+
+            for namespace in namespaces:
+                for start in range(0, len(ids), batch_size):
+                    index.delete(ids=list(ids)[start:start + batch_size], namespace=namespace)
 
-        # Break into 100 entry chunks and batch upsert to Pinecone
+            if self.document_store is not None:
+                self.document_store.delete(ids)
+
+            logging.info("Deleted {} stale vectors from Pinecone".format(len(ids)))
+
+        except:
+            logging.error("Unable to delete stale vectors from Pinecone")
+            raise
+
+
+    @staticmethod
+    def pinecone_update_metadata(index, updates, partition_by_season=False, default_namespace=False):
+        '''Replaces the year and club metadata of vectors already in the index, used when later batches find duplicates of them.
+            Vectors are not copied into the namespaces of newly merged seasons
+            Params: index (GRPCIndex) - Pinecone index handle
+                    updates (list) - (id, metadata, previous years) for each vector
+                    partition_by_season (bool) - update the vector in the season namespaces it was written to
+                    default_namespace (bool) - the vector was also written to the default namespace when partitioned'''
 
         try:
-            start = 0
-            end = 99
-
-            while end <= len(self.chunks_df):
-                print(start, end)
-
-                ids_batch = [ self.chunks_df['id'][i] for i in range(start, end)]
-                embeds = [self.chunks_df['vector'][x] for x in range(start, end)]
-                meta_batch = [{
-                        "year" : self.chunks_df['year'][y],
-                        "club" : self.chunks_df['club'][y],
-                        "entities" : self.chunks_df['entities'][y],
-                        "text" : self.chunks_df['chunk'][y]
-                    } for y in range(start, end)]
-                to_upsert = list(zip(ids_batch, embeds, meta_batch))
-                index.upsert(vectors=to_upsert)
-
-                start = start + 100
-                end = end + 100
-
-                if end >= len(self.chunks_df):
-                    end = len(self.chunks_df)
-
-                    ids_batch = [ self.chunks_df['id'][i] for i in range(start, end)]
-                    embeds = [self.chunks_df['vector'][x] for x in range(start, end)]
-                    meta_batch = [{
-                            "year" : self.chunks_df['year'][y],
-                            "club" : self.chunks_df['club'][y],
-                            "entities" : self.chunks_df['entities'][y],
-                            "text" : self.chunks_df['chunk'][y]
-                        } for y in range(start, end)]
-                    to_upsert = list(zip(ids_batch, embeds, meta_batch))
-                    index.upsert(vectors=to_upsert)
-
-                    break
-
-            logging.info("Upsert to Pinecone complete")
-        
+            for vector_id, metadata, previous_years in updates:
+                namespaces = ([''] if default_namespace or not partition_by_season else []) + ([str(year) for year in previous_years] if partition_by_season else [])
+
+                for namespace in namespaces:
+                    index.update(id=vector_id, set_metadata=metadata, namespace=namespace)
+
+            logging.info("Updated metadata of {} vectors in Pinecone".format(len(updates)))
+
         except:
-            logging.error("Unable to upsert to Pinecone")
+            logging.error("Unable to update vector metadata in Pinecone")
+            raise
+
+
+
+
+class LocalVectorUpsert:
+
+    def __init__(self, chunks_df, vectors):
+
+        self.chunks_df = chunks_df
+        self.vectors = vectors
+
+
+    @staticmethod
+    def load_index(index_path):
+        '''Loads an on-disk local index, returning empty vectors and metadata if it does not exist yet
+            Params: index_path (str) - Directory holding vectors.npy and metadata.json'''
+
+        if not os.path.exists(os.path.join(index_path, 'metadata.json')):
+            return None, []
+
+        with open(os.path.join(index_path, 'metadata.json')) as f:
+            metadata = json.load(f)
+
+        return np.load(os.path.join(index_path, 'vectors.npy')), metadata
+
+
+    @staticmethod
+    def load_documents(index_path):
+        '''Loads the id to chunk text document store of a local index
+            Params: index_path (str) - Directory holding documents.json'''
+
+        if not os.path.exists(os.path.join(index_path, 'documents.json')):
+            return {}
+
+        with open(os.path.join(index_path, 'documents.json')) as f:
+            return json.load(f)
+
+
+    @staticmethod
+    def save_index(index_path, vectors, metadata, documents=None):
+        '''Writes the local index, replacing the previous files only once all new files are complete
+            Params: index_path (str) - Directory to hold vectors.npy, metadata.json and documents.json
+                    vectors (ndarray) - Vector matrix
+                    metadata (list) - Metadata for each row of the vector matrix
+                    documents (dict) - Vector id to chunk text, documents.json is left unchanged if not given'''
+
+        os.makedirs(index_path, exist_ok=True)
+
+        with open(os.path.join(index_path, 'vectors.npy.tmp'), 'wb') as f:
+            np.save(f, np.ascontiguousarray(vectors, dtype='float32'))
+
+        with open(os.path.join(index_path, 'metadata.json.tmp'), 'w') as f:
+            json.dump(metadata, f)
+
+        if documents is not None:
+            with open(os.path.join(index_path, 'documents.json.tmp'), 'w') as f:
+                json.dump(documents, f)
+
+            os.replace(os.path.join(index_path, 'documents.json.tmp'), os.path.join(index_path, 'documents.json'))
+
+        os.replace(os.path.join(index_path, 'vectors.npy.tmp'), os.path.join(index_path, 'vectors.npy'))
+        os.replace(os.path.join(index_path, 'metadata.json.tmp'), os.path.join(index_path, 'metadata.json'))
+
+
+    def local_upsert(self, index_path):
+        '''Upserts data from chunks_df into a local index, the format read by LocalVectorStore in the query function.
+            Rows with an existing id are replaced and new ids are appended, chunk text is kept in documents.json
+            Params: index_path (str) - Directory holding vectors.npy, metadata.json and documents.json'''
+
+        if len(self.chunks_df) == 0:
+            return
+
+        try:
+            vectors, metadata = self.load_index(index_path)
+            documents = self.load_documents(index_path)
+            rows = {m['id']: n for n, m in enumerate(metadata)}
+
+            columns = PineconeUpsert(chunks_df=self.chunks_df, vectors=None).upsert_columns()
+            documents.update(zip(columns['id'], columns['chunk']))
+
+            new_metadata = [{'id': vector_id, 'year': year, 'club': club, 'entities': entities}
+                            for vector_id, year, club, entities in zip(columns['id'], columns['year'], columns['club'], columns['entities'])]
+            new_vectors = np.asarray(self.vectors, dtype='float32')
+
+            if vectors is None:
+                vectors = np.empty((0, new_vectors.shape[1]), dtype='float32')
+
+            existing = [n for n, m in enumerate(new_metadata) if m['id'] in rows]
+            appended = [n for n, m in enumerate(new_metadata) if m['id'] not in rows]
+
+            for n in existing:
+                vectors[rows[new_metadata[n]['id']]] = new_vectors[n]
+                metadata[rows[new_metadata[n]['id']]] = new_metadata[n]
+
+            vectors = np.concatenate([vectors, new_vectors[appended]])
+            metadata = metadata + [new_metadata[n] for n in appended]
+
+            self.save_index(index_path, vectors, metadata, documents)
+            logging.info("Local upsert complete, {} replaced and {} added".format(len(existing), len(appended)))
+
+        except:
+            logging.error("Unable to upsert to local index")
+            raise
+
+
+    def local_delete(self, ids, index_path):
+        '''Deletes vectors that are no longer part of any ingested document from a local index
+            Params: ids (list) - vector ids to delete
+                    index_path (str) - Directory holding vectors.npy and metadata.json'''
+
+        vectors, metadata = self.load_index(index_path)
+
+        if not ids or vectors is None:
+            return
+
+        ids = set(ids)
+        keep = [n for n, m in enumerate(metadata) if m['id'] not in ids]
+        documents = {vector_id: text for vector_id, text in self.load_documents(index_path).items() if vector_id not in ids}
+
+        self.save_index(index_path, vectors[keep], [metadata[n] for n in keep], documents)
+        logging.info("Deleted {} stale vectors from local index".format(len(metadata) - len(keep)))
+
+
+    def local_update_metadata(self, updates, index_path):
+        '''Replaces the year and club metadata of vectors already in a local index
+            Params: updates (list) - (id, metadata, previous years) for each vector
+                    index_path (str) - Directory holding vectors.npy and metadata.json'''
+
+        vectors, metadata = self.load_index(index_path)
+
+        if not updates or vectors is None:
+            return
+
+        updates = {vector_id: new_metadata for vector_id, new_metadata, _ in updates}
+
+        for row in metadata:
+            row.update(updates.get(row['id'], {}))
+
+        self.save_index(index_path, vectors, metadata)
+        logging.info("Updated metadata of {} vectors in local index".format(len(updates)))
+
+
+
+
+class DocumentStore:
+
+    def __init__(self, bucket, prefix='document-store', max_workers=16, max_retries=8):
+        '''Id keyed store of chunk text, so the query function fetches only the text of its fused matches instead of receiving
+            it in every vector match. Text is packed into one immutable JSON shard per season and club, named by a hash of its
+            contents, and index.json maps each shard name to its current object. A change writes new shard objects and then
+            swaps the index with a conditional write, so readers never see a partly written shard and concurrent ingest workers
+            never overwrite each other's changes
+            Params: bucket (str) - S3 bucket for the document objects
+                    prefix (str) - Key prefix for the document objects, must match the query function
+                    max_workers (int) - Shards read and written at once
+                    max_retries (int) - Attempts to swap the index when another writer changed it at the same time'''
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.s3 = boto3.client('s3', config=Config(max_pool_connections=max_workers))
+
+
+    @staticmethod
+    def shard_name(vector_id):
+        '''Returns the shard of a vector id, its year and club without the content hash, the query function uses the same mapping
+            Params: vector_id (str) - Vector id'''
+
+        return vector_id.rsplit('-', 1)[0]
+
+
+    def index_key(self):
+        return '{}/index.json'.format(self.prefix)
+
+
+    def load_index(self):
+        '''Returns the shard name to object key mapping and the ETag to swap it with, None if there is no index yet'''
+
+        try:
+            s3_object = self.s3.get_object(Bucket=self.bucket, Key=self.index_key())
+            return json.loads(s3_object['Body'].read())['shards'], s3_object['ETag']
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return {}, None
+
+            raise
+
+
+    def write_shard(self, name, shard_key, documents, deleted_ids):
+        '''Applies changes to a shard and writes the result as a new object, returning its key, None if the shard is now empty,
+            or shard_key unchanged if the changes made no difference
+            Params: name (str) - Shard name
+                    shard_key (str) - Current shard object key, None for a new shard
+                    documents (dict) - Vector id to chunk text to add or replace
+                    deleted_ids (list) - Vector ids to remove'''
+
+        stored = json.loads(self.s3.get_object(Bucket=self.bucket, Key=shard_key)['Body'].read()) if shard_key else {}
+        updated = dict(stored, **documents)
+
+        for vector_id in deleted_ids:
+            updated.pop(vector_id, None)
+
+        if updated == stored:
+            return shard_key
+
+        if not updated:
+            return None
+
+        body = json.dumps(updated, sort_keys=True).encode('utf-8')
+        key = '{}/shards/{}-{}.json'.format(self.prefix, name, hashlib.sha256(body).hexdigest()[:16])
+        self.s3.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+        return key
+
+
+    def update(self, documents, deleted_ids):
+        '''Rewrites every affected shard and swaps them into the index, retrying from the new index if another writer swapped
+            it first. Shard objects replaced by the swap are deleted, queries holding an older index reload it when they miss
+            Params: documents (dict) - Vector id to chunk text to add or replace
+                    deleted_ids (list) - Vector ids to remove'''
+
+        changes = {}
+
+        for vector_id, text in documents.items():
+            changes.setdefault(self.shard_name(vector_id), ({}, []))[0][vector_id] = text
+
+        for vector_id in deleted_ids:
+            changes.setdefault(self.shard_name(vector_id), ({}, []))[1].append(vector_id)
+
+        try:
+            for attempt in range(self.max_retries):
+                shards, etag = self.load_index()
+
+                try:
+                    with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                        written = dict(zip(changes, executor.map(lambda name: self.write_shard(name, shards.get(name), *changes[name]), changes)))
+
+                    updated = {name: key for name, key in dict(shards, **written).items() if key is not None}
+
+                    if updated == shards:
+                        return
+
+                    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+                    self.s3.put_object(Bucket=self.bucket, Key=self.index_key(), Body=json.dumps({'shards': updated}), **condition)
+
+                except ClientError as e:
+                    # Another writer swapped the index first, or replaced a shard listed in the index that was read
+                    if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict', 'NoSuchKey', '412', '409', '404'):
+                        raise
+
+                    time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+                    continue
+
+                replaced = [{'Key': shards[name]} for name in written if shards.get(name) not in (None, written[name])]
+
+                if replaced:
+                    self.s3.delete_objects(Bucket=self.bucket, Delete={'Objects': replaced, 'Quiet': True})
+
+                logging.info("Document store updated with {} documents and {} deletions across {} shards".format(len(documents), len(deleted_ids), len(changes)))
+                return
+
+            raise RuntimeError("Unable to update the document store index after {} attempts".format(self.max_retries))
+
+        except:
+            logging.error("Unable to update document store")
+            raise
+
+
+    def upsert(self, ids, texts):
+        '''Adds or replaces chunk text
+            Params: ids (list) - Vector ids
+                    texts (list) - Chunk text for each id'''
+
+        self.update(dict(zip(ids, texts)), [])
+
+
+    def delete(self, ids):
+        '''Removes the text of deleted vectors
+            Params: ids (list) - Vector ids'''
+
+        self.update({}, list(ids))
+
+
+
+
+class EmbeddingCache:
+
+    def __init__(self, directory=None, dtype='float32'):
+        '''Chunk hash to vector cache held on disk. Vectors from the previous ingest are read from a memory mapped .npy matrix and
+            vectors added in this run are appended to a local file, so memory only holds the hash to row index and each batch
+            reads just the rows it looks up. Supports the dict operations the ingest stages use
+            Params: directory (str) - Local directory for the cache files, a new temporary directory if not given
+                    dtype (str) - Storage type of the vectors'''
+
+        self.directory = directory or tempfile.mkdtemp(prefix='embedding-cache-')
+        self.dtype = np.dtype(dtype)
+        self.rows = {}
+        self.matrix = None
+        self.dimension = None
+        self.appended = None
+        self.appended_rows = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+    def load(self, path, hashes):
+        '''Memory maps a matrix saved by save as the rows of the given hashes
+            Params: path (str) - Local path of the .npy matrix
+                    hashes (list) - Chunk hash of each matrix row'''
+
+        self.matrix = np.load(path, mmap_mode='r')
+        self.dimension = self.matrix.shape[1]
+        self.rows.update((chunk_hash, (False, row)) for row, chunk_hash in enumerate(hashes))
+
+
+    def __contains__(self, chunk_hash):
+        return chunk_hash in self.rows
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+    def __getitem__(self, chunk_hash):
+        appended, row = self.rows[chunk_hash]
+
+        if not appended:
+            return np.array(self.matrix[row], dtype=self.dtype)
+
+        self.appended.flush()
+        row_bytes = self.dimension * self.dtype.itemsize
+
+        return np.frombuffer(os.pread(self.appended.fileno(), row_bytes, row * row_bytes), dtype=self.dtype)
+
+
+    def __setitem__(self, chunk_hash, vector):
+        '''Appends a new vector. A hash already cached keeps its vector, the same chunk and model always give the same vector'''
+
+        if chunk_hash in self.rows:
+            return
+
+        vector = np.asarray(vector, dtype=self.dtype)
+
+        if self.appended is None:
+            self.dimension = self.dimension or len(vector)
+            self.appended = open(self.path('appended.bin'), 'w+b')
+
+        if len(vector) != self.dimension:
+            raise ValueError("Expected a vector of length {}, received {}".format(self.dimension, len(vector)))
+
+        self.appended.write(vector.tobytes())
+        self.rows[chunk_hash] = (True, self.appended_rows)
+        self.appended_rows += 1
+
+
+    def items(self):
+        return ((chunk_hash, self[chunk_hash]) for chunk_hash in self.rows)
+
+
+    def update(self, pairs):
+        for chunk_hash, vector in (pairs.items() if isinstance(pairs, dict) else pairs):
+            self[chunk_hash] = vector
+
+
+    def save(self, path, hashes, batch_size=4096):
+        '''Writes the vectors of the given hashes to a .npy matrix batch by batch, without loading the cache into memory
+            Params: path (str) - Local path for the matrix
+                    hashes (list) - Chunk hashes to write, in row order
+                    batch_size (int) - Rows copied at a time'''
+
+        matrix = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(len(hashes), self.dimension))
+
+        for start in range(0, len(hashes), batch_size):
+            matrix[start:start + batch_size] = np.stack([self[chunk_hash] for chunk_hash in hashes[start:start + batch_size]])
+
+        matrix.flush()
+        del matrix
+
+
+    def close(self):
+        '''Removes the cache files'''
+
+        if self.appended is not None:
+            self.appended.close()
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+
+
+class IngestManifest:
+
+    def __init__(self, bucket, key, cache_directory=None):
+        self.bucket = bucket
+        self.key = key
+        self.embeddings_key = os.path.splitext(key)[0] + '-embeddings.npy'
+        self.version_key = 'index-version.json'
+        self.s3 = boto3.client('s3')
+        self.documents = {}
+        self.entities = {}
+        self.embeddings = EmbeddingCache(directory=cache_directory)
+        self.encoding_model = None
+        self.stale_ids = []
+
+
+    @staticmethod
+    def chunk_hash(chunk):
+        '''Returns the content hash used to key chunk ids and caches
+            Params: chunk (str) - Chunk text'''
+
+        return hashlib.sha256(chunk.encode('utf-8')).hexdigest()
+
+
+    @staticmethod
+    def source_key(source):
+        '''Converts a chunk source filepath in the tmp directory back to its S3 key
+            Params: source (str) - source filepath'''
+
+        return os.path.relpath(source, '/tmp')
+
+
+    def load(self, encoding_model):
+        '''Loads the manifest of previously ingested documents, along with the entity and embedding caches, from S3.
+            Embeddings are discarded if they were generated by a different model
+            Params: encoding_model (str) - Sentence Transformers model name used for this ingest'''
+
+        try:
+            manifest = json.loads(self.s3.get_object(Bucket=self.bucket, Key=self.key)['Body'].read())
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                logging.info("No ingest manifest found, all documents will be ingested")
+                self.encoding_model = encoding_model
+                return
+
+            logging.error("Unable to load ingest manifest")
+            raise
+
+        self.documents = manifest['documents']
+        self.entities = manifest['entities']
+        self.encoding_model = manifest.get('encoding_model')
+
+        if self.encoding_model == encoding_model and manifest.get('embedding_hashes'):
+            self.s3.download_file(self.bucket, self.embeddings_key, self.embeddings.path('previous.npy'))
+            self.embeddings.load(self.embeddings.path('previous.npy'), manifest['embedding_hashes'])
+
+        self.encoding_model = encoding_model
+        logging.info("Ingest manifest loaded with {} documents".format(len(self.documents)))
+
+
+    def document_etags(self):
+        '''Returns the S3 key to ETag mapping of every ingested document'''
+
+        return {key: document['etag'] for key, document in self.documents.items()}
+
+
+    def update_documents(self, file_etags, removed_keys, chunks_df):
+        '''Records the chunks of re-ingested documents and collects the ids of vectors that are no longer part of any document.
+            Documents that produced no chunks keep their previous entry so they are retried on the next ingest
+            Params: file_etags (dict) - S3 key to ETag of the documents ingested in this run
+                    removed_keys (list) - S3 keys of documents deleted from the bucket
+                    chunks_df (DataFrame) - Chunks created in this run'''
+
+        for key in removed_keys:
+            self.stale_ids += self.documents.pop(key)['chunk_ids']
+
+        chunks_by_key = {}
+
+        for source, vector_id, chunk_hash in zip(chunks_df['source'], chunks_df['id'], chunks_df['hash']):
+            document = chunks_by_key.setdefault(self.source_key(source), {'chunk_ids': set(), 'chunk_hashes': set()})
+            document['chunk_ids'].add(vector_id)
+            document['chunk_hashes'].add(chunk_hash)
+
+        for key, etag in file_etags.items():
+            if key not in chunks_by_key:
+                logging.warning("No chunks created for {}, it will be retried on the next ingest".format(key))
+                continue
+
+            previous_ids = set(self.documents.get(key, {}).get('chunk_ids', []))
+            self.stale_ids += sorted(previous_ids - chunks_by_key[key]['chunk_ids'])
+
+            self.documents[key] = {'etag': etag,
+                                   'chunk_ids': sorted(chunks_by_key[key]['chunk_ids']),
+                                   'chunk_hashes': sorted(chunks_by_key[key]['chunk_hashes'])}
+
+        # Ids still used by another document are not stale
+        live_ids = set(vector_id for document in self.documents.values() for vector_id in document['chunk_ids'])
+        self.stale_ids = [vector_id for vector_id in dict.fromkeys(self.stale_ids) if vector_id not in live_ids]
+
+
+    def save(self):
+        '''Saves the manifest and caches to S3, dropping cache entries for chunks no longer in any document. A small index version
+            object derived from the live chunk hashes is written alongside, the query function uses it to invalidate cached answers'''
+
+        live_hashes = set(chunk_hash for document in self.documents.values() for chunk_hash in document['chunk_hashes'])
+
+        self.entities = {chunk_hash: entities for chunk_hash, entities in self.entities.items() if chunk_hash in live_hashes}
+
+        try:
+            embedding_hashes = [chunk_hash for chunk_hash in self.embeddings if chunk_hash in live_hashes]
+
+            if embedding_hashes:
+                self.embeddings.save(self.embeddings.path('saved.npy'), embedding_hashes)
+                self.s3.upload_file(self.embeddings.path('saved.npy'), self.bucket, self.embeddings_key)
+                os.remove(self.embeddings.path('saved.npy'))
+
+            manifest = {'documents': self.documents,
+                        'entities': self.entities,
+                        'encoding_model': self.encoding_model,
+                        'embedding_hashes': embedding_hashes}
+
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps(manifest))
+
+            index_version = {'version': hashlib.sha256(''.join(sorted(live_hashes)).encode('utf-8')).hexdigest()[:16],
+                             'documents': len(self.documents),
+                             'chunks': len(live_hashes),
+                             'updated': time.time()}
+
+            self.s3.put_object(Bucket=self.bucket, Key=self.version_key, Body=json.dumps(index_version))
+            logging.info("Ingest manifest saved, index version {}".format(index_version['version']))
+
+        except:
+            logging.error("Unable to save ingest manifest")
+            raise
+
+
+
+
+class ChunkStore:
+
+    column_types = {'chunk': pa.string(),
+                    'source': pa.string(),
+                    'entities': pa.list_(pa.string()),
+                    'year': pa.string(),
+                    'club': pa.string(),
+                    'hash': pa.string(),
+                    'id': pa.string(),
+                    'years': pa.list_(pa.string()),
+                    'clubs': pa.list_(pa.string())}
+
+    def __init__(self, directory, run_key, bucket=None, prefix='ingest-checkpoint'):
+        '''Columnar on-disk store for the data handed between ingest stages. Tables are written as Parquet and vectors as an
+            .npy matrix read back memory mapped, so later stages read them without holding a second copy in memory. A checkpoint
+            records the completed stages and streaming batches so a failed run resumes after the last one. When bucket is given
+            every file is also copied to S3 so a replacement task can resume
+            Params: directory (str) - Local directory for the store
+                    run_key (str) - Identifies the ingest input, a checkpoint from a different input is discarded
+                    bucket (str) - S3 bucket to mirror the store to, None keeps it local only
+                    prefix (str) - S3 key prefix for the mirrored files'''
+
+        self.directory = directory
+        self.run_key = run_key
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = boto3.client('s3') if bucket else None
+        self.completed_stages = []
+        self.parts = []
+        self.duplicate_sources = None
+
+
+    @staticmethod
+    def input_key(file_etags, removed_keys, encoding_model):
+        '''Returns a key identifying the documents and model of an ingest
+            Params: file_etags (dict) - S3 key to ETag of the documents being ingested
+                    removed_keys (list) - S3 keys of documents deleted from the bucket
+                    encoding_model (str) - Sentence Transformers model name'''
+
+        return hashlib.sha256(json.dumps([sorted(file_etags.items()), sorted(removed_keys), encoding_model]).encode('utf-8')).hexdigest()[:16]
+
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+    def s3_key(self, name):
+        return '{}/{}'.format(self.prefix, name)
+
+
+    def write_file(self, name, write):
+        '''Writes a store file through a temporary file so a crash never leaves a partial file, then mirrors it to S3
+            Params: name (str) - File name in the store
+                    write (function) - Writes the file contents to the path it is given'''
+
+        write(self.path(name) + '.tmp')
+        os.replace(self.path(name) + '.tmp', self.path(name))
+
+        if self.s3 is not None:
+            self.s3.upload_file(self.path(name), self.bucket, self.s3_key(name))
+
+
+    def write_json(self, name, data):
+        '''Writes a JSON store file
+            Params: name (str) - File name in the store
+                    data (object) - JSON serialisable data'''
+
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(data, f)
+
+        self.write_file(name, write)
+
+
+    def read_json(self, name):
+        with open(self.local_file(name)) as f:
+            return json.load(f)
+
+
+    def local_file(self, name):
+        '''Returns the local path of a store file, downloading it from S3 first when resuming on a new task
+            Params: name (str) - File name in the store'''
+
+        if self.s3 is not None and not os.path.exists(self.path(name)):
+            self.s3.download_file(self.bucket, self.s3_key(name), self.path(name) + '.tmp')
+            os.replace(self.path(name) + '.tmp', self.path(name))
+
+        return self.path(name)
+
+
+    def load_checkpoint(self):
+        '''Loads the checkpoint of an earlier attempt at the same ingest, starting a new store if there is none or it was
+            written for different input'''
+
+        os.makedirs(self.directory, exist_ok=True)
+        checkpoint = None
+
+        try:
+            if self.s3 is not None:
+                checkpoint = json.loads(self.s3.get_object(Bucket=self.bucket, Key=self.s3_key('checkpoint.json'))['Body'].read())
+
+            elif os.path.exists(self.path('checkpoint.json')):
+                with open(self.path('checkpoint.json')) as f:
+                    checkpoint = json.load(f)
+
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                logging.error("Unable to load ingest checkpoint")
+                raise
+
+        if checkpoint is None or checkpoint['run_key'] != self.run_key:
+            self.clear()
+            return
+
+        self.completed_stages = checkpoint['stages']
+        self.parts = checkpoint['parts']
+        logging.info("Resuming ingest after stages {} and {} streaming batches".format(self.completed_stages, len(self.parts)))
+
+
+    def completed(self, stage):
+        return stage in self.completed_stages
+
+
+    def checkpoint(self, stage=None):
+        '''Records a completed stage, or the streaming batches written so far when stage is None
+            Params: stage (str) - Completed stage'''
+
+        if stage is not None:
+            self.completed_stages.append(stage)
+
+        self.write_json('checkpoint.json', {'run_key': self.run_key, 'stages': self.completed_stages, 'parts': self.parts})
+
+
+    def clear(self):
+        '''Removes the store, called once the ingest it belongs to has been recorded in the manifest'''
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        self.completed_stages = []
+        self.parts = []
+
+        if self.s3 is not None:
+            self.s3.delete_object(Bucket=self.bucket, Key=self.s3_key('checkpoint.json'))
+
+
+    def write_table(self, name, columns):
+        '''Writes columns to a Parquet file with the store's column types
+            Params: name (str) - Table name
+                    columns (dict) - Column name to list of values'''
+
+        table = pa.table({column: pa.array(values, type=self.column_types[column]) for column, values in columns.items()})
+        self.write_file(name + '.parquet', partial(pq.write_table, table))
+
+
+    def read_table(self, name):
+        '''Reads a Parquet table through a memory map
+            Params: name (str) - Table name'''
+
+        return pq.read_table(self.local_file(name + '.parquet'), memory_map=True)
+
+
+    def save_split(self, all_chunks, duplicate_sources=None):
+        '''Checkpoints the split (and deduplicated) chunks
+            Params: all_chunks (list) - List of text chunks in document format from langchain loader
+                    duplicate_sources (dict) - Sources merged into each canonical chunk by ChunkDeduplication'''
+
+        documents = [j for i in all_chunks for j in i]
+        self.write_table('split', {'chunk': [i.page_content for i in documents], 'source': [i.metadata['source'] for i in documents]})
+
+        self.write_json('duplicates.json', duplicate_sources)
+        self.checkpoint('split')
+
+
+    def load_split(self):
+        '''Returns the checkpointed chunks in the list of lists format from PDFLoader, and sets duplicate_sources'''
+
+        table = self.read_table('split')
+        self.duplicate_sources = self.read_json('duplicates.json')
+
+        return [[Document(page_content=chunk, metadata={'source': source}) for chunk, source in zip(table['chunk'].to_pylist(), table['source'].to_pylist())]]
+
+
+    def save_entities(self, chunks_list):
+        '''Checkpoints the chunks with extracted entities
+            Params: chunks_list (list) - [chunk, source, entities] for each chunk from EntityExtraction'''
+
+        self.write_table('entities', {'chunk': [i[0] for i in chunks_list], 'source': [i[1] for i in chunks_list], 'entities': [i[2] for i in chunks_list]})
+        self.checkpoint('entities')
+
+
+    def load_entities(self):
+        '''Returns the checkpointed chunks with entities in the chunks_list format from EntityExtraction'''
+
+        table = self.read_table('entities')
+
+        return [list(i) for i in zip(table['chunk'].to_pylist(), table['source'].to_pylist(), table['entities'].to_pylist())]
+
+
+    def save_metadata(self, chunks_df):
+        '''Checkpoints the chunks dataframe from MetadataExtraction
+            Params: chunks_df (DataFrame) - Chunks with metadata and ids'''
+
+        self.write_table('metadata', {column: chunks_df[column].tolist() for column in chunks_df.columns})
+        self.checkpoint('metadata')
+
+
+    def load_metadata(self):
+        '''Returns the checkpointed chunks dataframe backed by the memory mapped Arrow columns rather than Python objects'''
+
+        return self.read_table('metadata').to_pandas(types_mapper=pd.ArrowDtype)
+
+
+    def save_vectors(self, vectors):
+        '''Checkpoints the vector matrix
+            Params: vectors (ndarray) - Vector matrix, row i holding the vector for row i of the metadata table'''
+
+        def write(path):
+            with open(path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(vectors))
+
+        self.write_file('vectors.npy', write)
+        self.checkpoint('vectors')
+
+
+    def load_vectors(self):
+        '''Returns the checkpointed vector matrix memory mapped, rows are read from disk as they are sliced'''
+
+        return np.load(self.local_file('vectors.npy'), mmap_mode='r')
+
+
+    def save_part(self, ingested_df):
+        '''Checkpoints the source, id and hash rows of a streaming batch once it has been upserted
+            Params: ingested_df (DataFrame) - Rows recorded for the manifest'''
+
+        name = 'part-{:05d}'.format(len(self.parts))
+        self.write_table(name, {column: ingested_df[column].tolist() for column in ('source', 'id', 'hash')})
+        self.parts.append(name)
+        self.checkpoint()
+
+
+    def load_parts(self):
+        '''Returns the rows of the streaming batches completed by earlier attempts'''
+
+        return [self.read_table(name).to_pandas() for name in self.parts]
+
+
+
+
+class StreamingIngest:
+
+    def __init__(self, pdf_loader, entity_extraction, entity_model, encoding_model, pinecone_secret_name, index_name, manifest=None, batch_size=256, processes=None, chunks_per_prompt=1, files=None, local_index_path=None, partition_by_season=False, default_namespace=False, deduplication=None, chunk_store=None, document_store=None):
+        self.pdf_loader = pdf_loader
+        self.document_store = document_store
+        self.deduplication = deduplication
+        self.chunk_store = chunk_store
+        self.completed_hashes = set()
+        self.partition_by_season = partition_by_season
+        self.default_namespace = default_namespace
+        self.local_index_path = local_index_path
+        self.files = files
+        self.entity_extraction = entity_extraction
+        self.entity_model = entity_model
+        self.encoding_model = encoding_model
+        self.pinecone_secret_name = pinecone_secret_name
+        self.index_name = index_name
+        self.manifest = manifest
+        self.batch_size = batch_size
+        self.processes = processes
+        self.chunks_per_prompt = chunks_per_prompt
+        self.ingested_chunks = []
+        self.batch_count = 0
+
+
+    def run(self):
+        '''Streams chunks from the PDF parsing pool through entity extraction, metadata, embedding and upsert in batches of
+            batch_size. Batches are processed while later PDFs are still being parsed and only one batch is held in memory. With a
+            chunk store each upserted batch is checkpointed, and chunks upserted by an earlier attempt are skipped'''
+
+        model = SentenceTransformer(self.encoding_model)
+        index = PineconeUpsert.pinecone_index(self.pinecone_secret_name, self.index_name) if self.local_index_path is None else None
+
+        if self.chunk_store is not None:
+            self.ingested_chunks = self.chunk_store.load_parts()
+
+            for part in self.ingested_chunks:
+                self.completed_hashes.update(part['hash'])
+
+                if self.deduplication is not None:
+                    self.deduplication.canonical_ids.update(zip(part['hash'], part['id']))
+
+        batch = []
+
+        for chunks in self.pdf_loader.iterate_pdfs(processes=self.processes, files=self.files):
+            batch.extend(chunks)
+
+            while len(batch) >= self.batch_size:
+                self.process_batch(batch[:self.batch_size], model, index)
+                batch = batch[self.batch_size:]
+
+        if batch:
+            self.process_batch(batch, model, index)
+
+        if self.deduplication is not None:
+            self.merge_late_duplicates(index)
+
+        logging.info("Streaming ingest complete, {} batches and {} chunks upserted".format(self.batch_count, sum(len(i) for i in self.ingested_chunks)))
+
+
+    def process_batch(self, documents, model, index):
+        '''Runs one batch of chunks through every stage after parsing
+            Params: documents (list) - Chunks in document format from langchain loader
+                    model (SentenceTransformer) - Loaded encoding model
+                    index (GRPCIndex) - Pinecone index handle, None when upserting to the local index'''
+
+        if self.deduplication is not None:
+            documents = self.deduplication.deduplicate([documents])[0]
+
+        if self.completed_hashes:
+            hashes = [IngestManifest.chunk_hash(document.page_content) for document in documents]
+            skipped = [chunk_hash for chunk_hash in hashes if chunk_hash in self.completed_hashes]
+            documents = [document for document, chunk_hash in zip(documents, hashes) if chunk_hash not in self.completed_hashes]
+
+            # Sources merged into chunks upserted by an earlier attempt are recorded against their existing ids
+            if self.deduplication is not None and skipped:
+                self.ingested_chunks.append(pd.DataFrame([(source, self.deduplication.canonical_ids[chunk_hash], chunk_hash) for chunk_hash in skipped
+                                                          for source in self.deduplication.sources[chunk_hash]], columns=['source', 'id', 'hash']))
+
+        if not documents:
+            return
+
+        self.entity_extraction.chunks_list = []
+        self.entity_extraction.entity_extraction(all_chunks=[documents], model=self.entity_model, chunks_per_prompt=self.chunks_per_prompt,
+                                                 entity_cache=self.manifest.entities if self.manifest else None)
+
+        metadata = MetadataExtraction(chunks_list=self.entity_extraction.chunks_list, duplicate_sources=self.deduplication.sources if self.deduplication else None)
+        metadata.metadata_extraction()
+        metadata.chunks_dataframe_creation()
+
+        vectors = VectorGeneration(chunks_df=metadata.chunks_df)
+        vectors.vector_generation(encoding_model=self.encoding_model, embedding_cache=self.manifest.embeddings if self.manifest else None, model=model)
+
+        if self.local_index_path is None:
+            upsert = PineconeUpsert(chunks_df=vectors.chunks_df, vectors=vectors.vectors, document_store=self.document_store)
+            upsert.pinecone_upsert(pinecone_secret_name=self.pinecone_secret_name, index_name=self.index_name, index=index, partition_by_season=self.partition_by_season,
+                                   default_namespace=self.default_namespace)
+            upserted = bool(upsert.upsert_summary) and not upsert.upsert_summary['failed_batches']
+        else:
+            upsert = LocalVectorUpsert(chunks_df=vectors.chunks_df, vectors=vectors.vectors)
+            upsert.local_upsert(index_path=self.local_index_path)
+            upserted = True
+
+        # Only the small identifying columns are kept for the manifest, with a row for each source merged into a chunk
+        if self.deduplication is not None:
+            self.ingested_chunks.append(self.deduplication.ingested_rows(vectors.chunks_df))
+        else:
+            self.ingested_chunks.append(vectors.chunks_df[['source', 'id', 'hash']])
+
+        # Batches with failed upserts are not checkpointed so a rerun sends them again
+        if self.chunk_store is not None and upserted:
+            self.chunk_store.save_part(self.ingested_chunks[-1])
+
+        self.batch_count += 1
+
+
+    def merge_late_duplicates(self, index):
+        '''Merges duplicates found in later batches into chunks that were already upserted, updating their year and club
+            metadata and recording the duplicates' sources against the canonical id for the manifest
+            Params: index (GRPCIndex) - Pinecone index handle, None when upserting to the local index'''
+
+        late = self.deduplication.late_duplicates()
+
+        if not late:
+            return
+
+        metadata = MetadataExtraction(chunks_list=[], duplicate_sources=self.deduplication.sources)
+        updates = []
+
+        for vector_id, chunk_hash, previous_sources, new_sources in late:
+            years, clubs = metadata.merged_metadata(chunk_hash, previous_sources[0])
+            updates.append((vector_id, {'year': metadata.metadata_value(years), 'club': metadata.metadata_value(clubs)}, sorted(set(metadata.source_metadata(i)[0] for i in previous_sources))))
+
+            self.ingested_chunks.append(pd.DataFrame([(source, vector_id, chunk_hash) for source in new_sources], columns=['source', 'id', 'hash']))
+
+        if self.local_index_path is None:
+            PineconeUpsert.pinecone_update_metadata(index, updates, partition_by_season=self.partition_by_season, default_namespace=self.default_namespace)
+        else:
+            LocalVectorUpsert(chunks_df=None, vectors=None).local_update_metadata(updates, index_path=self.local_index_path)
+
+
+    def ingested_chunks_df(self):
+        '''Returns the source, id and hash of every chunk upserted during the run'''
+
+        if not self.ingested_chunks:
+            return pd.DataFrame(columns=['source', 'id', 'hash'])
+
+        return pd.concat(self.ingested_chunks, ignore_index=True)
+
+
+
+
+class StagedIngest:
+
+    def __init__(self, pdf_loader, entity_extraction, entity_model, encoding_model, pinecone_secret_name, index_name, chunk_store, manifest=None, processes=None, encoding_processes=None, chunks_per_prompt=1, files=None, local_index_path=None, partition_by_season=False, default_namespace=False, deduplication=None, document_store=None):
+        self.pdf_loader = pdf_loader
+        self.document_store = document_store
+        self.entity_extraction = entity_extraction
+        self.entity_model = entity_model
+        self.encoding_model = encoding_model
+        self.pinecone_secret_name = pinecone_secret_name
+        self.index_name = index_name
+        self.chunk_store = chunk_store
+        self.manifest = manifest
+        self.processes = processes
+        self.encoding_processes = encoding_processes
+        self.chunks_per_prompt = chunks_per_prompt
+        self.files = files
+        self.local_index_path = local_index_path
+        self.partition_by_season = partition_by_season
+        self.default_namespace = default_namespace
+        self.deduplication = deduplication
+        self.ingested_chunks = None
+
+
+    def run(self):
+        '''Runs each stage over the whole corpus, checkpointing its output to the chunk store so a failed run resumes after
+            the last completed stage. Embedding and upsert read the Arrow backed metadata table and the memory mapped vectors
+            from the store instead of in memory Python objects'''
+
+        store = self.chunk_store
+
+        if store.completed('split'):
+            self.pdf_loader.all_chunks = store.load_split()
+
+            if self.deduplication is not None and store.duplicate_sources is not None:
+                self.deduplication.sources = store.duplicate_sources
+
+        else:
+            self.pdf_loader.load_and_split_pdfs(processes=self.processes, files=self.files)
+
+            if self.deduplication is not None:
+                self.pdf_loader.all_chunks = self.deduplication.deduplicate(self.pdf_loader.all_chunks)
+
+            store.save_split(self.pdf_loader.all_chunks, duplicate_sources=self.deduplication.sources if self.deduplication else None)
+
+        if store.completed('entities'):
+            self.entity_extraction.chunks_list = store.load_entities()
+
+        else:
+            self.entity_extraction.entity_extraction(all_chunks=self.pdf_loader.all_chunks, model=self.entity_model, chunks_per_prompt=self.chunks_per_prompt,
+                                                     entity_cache=self.manifest.entities if self.manifest else None)
+            store.save_entities(self.entity_extraction.chunks_list)
+
+        self.pdf_loader.all_chunks = []
+
+        if not store.completed('metadata'):
+            metadata = MetadataExtraction(chunks_list=self.entity_extraction.chunks_list, duplicate_sources=self.deduplication.sources if self.deduplication else None)
+            metadata.metadata_extraction()
+            metadata.chunks_dataframe_creation()
+            store.save_metadata(metadata.chunks_df)
+
+        self.entity_extraction.chunks_list = []
+        chunks_df = store.load_metadata()
+
+        vectors = VectorGeneration(chunks_df=chunks_df)
+
+        if not store.completed('vectors'):
+            vectors.vector_generation(encoding_model=self.encoding_model, batch_size=64, processes=self.encoding_processes,
+                                      embedding_cache=self.manifest.embeddings if self.manifest else None)
+
+            if vectors.vectors is None:
+                raise RuntimeError("Vector generation failed, rerun to resume from the metadata checkpoint")
+
+            store.save_vectors(vectors.vectors)
+
+        vectors.vectors = store.load_vectors()
+
+        # Caches filled by an earlier attempt are restored from the store so the manifest keeps them
+        if self.manifest:
+            self.manifest.entities.update(zip(chunks_df['hash'].tolist(), chunks_df['entities'].tolist()))
+            self.manifest.embeddings.update(zip(chunks_df['hash'].tolist(), vectors.vectors))
+
+        if not store.completed('upserted'):
+            if self.local_index_path is None:
+                upsert = PineconeUpsert(chunks_df=chunks_df, vectors=vectors.vectors, document_store=self.document_store)
+                upsert.pinecone_upsert(pinecone_secret_name=self.pinecone_secret_name, index_name=self.index_name, batch_size=100, max_in_flight=4, partition_by_season=self.partition_by_season,
+                                       default_namespace=self.default_namespace)
+                upserted = bool(upsert.upsert_summary) and not upsert.upsert_summary['failed_batches']
+
+            else:
+                LocalVectorUpsert(chunks_df=chunks_df, vectors=vectors.vectors).local_upsert(index_path=self.local_index_path)
+                upserted = True
+
+            if not upserted:
+                logging.error("Upsert incomplete, the chunk store is kept so a rerun resumes from the upsert stage")
+                raise RuntimeError("Upsert incomplete")
+
+            store.checkpoint('upserted')
 
+        self.ingested_chunks = self.deduplication.ingested_rows(chunks_df) if self.deduplication is not None else chunks_df[['source', 'id', 'hash']]
+        logging.info("Staged ingest complete, {} chunks upserted".format(len(chunks_df)))
@@ -1,37 +1,231 @@
 import data_load.data_load as dl
+import data_sharding.sharding as sh
 import data_vectorisation.vectorise as vec
+import logging
+import multiprocessing
+import os
+import pandas as pd
 
-def main():
 
-  # Load data from S3 bucket to temp file
+ENCODING_MODEL = 'BAAI/bge-small-en-v1.5' # Must match the model used to encode queries
+INCREMENTAL = True # Only re-ingest documents that are new or changed since the last run
+STREAMING = True # Stream chunks through every stage in bounded batches instead of materialising the whole corpus
+STREAMING_BATCH_SIZE = 256 # Chunks per streaming batch
+STREAM_FROM_S3 = True # Pass PDF bytes from S3 straight to the parser instead of downloading to the tmp directory
+DOWNLOAD_WORKERS = 16 # Concurrent S3 downloads
+VECTOR_BACKEND = 'pinecone' # pinecone, or local to write the in process index read by the query function
+LOCAL_INDEX_PATH = 'local_index' # Directory for vectors.npy and metadata.json when using the local backend
+PARTITION_BY_SEASON = True # Write each vector to a Pinecone namespace for its season instead of the default namespace, the local index partitions by season when loaded
+DEFAULT_NAMESPACE_COPY = False # Also keep every vector in the default namespace when partitioned, doubling index storage and upsert volume so unfiltered queries need one namespace instead of one per season
+DEDUPLICATE = True # Drop exact and near duplicate chunks before entity extraction, merging their sources into the chunk that is kept
+DEDUP_THRESHOLD = 0.8 # Estimated word shingle similarity above which chunks are treated as duplicates
+CHUNK_STORE_PATH = 'chunk_store' # Directory for the Parquet and memory mapped vector checkpoints written between stages
+CHUNK_STORE_BUCKET = 'rag-training-lookup' # Bucket the checkpoints are mirrored to so a replacement task resumes, None keeps them local
+SHARDING = os.environ.get('INGEST_SHARDING', 'off') # off, ecs for workers coordinating through S3, or local to run LOCAL_WORKERS processes
+SHARD_BY = 'prefix' # prefix to shard by year directory and club, or hash to spread keys evenly over SHARD_COUNT shards
+SHARD_COUNT = 32 # Shards when sharding by hash
+SHARD_LEASE = 900 # Seconds without a heartbeat before another worker takes over a shard
+LOCAL_WORKERS = 4 # Worker processes in local sharding mode
+LOCAL_SHARD_PATH = 'shard_store' # Directory for coordination files in local sharding mode
+DOCUMENT_STORE = True # Keep chunk text in an id keyed document store in S3 instead of Pinecone metadata, the local backend always uses documents.json
+
+
+def create_document_store():
+
+  if DOCUMENT_STORE and VECTOR_BACKEND != 'local':
+    return vec.DocumentStore(bucket = 'rag-training-lookup')
 
-  s3_data_load = dl.S3DataLoad()
-  s3_data_load.list_files(s3_bucket='')
-  s3_data_load.create_tmp_directories()
-  s3_data_load.load_data(s3_bucket='')
+  return None
 
 
-  # Convert PDF data to vectors and upsert to Pinecone database
+def run_pipeline(s3_data_load, manifest, chunk_store):
+  '''Loads, splits, extracts, embeds and upserts the files selected in s3_data_load, returning the source, id and hash of every ingested chunk'''
+
+  if STREAM_FROM_S3:
+    files = s3_data_load.iterate_file_bytes(s3_bucket='')
+
+  else:
+    s3_data_load.create_tmp_directories()
+    s3_data_load.load_data(s3_bucket='')
+    files = None
 
   pdf = vec.PDFLoader()
-  pdf.retrieve_file_paths()
-  pdf.load_and_split_pdfs()
 
-  entities = vec.EntityExtraction()
-  entities.entity_extraction(all_chunks=pdf.all_chunks, model ='anthropic.claude-3-haiku-20240307-v1:0')
+  if not STREAM_FROM_S3:
+    pdf.retrieve_file_paths()
+
+  entities = vec.EntityExtraction(max_workers = 16)
+  deduplication = vec.ChunkDeduplication(threshold = DEDUP_THRESHOLD) if DEDUPLICATE else None
+  document_store = create_document_store()
+
+  if STREAMING:
+    streaming = vec.StreamingIngest(pdf_loader = pdf, entity_extraction = entities, entity_model = 'anthropic.claude-3-haiku-20240307-v1:0', encoding_model = ENCODING_MODEL,
+                                    pinecone_secret_name = '', index_name = '', manifest = manifest, batch_size = STREAMING_BATCH_SIZE, files = files,
+                                    local_index_path = LOCAL_INDEX_PATH if VECTOR_BACKEND == 'local' else None, partition_by_season = PARTITION_BY_SEASON, default_namespace = DEFAULT_NAMESPACE_COPY,
+                                    deduplication = deduplication, chunk_store = chunk_store, document_store = document_store)
+    streaming.run()
+
+    return streaming.ingested_chunks_df()
+
+  staged = vec.StagedIngest(pdf_loader = pdf, entity_extraction = entities, entity_model = 'anthropic.claude-3-haiku-20240307-v1:0', encoding_model = ENCODING_MODEL,
+                            pinecone_secret_name = '', index_name = '', chunk_store = chunk_store, manifest = manifest, encoding_processes = os.cpu_count(), files = files,
+                            local_index_path = LOCAL_INDEX_PATH if VECTOR_BACKEND == 'local' else None, partition_by_season = PARTITION_BY_SEASON, default_namespace = DEFAULT_NAMESPACE_COPY,
+                            deduplication = deduplication, document_store = document_store)
+  staged.run()
+
+  return staged.ingested_chunks
+
+
+def record_ingest(manifest, file_etags, removed_keys, ingested_chunks_df):
+  '''Removes vectors for deleted and changed chunks, then saves the manifest'''
+
+  manifest.update_documents(file_etags = file_etags, removed_keys = removed_keys, chunks_df = ingested_chunks_df)
+
+  if VECTOR_BACKEND == 'local':
+    vec.LocalVectorUpsert(chunks_df = None, vectors = None).local_delete(ids = manifest.stale_ids, index_path = LOCAL_INDEX_PATH)
+  else:
+    vec.PineconeUpsert(chunks_df = None, vectors = None, document_store = create_document_store()).pinecone_delete(ids = manifest.stale_ids, pinecone_secret_name='', index_name = '', partition_by_season = PARTITION_BY_SEASON)
+
+  manifest.save()
+  manifest.embeddings.close()
+
+
+def load_manifest():
+
+  manifest = vec.IngestManifest(bucket='rag-training-lookup', key='ingest-manifest.json')
+
+  if INCREMENTAL:
+    manifest.load(encoding_model = ENCODING_MODEL)
+  else:
+    manifest.encoding_model = ENCODING_MODEL
+
+  return manifest
+
+
+def main():
+
+  # Load manifest of previously ingested documents
+
+  manifest = load_manifest()
+
+
+  # List new, changed and removed data in the S3 bucket
+
+  s3_data_load = dl.S3DataLoad(max_workers = DOWNLOAD_WORKERS)
+  s3_data_load.list_files(s3_bucket='', prefix='', suffix='.pdf')
+  s3_data_load.select_changed_files(known_etags = manifest.document_etags())
+
+  if not s3_data_load.file_list['Contents'] and not s3_data_load.removed_keys:
+    logging.info("No new, changed or removed documents to ingest")
+    return
+
+
+  # Resume from the checkpoint of an earlier failed attempt at the same ingest
+
+  chunk_store = vec.ChunkStore(directory = CHUNK_STORE_PATH, run_key = vec.ChunkStore.input_key(s3_data_load.file_etags, s3_data_load.removed_keys, ENCODING_MODEL),
+                               bucket = CHUNK_STORE_BUCKET)
+  chunk_store.load_checkpoint()
+
+
+  # Convert PDF data to vectors and upsert to the vector database
+
+  ingested_chunks_df = run_pipeline(s3_data_load, manifest, chunk_store)
+
+
+  # Record this ingest
+
+  record_ingest(manifest, s3_data_load.file_etags, s3_data_load.removed_keys, ingested_chunks_df)
+  chunk_store.clear()
+
+
+def shard_worker(worker_id = None, local = False):
+  '''Joins the ingest plan in progress, or creates one from the new and changed files, then claims and ingests shards until
+      none are left. The worker that finds every shard complete merges their results into the manifest'''
+
+  store = sh.LocalShardStore(directory = LOCAL_SHARD_PATH) if local else sh.S3ShardStore(bucket = 'rag-training-lookup')
+  coordinator = sh.ShardCoordinator(store = store, worker_id = worker_id, lease_seconds = SHARD_LEASE)
+  manifest = load_manifest()
+
+  if not coordinator.load_plan():
+    s3_data_load = dl.S3DataLoad(max_workers = DOWNLOAD_WORKERS)
+    s3_data_load.list_files(s3_bucket='', prefix='', suffix='.pdf')
+    s3_data_load.select_changed_files(known_etags = manifest.document_etags())
+
+    if not s3_data_load.file_list['Contents'] and not s3_data_load.removed_keys:
+      logging.info("No new, changed or removed documents to ingest")
+      return
+
+    coordinator.create_plan(contents = s3_data_load.file_list['Contents'], removed_keys = s3_data_load.removed_keys, shard_by = SHARD_BY, shard_count = SHARD_COUNT)
+
+
+  # Ingest shards, each with its own chunk store so a taken over shard resumes from its checkpoint
+
+  cached_entities = set(manifest.entities)
+  cached_embeddings = set(manifest.embeddings)
+
+  while True:
+    shard = coordinator.claim_shard()
+
+    if shard is None:
+      break
+
+    s3_data_load = dl.S3DataLoad(max_workers = DOWNLOAD_WORKERS)
+    s3_data_load.file_list = {'Contents': shard['files']}
+    s3_data_load.file_etags = {i['Key']: i['ETag'] for i in shard['files']}
+
+    chunk_store = vec.ChunkStore(directory = os.path.join(CHUNK_STORE_PATH, shard['id']), run_key = vec.ChunkStore.input_key(s3_data_load.file_etags, [], ENCODING_MODEL),
+                                 bucket = CHUNK_STORE_BUCKET, prefix = 'ingest-checkpoint/{}'.format(shard['id']))
+    chunk_store.load_checkpoint()
+
+    ingested_chunks_df = run_pipeline(s3_data_load, manifest, chunk_store)
+
+    coordinator.complete_shard(shard = shard,
+                               rows = ingested_chunks_df[['source', 'id', 'hash']].values.tolist(),
+                               entities = {key: value for key, value in manifest.entities.items() if key not in cached_entities},
+                               embeddings = {key: value for key, value in manifest.embeddings.items() if key not in cached_embeddings})
+    chunk_store.clear()
+
+    cached_entities = set(manifest.entities)
+    cached_embeddings = set(manifest.embeddings)
+
+
+  # Merge every shard into the manifest once all are complete
+
+  manifest.embeddings.close()
+
+  if not coordinator.claim_finalise():
+    logging.info("No shards left to claim, finishing worker")
+    return
+
+  manifest = load_manifest()
+  rows = []
+
+  for shard_rows, shard_entities, shard_embeddings in coordinator.results():
+    rows.extend(shard_rows)
+    manifest.entities.update(shard_entities)
+    manifest.embeddings.update(shard_embeddings)
+
+  record_ingest(manifest, coordinator.file_etags(), coordinator.plan['removed_keys'], pd.DataFrame(rows, columns = ['source', 'id', 'hash']))
+  coordinator.finish()
+
+
+def local_sharded_main():
+  '''Runs LOCAL_WORKERS shard workers as separate processes coordinating through LOCAL_SHARD_PATH'''
 
-  metadata = vec.MetadataExtraction(chunks_list = entities.chunks_list)
-  metadata.metadata_extraction()
-  metadata.chunks_dataframe_creation()
+  context = multiprocessing.get_context('spawn')
+  workers = [context.Process(target = shard_worker, kwargs = {'worker_id': 'local-{}'.format(n), 'local': True}) for n in range(LOCAL_WORKERS)]
 
-  vectors = vec.VectorGeneration(chunks_df = metadata.chunks_df)
-  vectors.vector_generation(encoding_model = 'bge-small-en-v1.5') # Must match the model used to encode queries
+  for worker in workers:
+    worker.start()
 
-  upsert = vec.PineconeUpsert(chunks_df = vectors.chunks_df)
-  upsert.pinecone_upsert(pinecone_secret_name='', index_name = '')
+  for worker in workers:
+    worker.join()
 
 
 if __name__ == "__main__":
-        main()
-  
-  
+  if SHARDING == 'ecs':
+    shard_worker()
+  elif SHARDING == 'local':
+    local_sharded_main()
+  else:
+    main()
@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import data_vectorisation.vectorise as vec
+import pandas as pd
+
+
+SQUAD_TABLE = ' '.join('player {} position midfielder appearances {} goals {}'.format(n, n * 3, n % 4) for n in range(30))
+
+
+def page(text, source):
+    return SimpleNamespace(page_content=text, metadata={'source': source})
+
+
+def texts(all_chunks):
+    return [[document.page_content for document in documents] for documents in all_chunks]
+
+
+def test_exact_duplicates_ignore_case_and_whitespace():
+    deduplication = vec.ChunkDeduplication()
+
+    kept = deduplication.deduplicate([[page('Arsenal won the league', '/tmp/2019/Annual_Arsenal_report.pdf')],
+                                      [page('ARSENAL  won the\nleague', '/tmp/2020/Annual_Chelsea_report.pdf')]])
+
+    assert texts(kept) == [['Arsenal won the league'], []]
+    assert deduplication.duplicate_count == 1
+    assert deduplication.sources[vec.IngestManifest.chunk_hash('Arsenal won the league')] == ['/tmp/2019/Annual_Arsenal_report.pdf',
+                                                                                             '/tmp/2020/Annual_Chelsea_report.pdf']
+
+
+def test_near_duplicates_are_merged_and_distinct_chunks_kept():
+    deduplication = vec.ChunkDeduplication()
+    near_copy = SQUAD_TABLE.replace('goals 3', 'goals 2', 1)
+
+    kept = deduplication.deduplicate([[page(SQUAD_TABLE, '/tmp/2019/Annual_Arsenal_report.pdf'),
+                                       page(near_copy, '/tmp/2020/Annual_Arsenal_report.pdf'),
+                                       page('The manager praised the academy graduates after the final', '/tmp/2020/Annual_Arsenal_report.pdf')]])
+
+    assert texts(kept) == [[SQUAD_TABLE, 'The manager praised the academy graduates after the final']]
+    assert len(deduplication.sources[vec.IngestManifest.chunk_hash(SQUAD_TABLE)]) == 2
+
+
+def test_duplicates_in_a_later_batch_are_merged_into_upserted_chunks():
+    deduplication = vec.ChunkDeduplication()
+    chunk_hash = vec.IngestManifest.chunk_hash(SQUAD_TABLE)
+
+    deduplication.deduplicate([[page(SQUAD_TABLE, '/tmp/2019/Annual_Arsenal_report.pdf')]])
+    deduplication.ingested_rows(pd.DataFrame({'source': ['/tmp/2019/Annual_Arsenal_report.pdf'], 'id': ['2019-Arsenal-abc'], 'hash': [chunk_hash]}))
+
+    kept = deduplication.deduplicate([[page(SQUAD_TABLE, '/tmp/2021/Annual_Arsenal_report.pdf')]])
+
+    assert texts(kept) == [[]]
+    assert deduplication.late_duplicates() == [('2019-Arsenal-abc', chunk_hash, ['/tmp/2019/Annual_Arsenal_report.pdf'], ['/tmp/2021/Annual_Arsenal_report.pdf'])]
+    assert deduplication.late_duplicates() == []
+
+
+def test_merged_chunks_carry_the_years_and_clubs_of_every_source():
+    deduplication = vec.ChunkDeduplication()
+    deduplication.deduplicate([[page(SQUAD_TABLE, '/tmp/2019/Annual_Arsenal_report.pdf')],
+                               [page(SQUAD_TABLE, '/tmp/2020/Annual_Chelsea_report.pdf')]])
+
+    metadata = vec.MetadataExtraction(chunks_list=[], duplicate_sources=deduplication.sources)
+
+    assert metadata.merged_metadata(vec.IngestManifest.chunk_hash(SQUAD_TABLE), '/tmp/2019/Annual_Arsenal_report.pdf') == (['2019', '2020'], ['Arsenal', 'Chelsea'])
+
+
+def test_ingested_rows_record_the_canonical_id_for_each_duplicate_source():
+    deduplication = vec.ChunkDeduplication()
+    chunk_hash = vec.IngestManifest.chunk_hash(SQUAD_TABLE)
+    deduplication.deduplicate([[page(SQUAD_TABLE, '/tmp/2019/Annual_Arsenal_report.pdf')],
+                               [page(SQUAD_TABLE, '/tmp/2020/Annual_Arsenal_report.pdf')]])
+
+    rows = deduplication.ingested_rows(pd.DataFrame({'source': ['/tmp/2019/Annual_Arsenal_report.pdf'], 'id': ['2019-Arsenal-abc'], 'hash': [chunk_hash]}))
+
+    assert rows.values.tolist() == [['/tmp/2019/Annual_Arsenal_report.pdf', '2019-Arsenal-abc', chunk_hash],
+                                    ['/tmp/2020/Annual_Arsenal_report.pdf', '2019-Arsenal-abc', chunk_hash]]
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import data_vectorisation.vectorise as vec
+import numpy as np
+import os
+import pandas as pd
+
+
+def chunk_store(tmp_path, run_key='run-1'):
+    store = vec.ChunkStore(directory=str(tmp_path / 'store'), run_key=run_key)
+    store.load_checkpoint()
+
+    return store
+
+
+def test_stages_round_trip_and_resume_from_the_checkpoint(tmp_path):
+    store = chunk_store(tmp_path)
+    store.save_split([[SimpleNamespace(page_content='alpha', metadata={'source': '/tmp/2019/a.pdf'})]], duplicate_sources={'h': ['/tmp/2019/a.pdf']})
+    store.save_entities([['alpha', '/tmp/2019/a.pdf', ['Arsenal', 'Emirates']]])
+
+    resumed = chunk_store(tmp_path)
+
+    assert resumed.completed('split') and resumed.completed('entities') and not resumed.completed('metadata')
+    assert [[(i.page_content, i.metadata['source']) for i in documents] for documents in resumed.load_split()] == [[('alpha', '/tmp/2019/a.pdf')]]
+    assert resumed.duplicate_sources == {'h': ['/tmp/2019/a.pdf']}
+    assert resumed.load_entities() == [['alpha', '/tmp/2019/a.pdf', ['Arsenal', 'Emirates']]]
+
+
+def test_checkpoint_for_different_input_is_discarded(tmp_path):
+    store = chunk_store(tmp_path)
+    store.save_entities([['alpha', '/tmp/2019/a.pdf', ['Arsenal']]])
+
+    restarted = chunk_store(tmp_path, run_key='run-2')
+
+    assert restarted.completed_stages == []
+    assert not os.path.exists(restarted.path('entities.parquet'))
+
+
+def test_vectors_are_read_back_memory_mapped(tmp_path):
+    store = chunk_store(tmp_path)
+    vectors = np.arange(12, dtype='float32').reshape(3, 4)
+    store.save_vectors(vectors)
+
+    loaded = chunk_store(tmp_path).load_vectors()
+
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded, vectors)
+    assert not os.path.exists(store.path('vectors.npy.tmp'))
+
+
+def test_metadata_columns_keep_their_types(tmp_path):
+    store = chunk_store(tmp_path)
+    store.save_metadata(pd.DataFrame({'chunk': ['alpha'], 'source': ['/tmp/2019/a.pdf'], 'entities': [['Arsenal']], 'year': ['2019'],
+                                      'club': ['Arsenal'], 'hash': ['h'], 'id': ['2019-Arsenal-h']}))
+
+    metadata = chunk_store(tmp_path).load_metadata()
+
+    assert metadata['id'].tolist() == ['2019-Arsenal-h']
+    assert list(metadata['entities'][0]) == ['Arsenal']
+
+
+def test_streaming_parts_accumulate_across_attempts(tmp_path):
+    store = chunk_store(tmp_path)
+    store.save_part(pd.DataFrame({'source': ['/tmp/2019/a.pdf'], 'id': ['id-1'], 'hash': ['h1']}))
+
+    resumed = chunk_store(tmp_path)
+    resumed.save_part(pd.DataFrame({'source': ['/tmp/2019/b.pdf'], 'id': ['id-2'], 'hash': ['h2']}))
+
+    assert [part['id'].tolist() for part in chunk_store(tmp_path).load_parts()] == [['id-1'], ['id-2']]
@@ -0,0 +1,57 @@
+from concurrent.futures import Future
+from unittest import mock
+
+import data_load.data_load as dl
+import logging
+
+
+def finished_future(result=None, exception=None):
+    future = Future()
+
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+    return future
+
+
+def s3_data_load():
+    with mock.patch.object(dl.boto3, 'client'):
+        return dl.S3DataLoad()
+
+
+def test_completed_downloads_logs_before_yielding(caplog):
+    pending = {finished_future(b'pdf'): '2019/Arsenal_report.pdf'}
+
+    with caplog.at_level(logging.INFO):
+        generator = s3_data_load().completed_downloads(pending)
+        assert next(generator) == ('2019/Arsenal_report.pdf', b'pdf')
+
+    assert '2019/Arsenal_report.pdf downloaded' in caplog.text
+
+
+def test_completed_downloads_skips_failures_and_closes_cleanly(caplog):
+    pending = {finished_future(exception=OSError('timed out')): '2019/Chelsea_report.pdf',
+               finished_future(b'first'): '2019/Arsenal_report.pdf',
+               finished_future(b'second'): '2020/Arsenal_report.pdf'}
+
+    with caplog.at_level(logging.ERROR):
+        generator = s3_data_load().completed_downloads(pending)
+        key, data = next(generator)
+        generator.close()
+
+    assert data in (b'first', b'second')
+    assert 'Unable to download file 2019/Arsenal_report.pdf' not in caplog.text
+    assert 'Unable to download file 2020/Arsenal_report.pdf' not in caplog.text
+
+
+def test_select_changed_files():
+    loader = s3_data_load()
+    loader.prefix, loader.suffix = '', '.pdf'
+    loader.file_list = {'Contents': [{'Key': '2019/a.pdf', 'ETag': '"1"'}, {'Key': '2019/b.pdf', 'ETag': '"3"'}]}
+
+    loader.select_changed_files({'2019/a.pdf': '"1"', '2019/b.pdf': '"2"', '2018/c.pdf': '"4"'})
+
+    assert loader.file_etags == {'2019/b.pdf': '"3"'}
+    assert loader.removed_keys == ['2018/c.pdf']
@@ -0,0 +1,129 @@
+from botocore.exceptions import ClientError
+from types import SimpleNamespace
+from unittest import mock
+
+import data_vectorisation.vectorise as vec
+import json
+import re
+import threading
+
+
+def page(text, source='/tmp/2019/Arsenal_2019.pdf'):
+    return SimpleNamespace(page_content=text, metadata={'source': source})
+
+
+def extraction(**kwargs):
+    with mock.patch.object(vec.boto3, 'client'):
+        return vec.EntityExtraction(**kwargs)
+
+
+def throttled():
+    return ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'Converse')
+
+
+def test_output_keeps_input_order_and_shape():
+    extractor = extraction(max_workers=4)
+    extractor.bedrock_interaction = lambda model, prompt: 'Entity for {}'.format(re.search(r'chunk \d+', prompt).group())
+
+    extractor.entity_extraction([[page('chunk {}'.format(n)) for n in range(10)]], model='haiku')
+
+    assert extractor.chunks_list == [['chunk {}'.format(n), '/tmp/2019/Arsenal_2019.pdf', ['Entity for chunk {}'.format(n)]] for n in range(10)]
+
+
+def test_throttled_requests_are_retried_and_concurrency_reduced(monkeypatch):
+    monkeypatch.setattr(vec.time, 'sleep', lambda seconds: None)
+    extractor = extraction(max_workers=4)
+    attempts = []
+
+    def bedrock_interaction(model, prompt):
+        attempts.append(extractor.concurrency)
+
+        if len(attempts) <= 2:
+            raise throttled()
+
+        return 'Arsenal, Emirates Stadium'
+
+    extractor.bedrock_interaction = bedrock_interaction
+
+    assert extractor.single_chunk_entities('chunk', model='haiku') == ['Arsenal', 'Emirates Stadium']
+    # Each throttle halves the limit, the success then starts recovering it
+    assert attempts == [4, 2, 1]
+    assert extractor.concurrency == 2
+    assert extractor.in_flight == 0
+
+
+def test_concurrency_recovers_after_a_window_of_successes():
+    extractor = extraction(max_workers=4)
+    extractor.concurrency = 2
+
+    for outcome in ['success', 'success']:
+        extractor.acquire_slot()
+        extractor.release_slot(outcome)
+
+    assert extractor.concurrency == 3
+
+
+def test_in_flight_requests_never_exceed_the_limit():
+    extractor = extraction(max_workers=3)
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def bedrock_interaction(model, prompt):
+        with lock:
+            active.append(prompt)
+            peak.append(len(active))
+
+        threading.Event().wait(0.01)
+
+        with lock:
+            active.remove(prompt)
+
+        return 'Entity'
+
+    extractor.bedrock_interaction = bedrock_interaction
+    extractor.entity_extraction([[page('chunk {}'.format(n)) for n in range(12)]], model='haiku')
+
+    assert len(extractor.chunks_list) == 12
+    assert max(peak) <= 3
+
+
+def test_packed_prompts_are_split_per_chunk():
+    extractor = extraction()
+    prompts = []
+
+    def bedrock_interaction(model, prompt):
+        prompts.append(prompt)
+        return json.dumps({'1': ['Arsenal'], '2': ['Chelsea', 'Stamford Bridge'], '3': []})
+
+    extractor.bedrock_interaction = bedrock_interaction
+    extractor.entity_extraction([[page('a'), page('b'), page('c')]], model='haiku', chunks_per_prompt=3)
+
+    assert len(prompts) == 1
+    assert [chunk[2] for chunk in extractor.chunks_list] == [['Arsenal'], ['Chelsea', 'Stamford Bridge'], []]
+
+
+def test_unparseable_packed_response_falls_back_to_single_chunks():
+    extractor = extraction()
+
+    def bedrock_interaction(model, prompt):
+        if 'numbered texts' in prompt:
+            return 'not json'
+
+        return 'Single'
+
+    extractor.bedrock_interaction = bedrock_interaction
+    extractor.entity_extraction([[page('a'), page('b')]], model='haiku', chunks_per_prompt=2)
+
+    assert [chunk[2] for chunk in extractor.chunks_list] == [['Single'], ['Single']]
+
+
+def test_cached_entities_skip_bedrock():
+    extractor = extraction()
+    extractor.bedrock_interaction = lambda model, prompt: 'Fresh'
+    cache = {vec.IngestManifest.chunk_hash('a'): ['Cached']}
+
+    extractor.entity_extraction([[page('a'), page('b')]], model='haiku', entity_cache=cache)
+
+    assert [chunk[2] for chunk in extractor.chunks_list] == [['Cached'], ['Fresh']]
+    assert cache[vec.IngestManifest.chunk_hash('b')] == ['Fresh']
@@ -0,0 +1,130 @@
+from botocore.exceptions import ClientError
+from unittest import mock
+
+import data_vectorisation.vectorise as vec
+import io
+import json
+import numpy as np
+import pandas as pd
+
+
+class MemoryS3Client:
+
+    def __init__(self):
+        self.objects = {}
+
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body.encode('utf-8') if isinstance(Body, str) else Body
+
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}}, 'GetObject')
+
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+
+    def download_file(self, Bucket, Key, Filename):
+        with open(Filename, 'wb') as f:
+            f.write(self.get_object(Bucket, Key)['Body'].read())
+
+
+def manifest(s3):
+    with mock.patch.object(vec.boto3, 'client', return_value=s3):
+        return vec.IngestManifest(bucket='bucket', key='ingest-manifest.json')
+
+
+def chunks(*rows):
+    return pd.DataFrame(rows, columns=['source', 'id', 'hash'])
+
+
+def test_missing_manifest_ingests_everything():
+    ingest_manifest = manifest(MemoryS3Client())
+    ingest_manifest.load('model-a')
+
+    assert ingest_manifest.document_etags() == {}
+
+
+def test_changed_and_removed_documents_produce_stale_ids():
+    ingest_manifest = manifest(MemoryS3Client())
+    ingest_manifest.documents = {'2019/a.pdf': {'etag': '"1"', 'chunk_ids': ['a1', 'a2'], 'chunk_hashes': ['h1', 'h2']},
+                                 '2019/b.pdf': {'etag': '"1"', 'chunk_ids': ['b1', 'shared'], 'chunk_hashes': ['h3', 'h4']},
+                                 '2019/c.pdf': {'etag': '"1"', 'chunk_ids': ['c1'], 'chunk_hashes': ['h5']}}
+
+    ingest_manifest.update_documents(file_etags={'2019/a.pdf': '"2"'},
+                                     removed_keys=['2019/b.pdf'],
+                                     chunks_df=chunks(('/tmp/2019/a.pdf', 'a1', 'h1'), ('/tmp/2019/a.pdf', 'shared', 'h4')))
+
+    # a2 left the changed document, b1 left with the removed one, shared is still live in a
+    assert ingest_manifest.stale_ids == ['b1', 'a2']
+    assert ingest_manifest.document_etags() == {'2019/a.pdf': '"2"', '2019/c.pdf': '"1"'}
+
+
+def test_document_without_chunks_keeps_its_previous_entry():
+    ingest_manifest = manifest(MemoryS3Client())
+    ingest_manifest.documents = {'2019/a.pdf': {'etag': '"1"', 'chunk_ids': ['a1'], 'chunk_hashes': ['h1']}}
+
+    ingest_manifest.update_documents(file_etags={'2019/a.pdf': '"2"'}, removed_keys=[], chunks_df=chunks())
+
+    assert ingest_manifest.document_etags() == {'2019/a.pdf': '"1"'}
+    assert ingest_manifest.stale_ids == []
+
+
+def test_caches_round_trip_and_drop_dead_chunks():
+    s3 = MemoryS3Client()
+    first = manifest(s3)
+    first.load('model-a')
+    first.update_documents(file_etags={'2019/a.pdf': '"1"'}, removed_keys=[], chunks_df=chunks(('/tmp/2019/a.pdf', 'a1', 'h1')))
+    first.entities = {'h1': ['Arsenal'], 'dead': ['Gone']}
+    first.embeddings.update({'h1': np.array([1.0, 2.0], dtype='float32'), 'dead': np.array([0.0, 0.0], dtype='float32')})
+    first.save()
+
+    second = manifest(s3)
+    second.load('model-a')
+
+    assert second.entities == {'h1': ['Arsenal']}
+    assert list(second.embeddings) == ['h1']
+    assert second.embeddings['h1'].tolist() == [1.0, 2.0]
+    assert json.loads(s3.objects[('bucket', 'index-version.json')])['chunks'] == 1
+
+
+def test_embeddings_from_another_model_are_discarded():
+    s3 = MemoryS3Client()
+    first = manifest(s3)
+    first.load('model-a')
+    first.update_documents(file_etags={'2019/a.pdf': '"1"'}, removed_keys=[], chunks_df=chunks(('/tmp/2019/a.pdf', 'a1', 'h1')))
+    first.embeddings['h1'] = np.array([1.0, 2.0], dtype='float32')
+    first.save()
+
+    second = manifest(s3)
+    second.load('model-b')
+
+    assert len(second.embeddings) == 0
+    assert second.document_etags() == {'2019/a.pdf': '"1"'}
+
+
+def test_embedding_cache_maps_previous_vectors_and_appends_new_ones(tmp_path):
+    s3 = MemoryS3Client()
+    first = manifest(s3)
+    first.load('model-a')
+    first.update_documents(file_etags={'2019/a.pdf': '"1"'}, removed_keys=[], chunks_df=chunks(('/tmp/2019/a.pdf', 'a1', 'h1'), ('/tmp/2019/a.pdf', 'a2', 'h2')))
+    first.embeddings.update([('h1', [1.0, 2.0]), ('h2', [3.0, 4.0])])
+    first.save()
+
+    second = manifest(s3)
+    second.load('model-a')
+    second.embeddings['h3'] = [5.0, 6.0]
+    second.embeddings['h1'] = [9.0, 9.0]
+
+    assert isinstance(second.embeddings.matrix, np.memmap)
+    assert [(chunk_hash, vector.tolist()) for chunk_hash, vector in second.embeddings.items()] == [('h1', [1.0, 2.0]), ('h2', [3.0, 4.0]), ('h3', [5.0, 6.0])]
+
+    second.embeddings.save(str(tmp_path / 'saved.npy'), ['h3', 'h1'])
+
+    assert np.load(str(tmp_path / 'saved.npy')).tolist() == [[5.0, 6.0], [1.0, 2.0]]
@@ -0,0 +1,38 @@
+from concurrent.futures import Future
+
+import data_vectorisation.vectorise as vec
+import logging
+
+
+def finished_future(result=None, exception=None):
+    future = Future()
+
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+    return future
+
+
+def test_completed_pdfs_skips_failed_files(caplog):
+    pending = {finished_future(['chunk']): '/tmp/2019/a.pdf', finished_future(exception=ValueError('bad pdf')): '/tmp/2019/b.pdf'}
+
+    with caplog.at_level(logging.ERROR):
+        results = list(vec.PDFLoader().completed_pdfs(pending))
+
+    assert results == [['chunk']]
+    assert pending == {}
+    assert 'Unable to load PDF /tmp/2019/b.pdf' in caplog.text
+
+
+def test_completed_pdfs_closes_cleanly(caplog):
+    pending = {finished_future(['first']): '/tmp/2019/a.pdf', finished_future(['second']): '/tmp/2019/b.pdf'}
+    generator = vec.PDFLoader().completed_pdfs(pending)
+
+    next(generator)
+
+    with caplog.at_level(logging.ERROR):
+        generator.close()
+
+    assert 'Unable to load PDF' not in caplog.text
@@ -0,0 +1,179 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import data_sharding.sharding as sh
+import json
+import numpy as np
+import time
+
+
+CONTENTS = [{'Key': '2014/2014–15_Arsenal_F.C._season.pdf', 'ETag': '"a"', 'Size': 300},
+            {'Key': '2014/2014–15_Chelsea_F.C._season.pdf', 'ETag': '"b"', 'Size': 200},
+            {'Key': '2014/2014–15_Manchester_United_F.C._season.pdf', 'ETag': '"c"', 'Size': 100},
+            {'Key': '2015/2015–16_Arsenal_F.C._season.pdf', 'ETag': '"d"', 'Size': 50}]
+
+
+def coordinator(tmp_path, worker_id, lease_seconds=60):
+    return sh.ShardCoordinator(store=sh.LocalShardStore(str(tmp_path)), worker_id=worker_id, lease_seconds=lease_seconds)
+
+
+def planned(tmp_path, worker_id, lease_seconds=60):
+    worker = coordinator(tmp_path, worker_id, lease_seconds)
+    worker.create_plan(contents=CONTENTS, removed_keys=['2013/2013–14_Arsenal_F.C._season.pdf'])
+
+    return worker
+
+
+def complete(worker, shard):
+    return worker.complete_shard(shard=shard, rows=[[i['Key'], i['ETag'], i['ETag']] for i in shard['files']],
+                                 entities={shard['id']: 'Entity'}, embeddings={shard['id']: np.ones(4, dtype='float32')})
+
+
+def test_shard_name_finds_the_club_anywhere_in_the_file_name():
+    assert sh.ShardCoordinator.shard_name('2014/2014–15_Arsenal_F.C._season.pdf', 'prefix', 32) == '2014-Arsenal'
+    assert sh.ShardCoordinator.shard_name('2014/2014–15_Manchester_United_F.C._season.pdf', 'prefix', 32) == '2014-Manchester_United'
+    assert sh.ShardCoordinator.shard_name('2014/2014–15_Fulham_F.C._season.pdf', 'prefix', 32) == '2014-other'
+    assert sh.ShardCoordinator.shard_name('2014/2014–15_Arsenal_F.C._season.pdf', 'hash', 4).startswith('hash-000')
+
+
+def test_shard_files_splits_each_year_by_club_largest_first():
+    shards = sh.ShardCoordinator.shard_files(CONTENTS)
+
+    assert [shard['id'] for shard in shards] == ['2014-Arsenal', '2014-Chelsea', '2014-Manchester_United', '2015-Arsenal']
+
+
+def test_workers_share_the_first_plan(tmp_path):
+    workers = [coordinator(tmp_path, 'worker-{}'.format(n)) for n in range(8)]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda worker: worker.create_plan(contents=CONTENTS, removed_keys=[]), workers))
+
+    assert len(set(worker.plan['run_id'] for worker in workers)) == 1
+
+
+def test_concurrent_claims_have_one_winner(tmp_path):
+    first = planned(tmp_path, 'worker-0')
+    workers = [first] + [coordinator(tmp_path, 'worker-{}'.format(n)) for n in range(1, 8)]
+
+    for worker in workers[1:]:
+        worker.load_plan()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        claimed = list(executor.map(lambda worker: worker.claim('2014-Arsenal'), workers))
+
+    assert claimed.count(True) == 1
+
+    for worker in workers:
+        worker.release('2014-Arsenal')
+
+
+def test_expired_claim_is_taken_over_and_the_first_worker_discards_its_results(tmp_path):
+    crashed = planned(tmp_path, 'crashed', lease_seconds=0.3)
+    shard = crashed.claim_shard()
+
+    # Stop renewing as if the worker had hung
+    crashed.heartbeats[shard['id']].set()
+
+    taking_over = coordinator(tmp_path, 'taking-over', lease_seconds=0.3)
+    taking_over.load_plan()
+
+    assert taking_over.claim(shard['id']) is False
+
+    time.sleep(0.4)
+
+    assert taking_over.claim(shard['id']) is True
+    assert crashed.holds_claim(shard['id']) is False
+    assert complete(crashed, shard) is False
+    assert shard['id'] not in taking_over.completed_shards()
+    assert complete(taking_over, shard) is True
+    assert shard['id'] in taking_over.completed_shards()
+
+
+def test_heartbeat_stops_renewing_a_taken_over_claim(tmp_path):
+    worker = planned(tmp_path, 'worker', lease_seconds=0.3)
+    worker.claim('2014-Arsenal')
+
+    # Another worker takes over with the next attempt
+    worker.store.create(worker.claim_key('2014-Arsenal', 1), json.dumps({'worker': 'other', 'renewed': time.time()}).encode('utf-8'))
+    time.sleep(0.25)
+
+    renewed = json.loads(worker.store.get(worker.claim_key('2014-Arsenal', 0)))['renewed']
+    time.sleep(0.25)
+
+    assert worker.heartbeats['2014-Arsenal'].is_set()
+    assert json.loads(worker.store.get(worker.claim_key('2014-Arsenal', 0)))['renewed'] == renewed
+
+
+def test_finalise_runs_once_after_every_shard(tmp_path):
+    workers = [planned(tmp_path, 'worker-0')] + [coordinator(tmp_path, 'worker-{}'.format(n)) for n in range(1, 3)]
+
+    for worker in workers[1:]:
+        worker.load_plan()
+
+    assert workers[0].claim_finalise() is False
+
+    def run(worker):
+        while True:
+            shard = worker.claim_shard()
+
+            if shard is None:
+                return
+
+            complete(worker, shard)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        list(executor.map(run, workers))
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        finalising = list(executor.map(lambda worker: worker.claim_finalise(), workers))
+
+    assert finalising.count(True) == 1
+
+    finaliser = workers[finalising.index(True)]
+    results = list(finaliser.results())
+
+    assert sorted(row[0] for rows, _, _ in results for row in rows) == sorted(i['Key'] for i in CONTENTS)
+    assert sorted(key for _, entities, _ in results for key in entities) == sorted(shard['id'] for shard in finaliser.plan['shards'])
+    assert finaliser.file_etags() == {i['Key']: i['ETag'] for i in CONTENTS}
+
+    finaliser.finish()
+
+    assert finaliser.store.get('plan.json') is None
+    assert finaliser.store.list_keys(finaliser.plan['run_id'] + '/') == [finaliser.run_key('finished.json')]
+
+
+def test_slow_worker_cannot_claim_shards_of_a_finished_run(tmp_path):
+    finaliser = planned(tmp_path, 'finaliser')
+    slow = coordinator(tmp_path, 'slow')
+    slow.load_plan()
+
+    for shard in finaliser.plan['shards']:
+        assert finaliser.claim(shard['id'])
+        complete(finaliser, shard)
+
+    assert finaliser.claim_finalise()
+    finaliser.finish()
+
+    # The shard records are gone so every shard looks pending to the slow worker's plan
+    assert len(slow.pending_shards()) == len(slow.plan['shards'])
+    assert slow.claim_shard() is None
+    assert slow.claim('2014-Arsenal') is False
+    assert slow.claim_finalise() is False
+    assert slow.store.list_keys(slow.plan['run_id'] + '/') == [slow.run_key('finished.json')]
+
+
+def test_claim_created_as_the_run_finishes_is_withdrawn(tmp_path, monkeypatch):
+    finaliser = planned(tmp_path, 'finaliser')
+    slow = coordinator(tmp_path, 'slow')
+    slow.load_plan()
+
+    create = slow.store.create
+
+    def create_then_finish(key, body):
+        created = create(key, body)
+        finaliser.finish()
+        return created
+
+    monkeypatch.setattr(slow.store, 'create', create_then_finish)
+
+    assert slow.claim('2014-Arsenal') is False
+    assert 'slow' not in [json.loads(slow.store.get(key)).get('worker') for key in slow.store.list_keys(slow.plan['run_id'] + '/')]
@@ -0,0 +1,53 @@
+import data_vectorisation.vectorise as vec
+import numpy as np
+import pandas as pd
+
+
+class FakeModel:
+
+    def __init__(self):
+        self.calls = []
+
+
+    def encode(self, chunks, batch_size=32, convert_to_numpy=True):
+        self.calls.append((list(chunks), batch_size))
+        return np.array([[len(chunk), 1.0] for chunk in chunks])
+
+
+def test_chunks_are_encoded_in_one_batched_call_into_a_contiguous_matrix(monkeypatch):
+    model = FakeModel()
+    monkeypatch.setattr(vec, 'SentenceTransformer', lambda encoding_model: model)
+    generation = vec.VectorGeneration(pd.DataFrame({'chunk': ['alpha', 'be', 'gamma text']}))
+    generation.vector_generation('model-name', batch_size=16, dtype='float16')
+
+    assert model.calls == [(['alpha', 'be', 'gamma text'], 16)]
+    assert generation.vectors.dtype == np.float16
+    assert generation.vectors.flags['C_CONTIGUOUS']
+    assert generation.vectors.tolist() == [[5.0, 1.0], [2.0, 1.0], [10.0, 1.0]]
+
+
+def test_cached_embeddings_are_reused_and_new_ones_added(monkeypatch):
+    model = FakeModel()
+    monkeypatch.setattr(vec, 'SentenceTransformer', lambda encoding_model: model)
+    cached_hash = vec.IngestManifest.chunk_hash('alpha')
+    cache = {cached_hash: np.array([9.0, 9.0], dtype='float32')}
+
+    generation = vec.VectorGeneration(pd.DataFrame({'chunk': ['alpha', 'beta', 'alpha']}))
+    generation.vector_generation('model-name', embedding_cache=cache)
+
+    assert model.calls == [(['beta'], 64)]
+    assert generation.vectors.tolist() == [[9.0, 9.0], [4.0, 1.0], [9.0, 9.0]]
+    assert set(cache) == {cached_hash, vec.IngestManifest.chunk_hash('beta')}
+
+
+def test_fully_cached_chunks_do_not_load_the_model(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('model should not be loaded')
+
+    monkeypatch.setattr(vec, 'SentenceTransformer', fail)
+    cache = {vec.IngestManifest.chunk_hash('alpha'): np.array([1.0, 2.0], dtype='float32')}
+
+    generation = vec.VectorGeneration(pd.DataFrame({'chunk': ['alpha']}))
+    generation.vector_generation('model-name', embedding_cache=cache)
+
+    assert generation.vectors.tolist() == [[1.0, 2.0]]
@@ -0,0 +1,212 @@
+from botocore.exceptions import ClientError
+from concurrent.futures import Future
+from types import SimpleNamespace
+from unittest import mock
+
+import data_vectorisation.vectorise as vec
+import io
+import json
+import numpy as np
+import os
+import pandas as pd
+
+
+class FakeIndex:
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.requests = []
+
+
+    def upsert(self, vectors, namespace, async_req):
+        self.requests.append((namespace, [vector_id for vector_id, _, _ in vectors]))
+        future = Future()
+
+        if self.failures:
+            self.failures -= 1
+            future.set_exception(OSError('unavailable'))
+        else:
+            future.set_result(SimpleNamespace(upserted_count=len(vectors)))
+
+        return future
+
+
+def many_chunks_df(rows):
+    return pd.DataFrame({'id': ['id-{}'.format(n) for n in range(rows)],
+                         'year': ['2019'] * rows,
+                         'club': ['Arsenal'] * rows,
+                         'entities': ['None'] * rows,
+                         'chunk': ['text {}'.format(n) for n in range(rows)]})
+
+
+def test_every_row_is_upserted_across_batch_boundaries():
+    index = FakeIndex()
+    upsert = vec.PineconeUpsert(chunks_df=many_chunks_df(250), vectors=np.ones((250, 4), dtype='float32'))
+    upsert.pinecone_upsert('secret', 'index', index=index, batch_size=100, max_in_flight=2)
+
+    assert [len(ids) for _, ids in index.requests] == [100, 100, 50]
+    assert sorted(i for _, ids in index.requests for i in ids) == sorted('id-{}'.format(n) for n in range(250))
+    assert upsert.upsert_summary == {'batches': 3, 'upserted_vectors': 250, 'retried_batches': 0, 'failed_batches': []}
+
+
+def test_failed_batches_are_retried_with_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(vec.time, 'sleep', sleeps.append)
+
+    upsert = vec.PineconeUpsert(chunks_df=many_chunks_df(10), vectors=np.ones((10, 4), dtype='float32'))
+    upsert.pinecone_upsert('secret', 'index', index=FakeIndex(failures=2), batch_size=10, base_backoff=1)
+
+    assert sleeps == [1, 2]
+    assert upsert.batch_results[0]['attempts'] == 3
+    assert upsert.upsert_summary['retried_batches'] == 1
+    assert upsert.upsert_summary['upserted_vectors'] == 10
+
+
+def test_batches_that_keep_failing_are_reported(monkeypatch):
+    monkeypatch.setattr(vec.time, 'sleep', lambda seconds: None)
+
+    upsert = vec.PineconeUpsert(chunks_df=many_chunks_df(10), vectors=np.ones((10, 4), dtype='float32'))
+    upsert.pinecone_upsert('secret', 'index', index=FakeIndex(failures=10), batch_size=5, max_retries=1)
+
+    assert upsert.upsert_summary['failed_batches'] == [0, 1]
+    assert all(result['attempts'] == 2 for result in upsert.batch_results)
+
+
+def test_partition_rows_writes_each_season_once():
+    df = many_chunks_df(3)
+    df['years'] = [['2019'], ['2020'], ['2019', '2020']]
+    upsert = vec.PineconeUpsert(chunks_df=df, vectors=np.ones((3, 4), dtype='float32'))
+    columns = upsert.upsert_columns()
+
+    assert [(namespace, rows.tolist()) for namespace, rows in upsert.partition_rows(columns, partition_by_season=True)] == [('2019', [0, 2]), ('2020', [1, 2])]
+    assert [namespace for namespace, _ in upsert.partition_rows(columns, partition_by_season=True, default_namespace=True)] == ['', '2019', '2020']
+    assert [(namespace, rows.tolist()) for namespace, rows in upsert.partition_rows(columns, partition_by_season=False)] == [('', [0, 1, 2])]
+
+
+def test_metadata_updates_follow_the_namespaces_vectors_were_written_to():
+    index = SimpleNamespace(updates=[])
+    index.update = lambda id, set_metadata, namespace: index.updates.append((id, namespace))
+
+    vec.PineconeUpsert.pinecone_update_metadata(index, [('a', {}, ['2019', '2020'])], partition_by_season=True)
+    vec.PineconeUpsert.pinecone_update_metadata(index, [('b', {}, ['2019'])], partition_by_season=True, default_namespace=True)
+    vec.PineconeUpsert.pinecone_update_metadata(index, [('c', {}, ['2019'])])
+
+    assert index.updates == [('a', '2019'), ('a', '2020'), ('b', ''), ('b', '2019'), ('c', '')]
+
+
+
+def chunks_df():
+    return pd.DataFrame({'id': ['2019-Arsenal-a', '2019-Arsenal-b'],
+                         'year': ['2019', '2019'],
+                         'club': ['Arsenal', 'Arsenal'],
+                         'entities': ['Bukayo Saka', 'None'],
+                         'chunk': ['alpha text', 'beta text']})
+
+
+class ConditionalS3Client:
+    '''In memory S3 stand-in supporting the conditional writes the document store swaps its index with'''
+
+    def __init__(self):
+        self.objects = {}
+        self.before_index_write = None
+
+
+    @staticmethod
+    def error(code):
+        return ClientError({'Error': {'Code': code, 'Message': code}}, 'S3')
+
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.error('NoSuchKey')
+
+        return {'Body': io.BytesIO(self.objects[Key]), 'ETag': '"{}"'.format(hash(self.objects[Key]))}
+
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        if Key.endswith('index.json') and self.before_index_write:
+            callback, self.before_index_write = self.before_index_write, None
+            callback()
+
+        current = self.objects.get(Key)
+
+        if (IfNoneMatch == '*' and current is not None) or (IfMatch is not None and (current is None or '"{}"'.format(hash(current)) != IfMatch)):
+            raise self.error('PreconditionFailed')
+
+        self.objects[Key] = Body.encode('utf-8') if isinstance(Body, str) else Body
+
+
+    def delete_objects(self, Bucket, Delete):
+        for i in Delete['Objects']:
+            self.objects.pop(i['Key'], None)
+
+
+    def shards(self):
+        index = json.loads(self.objects['document-store/index.json'])['shards']
+        return {name: json.loads(self.objects[key]) for name, key in index.items()}
+
+
+def document_store(s3=None):
+    with mock.patch.object(vec.boto3, 'client', return_value=s3 or ConditionalS3Client()):
+        return vec.DocumentStore(bucket='bucket', max_workers=2)
+
+
+def test_document_store_packs_text_into_one_shard_per_season_and_club():
+    store = document_store()
+    store.upsert(['2019-Arsenal-a', '2019-Arsenal-b', '2020-Chelsea-c'], ['alpha text', 'beta text', 'gamma text'])
+
+    assert store.s3.shards() == {'2019-Arsenal': {'2019-Arsenal-a': 'alpha text', '2019-Arsenal-b': 'beta text'}, '2020-Chelsea': {'2020-Chelsea-c': 'gamma text'}}
+    assert len(store.s3.objects) == 3
+
+
+def test_document_store_changes_write_new_shards_and_delete_replaced_ones():
+    store = document_store()
+    store.upsert(['2019-Arsenal-a', '2019-Arsenal-b', '2020-Chelsea-c'], ['alpha text', 'beta text', 'gamma text'])
+    first_keys = set(store.s3.objects)
+
+    store.delete(['2019-Arsenal-b', '2020-Chelsea-c'])
+
+    assert store.s3.shards() == {'2019-Arsenal': {'2019-Arsenal-a': 'alpha text'}}
+    assert len(store.s3.objects) == 2
+    assert not first_keys & set(store.s3.objects) - {'document-store/index.json'}
+
+
+def test_document_store_retries_when_another_writer_swaps_the_index():
+    s3 = ConditionalS3Client()
+    store = document_store(s3)
+    store.upsert(['2019-Arsenal-a'], ['alpha text'])
+
+    s3.before_index_write = lambda: document_store(s3).upsert(['2020-Chelsea-c'], ['gamma text'])
+    store.upsert(['2019-Arsenal-b'], ['beta text'])
+
+    assert s3.shards() == {'2019-Arsenal': {'2019-Arsenal-a': 'alpha text', '2019-Arsenal-b': 'beta text'}, '2020-Chelsea': {'2020-Chelsea-c': 'gamma text'}}
+
+
+def test_text_stays_out_of_metadata_with_a_document_store():
+    vectors = np.ones((2, 4), dtype='float32')
+    upsert = vec.PineconeUpsert(chunks_df=chunks_df(), vectors=vectors, document_store=document_store())
+    batch = upsert.batch_vectors(upsert.upsert_columns(), np.arange(2))
+
+    assert [vector_id for vector_id, _, _ in batch] == ['2019-Arsenal-a', '2019-Arsenal-b']
+    assert batch[0][2] == {'year': '2019', 'club': 'Arsenal', 'entities': 'Bukayo Saka'}
+
+
+def test_text_kept_in_metadata_without_a_document_store():
+    upsert = vec.PineconeUpsert(chunks_df=chunks_df(), vectors=np.ones((2, 4), dtype='float32'))
+
+    assert upsert.batch_vectors(upsert.upsert_columns(), np.arange(2))[1][2]['text'] == 'beta text'
+
+
+def test_local_index_keeps_text_in_documents_json(tmp_path):
+    index_path = str(tmp_path)
+    vec.LocalVectorUpsert(chunks_df=chunks_df(), vectors=np.ones((2, 4), dtype='float32')).local_upsert(index_path=index_path)
+
+    with open(os.path.join(index_path, 'metadata.json')) as f:
+        assert all('text' not in row for row in json.load(f))
+
+    assert vec.LocalVectorUpsert.load_documents(index_path) == {'2019-Arsenal-a': 'alpha text', '2019-Arsenal-b': 'beta text'}
+
+    vec.LocalVectorUpsert(chunks_df=None, vectors=None).local_delete(ids=['2019-Arsenal-a'], index_path=index_path)
+
+    assert vec.LocalVectorUpsert.load_documents(index_path) == {'2019-Arsenal-b': 'beta text'}
+    assert [row['id'] for row in vec.LocalVectorUpsert.load_index(index_path)[1]] == ['2019-Arsenal-b']